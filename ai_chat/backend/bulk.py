@@ -0,0 +1,167 @@
+"""
+批量导入：流式解析 NDJSON 请求体，消息攒够一批后在一个事务内写入
+
+导入格式每行一个 JSON 对象：
+    {"type": "conversation", "id": 1, "title": "...", "created_at": "...", "updated_at": "..."}
+    {"type": "message", "conversation_id": 1, "role": "user", "content": "...", "created_at": "..."}
+message 行的 conversation_id 指向同一文件中 conversation 行的 id（导入后会分配新的 id）；
+conversation 行也可以带 "messages" 数组内联其消息。
+"""
+import json
+from typing import AsyncIterator, Dict, List, Optional, Set, Tuple
+
+from http_cache import to_db_timestamp
+
+# 每批写入的消息条数
+BULK_BATCH_SIZE = 2000
+
+# 单行最大字节数，防止没有换行的请求体占满内存
+MAX_LINE_BYTES = 16 * 1024 * 1024  # 16MB
+
+
+class BulkImportError(Exception):
+    """导入数据格式错误，line 为出错的行号（从 1 开始）"""
+
+    def __init__(self, line: int, message: str):
+        super().__init__(f"Line {line}: {message}")
+        self.line = line
+
+
+async def iter_ndjson(stream: AsyncIterator[bytes],
+                      max_line_bytes: int = MAX_LINE_BYTES) -> AsyncIterator[Tuple[int, Dict]]:
+    """逐行解析 NDJSON 字节流，产出 (行号, 对象)，跳过空行"""
+    buffer = bytearray()
+    line_no = 0
+
+    def parse(line: bytes) -> Optional[Dict]:
+        if not line.strip():
+            return None
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            raise BulkImportError(line_no, f"Invalid JSON: {e}")
+        if not isinstance(record, dict):
+            raise BulkImportError(line_no, "Each line must be a JSON object")
+        return record
+
+    async for chunk in stream:
+        buffer += chunk
+        start = 0
+        while True:
+            end = buffer.find(b"\n", start)
+            if end < 0:
+                break
+            line_no += 1
+            record = parse(bytes(buffer[start:end]))
+            if record is not None:
+                yield line_no, record
+            start = end + 1
+        del buffer[:start]
+        if len(buffer) > max_line_bytes:
+            raise BulkImportError(line_no + 1, f"Line exceeds {max_line_bytes} bytes")
+
+    # 最后一行可以没有换行符
+    if buffer:
+        line_no += 1
+        record = parse(bytes(buffer))
+        if record is not None:
+            yield line_no, record
+
+
+def _optional_timestamp(line: int, record: Dict, field: str) -> Optional[str]:
+    value = record.get(field)
+    if value is None:
+        return None
+    if not isinstance(value, str):
+        raise BulkImportError(line, f"'{field}' must be a string")
+    try:
+        return to_db_timestamp(value)
+    except ValueError:
+        raise BulkImportError(line, f"Invalid timestamp in '{field}'")
+
+
+def message_row(line: int, conversation_id: int, record: Dict) -> Dict:
+    """校验一条消息记录，转换为 add_messages_bulk 需要的格式"""
+    role = record.get("role")
+    content = record.get("content")
+    if not isinstance(role, str) or not role:
+        raise BulkImportError(line, "'role' must be a non-empty string")
+    if not isinstance(content, str):
+        raise BulkImportError(line, "'content' must be a string")
+    return {
+        "conversation_id": conversation_id,
+        "role": role,
+        "content": content,
+        "created_at": _optional_timestamp(line, record, "created_at"),
+    }
+
+
+class BulkImporter:
+    """把导入记录分批写入数据库，记录导入数量和涉及的对话"""
+
+    def __init__(self, db, batch_size: int = BULK_BATCH_SIZE):
+        self.db = db
+        self.batch_size = batch_size
+        self.pending: List[Dict] = []
+        self.id_map: Dict = {}  # 导入文件中的对话 id -> 新的对话 id
+        self.created_ids: List[int] = []
+        self.touched_ids: Set[int] = set()
+        self.messages = 0
+
+    async def add_message(self, line: int, conversation_id: int, record: Dict):
+        self.pending.append(message_row(line, conversation_id, record))
+        if len(self.pending) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        self.messages += await self.db.add_messages_bulk(batch)
+        self.touched_ids.update(message["conversation_id"] for message in batch)
+
+    async def add_conversation(self, line: int, record: Dict) -> int:
+        title = record.get("title", "新对话")
+        if not isinstance(title, str):
+            raise BulkImportError(line, "'title' must be a string")
+        conversation_id = await self.db.create_conversation(
+            title,
+            _optional_timestamp(line, record, "created_at"),
+            _optional_timestamp(line, record, "updated_at"),
+        )
+        self.created_ids.append(conversation_id)
+        if record.get("id") is not None:
+            self.id_map[record["id"]] = conversation_id
+
+        messages = record.get("messages") or []
+        if not isinstance(messages, list):
+            raise BulkImportError(line, "'messages' must be an array")
+        for message in messages:
+            if not isinstance(message, dict):
+                raise BulkImportError(line, "Each message must be a JSON object")
+            await self.add_message(line, conversation_id, message)
+        return conversation_id
+
+    async def import_records(self, records: AsyncIterator[Tuple[int, Dict]]):
+        """导入 conversation / message 记录，结束时写入剩余的消息"""
+        async for line, record in records:
+            record_type = record.get("type")
+            if record_type == "conversation":
+                await self.add_conversation(line, record)
+            elif record_type == "message":
+                source_id = record.get("conversation_id")
+                if source_id not in self.id_map:
+                    raise BulkImportError(line, f"Unknown conversation_id: {source_id!r}")
+                await self.add_message(line, self.id_map[source_id], record)
+            else:
+                raise BulkImportError(line, f"Unknown record type: {record_type!r}")
+        await self.flush()
+
+    async def import_messages(self, conversation_id: int, records: AsyncIterator[Tuple[int, Dict]]):
+        """把消息记录追加到已有的对话"""
+        async for line, record in records:
+            await self.add_message(line, conversation_id, record)
+        await self.flush()
+
+    def result(self) -> Dict:
+        return {"conversations": len(self.created_ids), "messages": self.messages}
@@ -0,0 +1,79 @@
+"""
+上下文组装：按 token 预算选取最新的消息作为提示词
+
+每条消息的 token 数在写入时计算一次，和对话内的前缀和一起存入 messages 表；
+组装上下文时用前缀和定位起点，只需一次索引查询，耗时与对话长度无关。
+分词器可插拔，通过注册表按名称选择，默认使用不依赖外部资源的估算分词器。
+"""
+import math
+import os
+import re
+from typing import Callable, Dict
+
+# 上下文的 token 预算（包含为回复预留的 max_tokens）
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", 4096))
+
+# 中日韩字符、连续的字母数字、其他非空白字符
+_CJK_CHARS = r"\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af"
+_TOKEN_RE = re.compile(rf"[{_CJK_CHARS}]|[^\W_{_CJK_CHARS}]+|\S")
+
+
+class Tokenizer:
+    """分词器基类：子类实现 count"""
+    name = "base"
+    message_overhead = 4  # 每条消息的角色标记等格式开销
+
+    def count(self, text: str) -> int:
+        raise NotImplementedError
+
+    def count_message(self, role: str, content: str) -> int:
+        """一条消息在提示词中占用的 token 数"""
+        return self.count(content) + self.message_overhead
+
+
+class SimpleTokenizer(Tokenizer):
+    """离线估算：每个中日韩字符、每个标点各计 1，字母数字串按每 4 个字符计 1"""
+    name = "simple"
+
+    def count(self, text: str) -> int:
+        total = 0
+        for match in _TOKEN_RE.finditer(text):
+            token = match.group()
+            total += math.ceil(len(token) / 4) if len(token) > 1 else 1
+        return total
+
+
+class TiktokenTokenizer(Tokenizer):
+    """使用 tiktoken 精确计数（需要安装 tiktoken 及其编码文件）"""
+    name = "tiktoken"
+
+    def __init__(self, encoding: str = "cl100k_base"):
+        import tiktoken
+        self.encoding = tiktoken.get_encoding(encoding)
+
+    def count(self, text: str) -> int:
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+
+# 分词器注册表：名称 -> 构造函数
+TOKENIZERS: Dict[str, Callable[..., Tokenizer]] = {
+    SimpleTokenizer.name: SimpleTokenizer,
+    TiktokenTokenizer.name: TiktokenTokenizer,
+}
+
+
+def register_tokenizer(name: str, factory: Callable[..., Tokenizer]):
+    """注册新的分词器"""
+    TOKENIZERS[name] = factory
+
+
+def create_tokenizer(name: str, **kwargs) -> Tokenizer:
+    """按名称创建分词器"""
+    if name not in TOKENIZERS:
+        raise ValueError(f"Unknown tokenizer: {name}")
+    return TOKENIZERS[name](**kwargs)
+
+
+def prompt_budget(max_tokens=None, budget: int = CONTEXT_TOKEN_BUDGET) -> int:
+    """历史消息可用的 token 数：总预算减去为回复预留的部分"""
+    return max(budget - (max_tokens or 0), 0)
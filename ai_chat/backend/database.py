@@ -1,18 +1,323 @@
+import asyncio
+import contextvars
+import os
 import sqlite3
 import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
-from typing import List, Dict, Optional
+from functools import partial, wraps
+from typing import Dict, Iterator, List, Optional
+
+from cache import LRUCache, MISSING
+from context import Tokenizer, SimpleTokenizer
+from metrics import DB_DURATION, DB_ERRORS
+import profiling
+from search import segment_text, build_match_query, highlight_snippet
+
+# 连接参数
+BUSY_TIMEOUT_MS = 5000          # 单次等待锁的最长时间
+LOCK_RETRY_ATTEMPTS = 5         # busy_timeout 耗尽后的重试次数
+LOCK_RETRY_BASE_DELAY = 0.05    # 重试退避的基础间隔（秒）
+
+# 每个连接建立时执行的 PRAGMA
+CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous = NORMAL",      # WAL 模式下 NORMAL 即可保证一致性
+    "PRAGMA cache_size = -20000",       # 约 20MB 页缓存
+    "PRAGMA mmap_size = 268435456",     # 256MB 内存映射读
+    "PRAGMA temp_store = MEMORY",
+    f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}",
+)
+
+# 数据迁移（建立全文索引、统计 token 数）时每批处理的行数
+BACKFILL_BATCH = 1000
+
+# IN (...) 查询每批的参数个数，低于 SQLite 的变量数上限
+BULK_ID_BATCH = 500
+
+# 导出时游标每次读取的行数
+EXPORT_BATCH_SIZE = 500
+
+
+def _backfill_search_index(cursor: sqlite3.Cursor):
+    """为已有的消息和对话标题建立全文索引"""
+    reader = cursor.connection.cursor()
+    reader.execute("SELECT id, content FROM messages")
+    for rows in iter(lambda: reader.fetchmany(BACKFILL_BATCH), []):
+        cursor.executemany(
+            "INSERT INTO messages_fts (rowid, content) VALUES (?, ?)",
+            [(row[0], segment_text(row[1])) for row in rows]
+        )
+    reader.execute("SELECT id, title FROM conversations")
+    for rows in iter(lambda: reader.fetchmany(BACKFILL_BATCH), []):
+        cursor.executemany(
+            "INSERT INTO conversations_fts (rowid, title) VALUES (?, ?)",
+            [(row[0], segment_text(row[1])) for row in rows]
+        )
+
+
+def _backfill_token_counts(cursor: sqlite3.Cursor):
+    """为已有消息计算 token 数，以及按写入顺序累计的对话内前缀和"""
+    reader = cursor.connection.cursor()
+    reader.execute(
+        "SELECT id, conversation_id, count_tokens(role, content) FROM messages "
+        "ORDER BY conversation_id, id"
+    )
+    current_id, total = None, 0
+    for rows in iter(lambda: reader.fetchmany(BACKFILL_BATCH), []):
+        updates = []
+        for message_id, conversation_id, count in rows:
+            if conversation_id != current_id:
+                current_id, total = conversation_id, 0
+            total += count
+            updates.append((count, total, message_id))
+        cursor.executemany(
+            "UPDATE messages SET token_count = ?, token_total = ? WHERE id = ?", updates
+        )
+
+
+# 数据库结构迁移：按顺序执行，PRAGMA user_version 记录已应用到的版本
+# 每一步可以是 SQL 语句，也可以是接收 cursor 的函数（用于需要 Python 处理的数据迁移）
+MIGRATIONS = (
+    # 1: 消息按对话分页、对话列表按更新时间排序所需的索引
+    (
+        "CREATE INDEX IF NOT EXISTS idx_messages_conversation_created "
+        "ON messages (conversation_id, created_at, id)",
+        "CREATE INDEX IF NOT EXISTS idx_conversations_updated "
+        "ON conversations (updated_at, id)",
+    ),
+    # 2: 按内容哈希存储上传文件，files 行是对 blob 的引用，触发器维护引用计数
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS blobs (
+            sha256 TEXT PRIMARY KEY,
+            file_path TEXT NOT NULL,
+            file_size INTEGER NOT NULL,
+            ref_count INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        "ALTER TABLE files ADD COLUMN sha256 TEXT REFERENCES blobs (sha256)",
+        "CREATE INDEX IF NOT EXISTS idx_files_sha256 ON files (sha256)",
+        "CREATE INDEX IF NOT EXISTS idx_blobs_unreferenced ON blobs (ref_count) WHERE ref_count <= 0",
+        '''
+        CREATE TRIGGER IF NOT EXISTS files_blob_ref_insert AFTER INSERT ON files
+        WHEN NEW.sha256 IS NOT NULL
+        BEGIN
+            UPDATE blobs SET ref_count = ref_count + 1 WHERE sha256 = NEW.sha256;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS files_blob_ref_delete AFTER DELETE ON files
+        WHEN OLD.sha256 IS NOT NULL
+        BEGIN
+            UPDATE blobs SET ref_count = ref_count - 1 WHERE sha256 = OLD.sha256;
+        END
+        ''',
+    ),
+    # 3: 可续传的分块上传会话及已接收的分块
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS upload_sessions (
+            id TEXT PRIMARY KEY,
+            original_filename TEXT NOT NULL,
+            file_size INTEGER NOT NULL,
+            chunk_size INTEGER NOT NULL,
+            temp_path TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS upload_chunks (
+            upload_id TEXT NOT NULL,
+            chunk_index INTEGER NOT NULL,
+            PRIMARY KEY (upload_id, chunk_index),
+            FOREIGN KEY (upload_id) REFERENCES upload_sessions (id)
+        ) WITHOUT ROWID
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_upload_sessions_created ON upload_sessions (created_at)",
+    ),
+    # 4: 消息内容和对话标题的全文索引，文本经 segment_text 切分后写入
+    (
+        # 消息不会修改，使用无内容表只保存索引
+        "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5 (content, content='')",
+        "CREATE VIRTUAL TABLE IF NOT EXISTS conversations_fts USING fts5 (title)",
+        _backfill_search_index,
+    ),
+    # 5: 增量同步按消息 id 做范围查询（索引隐含 rowid，即 (conversation_id, id)）
+    (
+        "CREATE INDEX IF NOT EXISTS idx_messages_conversation_id ON messages (conversation_id)",
+    ),
+    # 6: 每条消息的 token 数及对话内截至该消息的累计 token 数（按 id 顺序），用于按预算截取上下文
+    (
+        "ALTER TABLE messages ADD COLUMN token_count INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE messages ADD COLUMN token_total INTEGER NOT NULL DEFAULT 0",
+        _backfill_token_counts,
+        "CREATE INDEX IF NOT EXISTS idx_messages_conversation_tokens "
+        "ON messages (conversation_id, token_total)",
+    ),
+    # 7: 滚动摘要，概括对话开头到 end_message_id（含，按 id 顺序）的全部消息，每个对话只保留最新一条
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS summaries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_id INTEGER NOT NULL,
+            end_message_id INTEGER NOT NULL,
+            content TEXT NOT NULL,
+            token_count INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (conversation_id) REFERENCES conversations (id)
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_summaries_conversation "
+        "ON summaries (conversation_id, end_message_id)",
+    ),
+    # 8: 知识库：上传文件的文本抽取状态，以及切分后的文本块及其在全文中的字符偏移
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS file_ingestions (
+            file_id INTEGER PRIMARY KEY,
+            status TEXT NOT NULL,
+            char_count INTEGER,
+            chunk_count INTEGER,
+            error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (file_id) REFERENCES files (id)
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_file_ingestions_status ON file_ingestions (status)",
+        '''
+        CREATE TABLE IF NOT EXISTS file_chunks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            file_id INTEGER NOT NULL,
+            chunk_index INTEGER NOT NULL,
+            start_offset INTEGER NOT NULL,
+            end_offset INTEGER NOT NULL,
+            content TEXT NOT NULL,
+            FOREIGN KEY (file_id) REFERENCES files (id)
+        )
+        ''',
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_file_chunks_file ON file_chunks (file_id, chunk_index)",
+    ),
+)
+
+
+def _is_lock_error(error: sqlite3.OperationalError) -> bool:
+    message = str(error).lower()
+    return "locked" in message or "busy" in message
+
+
+def retry_on_locked(func):
+    """遇到 database is locked 时按指数退避重试；按方法名记录耗时（含重试）和出错次数，
+    请求正在被剖析时同时计入它的 SQL 耗时"""
+    operation = func.__name__
+    
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            for attempt in range(LOCK_RETRY_ATTEMPTS):
+                try:
+                    return func(*args, **kwargs)
+                except sqlite3.OperationalError as e:
+                    if not _is_lock_error(e) or attempt == LOCK_RETRY_ATTEMPTS - 1:
+                        raise
+                    time.sleep(LOCK_RETRY_BASE_DELAY * (2 ** attempt))
+        except Exception:
+            DB_ERRORS.inc(operation)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            DB_DURATION.observe(elapsed, operation)
+            profiling.record("sql", elapsed, operation)
+    return wrapper
+
 
 class Database:
-    def __init__(self, db_path: str = "chat.db"):
+    def __init__(self, db_path: str = "chat.db", tokenizer: Optional[Tokenizer] = None):
         self.db_path = db_path
+        # 写入消息时用于计算 token 数
+        self.tokenizer = tokenizer or SimpleTokenizer()
+        # 每个线程持有一个长连接，避免每次请求都重新打开数据库
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
         self.init_database()
     
+    def _connect(self) -> sqlite3.Connection:
+        """创建一个新连接并应用 PRAGMA"""
+        # isolation_level=None：读操作自动提交，写操作通过 _transaction 显式开启事务
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=BUSY_TIMEOUT_MS / 1000,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        # 批量写入和数据迁移时在 SQL 中直接生成全文索引文本、计算 token 数
+        conn.create_function("segment_text", 1, segment_text, deterministic=True)
+        conn.create_function("count_tokens", 2, self.tokenizer.count_message, deterministic=True)
+        return conn
+    
+    def _get_connection(self) -> sqlite3.Connection:
+        """获取当前线程的连接，不存在时创建"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+    
+    @contextmanager
+    def _transaction(self):
+        """写事务：BEGIN IMMEDIATE 提前拿写锁，避免读锁升级时的死锁"""
+        conn = self._get_connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn.cursor()
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
+    
+    def close(self):
+        """关闭所有线程持有的连接"""
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+    
+    @retry_on_locked
     def init_database(self):
         """初始化数据库表"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        conn = self._get_connection()
+        # WAL 模式是持久化的，写入数据库文件后对所有连接生效
+        conn.execute("PRAGMA journal_mode = WAL")
         
+        with self._transaction() as cursor:
+            self._create_tables(cursor)
+            self._migrate(cursor)
+    
+    def _migrate(self, cursor: sqlite3.Cursor):
+        """执行尚未应用的结构迁移"""
+        version = cursor.execute("PRAGMA user_version").fetchone()[0]
+        for target, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+            for statement in statements:
+                if callable(statement):
+                    statement(cursor)
+                else:
+                    cursor.execute(statement)
+            cursor.execute(f"PRAGMA user_version = {target}")
+    
+    def _create_tables(self, cursor: sqlite3.Cursor):
+        """创建基础表结构"""
         # 创建对话表
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS conversations (
@@ -48,35 +353,48 @@ class Database:
                 FOREIGN KEY (conversation_id) REFERENCES conversations (id)
             )
         ''')
-        
-        conn.commit()
-        conn.close()
     
-    def create_conversation(self, title: str = "新对话") -> int:
-        """创建新对话"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            "INSERT INTO conversations (title) VALUES (?)",
-            (title,)
-        )
-        conversation_id = cursor.lastrowid
+    @retry_on_locked
+    def create_conversation(self, title: str = "新对话", created_at: Optional[str] = None,
+                            updated_at: Optional[str] = None) -> int:
+        """创建新对话；导入时可指定原有的创建和更新时间"""
+        with self._transaction() as cursor:
+            cursor.execute('''
+                INSERT INTO conversations (title, created_at, updated_at)
+                VALUES (?, COALESCE(?, CURRENT_TIMESTAMP), COALESCE(?, ?, CURRENT_TIMESTAMP))
+            ''', (title, created_at, updated_at, created_at))
+            conversation_id = cursor.lastrowid
+            cursor.execute(
+                "INSERT INTO conversations_fts (rowid, title) VALUES (?, ?)",
+                (conversation_id, segment_text(title))
+            )
         
-        conn.commit()
-        conn.close()
         return conversation_id
     
-    def get_conversations(self) -> List[Dict]:
-        """获取所有对话列表"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    @retry_on_locked
+    def get_conversations(self, before_id: Optional[int] = None,
+                          limit: Optional[int] = None,
+                          updated_since: Optional[str] = None) -> List[Dict]:
+        """获取对话列表，按更新时间倒序；指定 before_id 时返回该对话之后的一页，
+        指定 updated_since 时只返回在该时间及之后更新过的对话"""
+        cursor = self._get_connection().cursor()
         
-        cursor.execute('''
-            SELECT id, title, created_at, updated_at 
-            FROM conversations 
-            ORDER BY updated_at DESC
-        ''')
+        query = "SELECT id, title, created_at, updated_at FROM conversations"
+        conditions = []
+        params: list = []
+        if before_id is not None:
+            conditions.append("(updated_at, id) < (SELECT updated_at, id FROM conversations WHERE id = ?)")
+            params.append(before_id)
+        if updated_since is not None:
+            # 时间戳精度为秒，用 >= 避免漏掉同一秒内的更新
+            conditions.append("updated_at >= ?")
+            params.append(updated_since)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY updated_at DESC, id DESC LIMIT ?"
+        params.append(limit if limit is not None else -1)
+        
+        cursor.execute(query, params)
         
         conversations = []
         for row in cursor.fetchall():
@@ -87,13 +405,12 @@ class Database:
                 "updated_at": row[3]
             })
         
-        conn.close()
         return conversations
     
+    @retry_on_locked
     def get_conversation(self, conversation_id: int) -> Optional[Dict]:
         """获取特定对话信息"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        cursor = self._get_connection().cursor()
         
         cursor.execute(
             "SELECT id, title, created_at, updated_at FROM conversations WHERE id = ?",
@@ -111,82 +428,968 @@ class Database:
         else:
             conversation = None
         
-        conn.close()
         return conversation
     
+    @retry_on_locked
+    def get_conversation_stats(self, conversation_id: int) -> Optional[Dict]:
+        """获取对话信息及最新消息的 id，用于生成 ETag，不读取消息内容"""
+        cursor = self._get_connection().cursor()
+        
+        # 最新消息 id 经 (conversation_id) 索引直接定位，耗时与对话长度无关（COUNT(*) 需要扫描）
+        cursor.execute('''
+            SELECT id, title, created_at, updated_at,
+                   (SELECT MAX(id) FROM messages WHERE conversation_id = conversations.id)
+            FROM conversations WHERE id = ?
+        ''', (conversation_id,))
+        
+        row = cursor.fetchone()
+        if not row:
+            return None
+        return {
+            "id": row[0],
+            "title": row[1],
+            "created_at": row[2],
+            "updated_at": row[3],
+            "last_message_id": row[4]
+        }
+    
+    @retry_on_locked
     def update_conversation_title(self, conversation_id: int, title: str) -> bool:
         """更新对话标题"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            "UPDATE conversations SET title = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
-            (title, conversation_id)
-        )
+        with self._transaction() as cursor:
+            cursor.execute(
+                "UPDATE conversations SET title = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                (title, conversation_id)
+            )
+            success = cursor.rowcount > 0
+            if success:
+                cursor.execute("DELETE FROM conversations_fts WHERE rowid = ?", (conversation_id,))
+                cursor.execute(
+                    "INSERT INTO conversations_fts (rowid, title) VALUES (?, ?)",
+                    (conversation_id, segment_text(title))
+                )
         
-        success = cursor.rowcount > 0
-        conn.commit()
-        conn.close()
         return success
     
-    def add_message(self, conversation_id: int, role: str, content: str) -> int:
-        """添加消息到对话"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    @retry_on_locked
+    def add_message(self, conversation_id: int, role: str, content: str) -> Optional[Dict]:
+        """添加消息到对话，返回新消息；对话不存在时返回 None"""
+        token_count = self.tokenizer.count_message(role, content)
+        with self._transaction() as cursor:
+            # 更新对话的更新时间，同时确认对话存在
+            cursor.execute(
+                "UPDATE conversations SET updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                (conversation_id,)
+            )
+            if cursor.rowcount == 0:
+                return None
+            
+            # 添加消息，token 数只在写入时计算一次，累计值接在对话最后一条消息之后
+            cursor.execute('''
+                INSERT INTO messages (conversation_id, role, content, token_count, token_total)
+                VALUES (?, ?, ?, ?, ? + COALESCE((
+                    SELECT token_total FROM messages WHERE conversation_id = ? ORDER BY id DESC LIMIT 1
+                ), 0))
+                RETURNING id, role, content, created_at
+            ''', (conversation_id, role, content, token_count, token_count, conversation_id))
+            row = cursor.fetchone()
+            
+            # 同步全文索引
+            cursor.execute(
+                "INSERT INTO messages_fts (rowid, content) VALUES (?, ?)",
+                (row[0], segment_text(content))
+            )
         
-        # 添加消息
-        cursor.execute(
-            "INSERT INTO messages (conversation_id, role, content) VALUES (?, ?, ?)",
-            (conversation_id, role, content)
-        )
-        message_id = cursor.lastrowid
+        return {
+            "id": row[0],
+            "role": row[1],
+            "content": row[2],
+            "created_at": row[3]
+        }
+    
+    @retry_on_locked
+    def add_messages_bulk(self, messages: List[Dict]) -> int:
+        """在一个事务内批量添加消息（可属于不同对话），返回写入条数
+        
+        每条消息包含 conversation_id、role、content，可选 created_at（缺省为当前时间）。
+        任一对话不存在时抛出 ValueError，整批不写入。
+        """
+        if not messages:
+            return 0
+        conversation_ids = sorted({message["conversation_id"] for message in messages})
+        # token 数在拿写锁之前算好
+        rows = []
+        for message in messages:
+            token_count = self.tokenizer.count_message(message["role"], message["content"])
+            rows.append((message["conversation_id"], message["role"], message["content"],
+                         message.get("created_at"), token_count, token_count,
+                         message["conversation_id"]))
+        
+        with self._transaction() as cursor:
+            found = set()
+            for start in range(0, len(conversation_ids), BULK_ID_BATCH):
+                batch = conversation_ids[start:start + BULK_ID_BATCH]
+                cursor.execute(
+                    f"SELECT id FROM conversations WHERE id IN ({', '.join('?' * len(batch))})",
+                    batch
+                )
+                found.update(row[0] for row in cursor.fetchall())
+            missing = [cid for cid in conversation_ids if cid not in found]
+            if missing:
+                raise ValueError(f"Conversation not found: {missing[0]}")
+            
+            # 写锁期间没有其他写入者，id 大于当前最大值的行就是本批写入的消息
+            cursor.execute("SELECT COALESCE(MAX(id), 0) FROM messages")
+            last_id = cursor.fetchone()[0]
+            
+            cursor.executemany('''
+                INSERT INTO messages (conversation_id, role, content, created_at, token_count, token_total)
+                VALUES (?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP), ?, ? + COALESCE((
+                    SELECT token_total FROM messages WHERE conversation_id = ? ORDER BY id DESC LIMIT 1
+                ), 0))
+            ''', rows)
+            count = cursor.rowcount
+            
+            cursor.execute(
+                "INSERT INTO messages_fts (rowid, content) "
+                "SELECT id, segment_text(content) FROM messages WHERE id > ?",
+                (last_id,)
+            )
+            
+            # 对话的更新时间取最新一条消息的时间，导入历史消息不会打乱对话的排序
+            cursor.executemany('''
+                UPDATE conversations SET updated_at = MAX(updated_at, (
+                    SELECT MAX(created_at) FROM messages WHERE conversation_id = ? AND id > ?
+                )) WHERE id = ?
+            ''', [(cid, last_id, cid) for cid in conversation_ids])
+        
+        return count
+    
+    @retry_on_locked
+    def get_messages(self, conversation_id: int, before_id: Optional[int] = None,
+                     limit: Optional[int] = None, since_id: Optional[int] = None) -> List[Dict]:
+        """获取对话的消息，按时间正序；指定 limit 时只返回 before_id 之前最新的一页，
+        指定 since_id 时按 id 顺序返回该消息之后新增的消息（增量同步）"""
+        cursor = self._get_connection().cursor()
+        
+        if since_id is not None:
+            cursor.execute('''
+                SELECT id, role, content, created_at 
+                FROM messages 
+                WHERE conversation_id = ? AND id > ?
+                ORDER BY id ASC
+                LIMIT ?
+            ''', (conversation_id, since_id, limit if limit is not None else -1))
+            rows = cursor.fetchall()
+        else:
+            query = '''
+                SELECT id, role, content, created_at 
+                FROM messages 
+                WHERE conversation_id = ? 
+            '''
+            params: list = [conversation_id]
+            if before_id is not None:
+                query += " AND (created_at, id) < (SELECT created_at, id FROM messages WHERE id = ?)"
+                params.append(before_id)
+            
+            # 分页时倒序取最新的 limit 条，再翻转成正序
+            paginated = before_id is not None or limit is not None
+            if paginated:
+                query += " ORDER BY created_at DESC, id DESC LIMIT ?"
+                params.append(limit if limit is not None else -1)
+            else:
+                query += " ORDER BY created_at ASC, id ASC"
+            
+            cursor.execute(query, params)
+            rows = cursor.fetchall()
+            if paginated:
+                rows.reverse()
+        
+        messages = []
+        for row in rows:
+            messages.append({
+                "id": row[0],
+                "role": row[1],
+                "content": row[2],
+                "created_at": row[3]
+            })
+        
+        return messages
+    
+    @retry_on_locked
+    def get_context_messages(self, conversation_id: int, budget: int, after_id: int = 0) -> List[Dict]:
+        """按写入顺序返回对话最新的一段消息，其 token 总数不超过 budget；最新一条消息总会包含在内。
+        指定 after_id 时只在该消息之后选取（之前的部分已由摘要概括）
+        
+        由前缀和定位起点：token_total 首次达到 (总数 - budget) 的消息之后的部分恰好放得下，
+        查询走 (conversation_id, token_total) 索引，与对话长度无关。
+        """
+        cursor = self._get_connection().cursor()
         
-        # 更新对话的更新时间
         cursor.execute(
-            "UPDATE conversations SET updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+            "SELECT id, token_total FROM messages WHERE conversation_id = ? ORDER BY id DESC LIMIT 1",
             (conversation_id,)
         )
+        last = cursor.fetchone()
+        if last is None or last[0] <= after_id:
+            return []
+        last_id, total = last
+        
+        start_after = after_id
+        if total > budget:
+            cursor.execute('''
+                SELECT id FROM messages
+                WHERE conversation_id = ? AND token_total >= ?
+                ORDER BY token_total, id LIMIT 1
+            ''', (conversation_id, total - budget))
+            start_after = max(min(cursor.fetchone()[0], last_id - 1), after_id)
+        
+        # 以 last_id 为上界，查询期间新写入的消息不会超出预算
+        cursor.execute('''
+            SELECT id, role, content, created_at
+            FROM messages
+            WHERE conversation_id = ? AND id > ? AND id <= ?
+            ORDER BY id
+        ''', (conversation_id, start_after, last_id))
+        
+        return [
+            {
+                "id": row[0],
+                "role": row[1],
+                "content": row[2],
+                "created_at": row[3]
+            }
+            for row in cursor.fetchall()
+        ]
+    
+    @retry_on_locked
+    def add_summary(self, conversation_id: int, end_message_id: int, content: str) -> Dict:
+        """保存对话的最新摘要，概括到 end_message_id 为止的全部消息；被取代的旧摘要一并删除"""
+        token_count = self.tokenizer.count_message("system", content)
+        with self._transaction() as cursor:
+            cursor.execute(
+                "DELETE FROM summaries WHERE conversation_id = ? AND end_message_id <= ?",
+                (conversation_id, end_message_id)
+            )
+            cursor.execute('''
+                INSERT INTO summaries (conversation_id, end_message_id, content, token_count)
+                VALUES (?, ?, ?, ?)
+                RETURNING id, end_message_id, content, token_count, created_at
+            ''', (conversation_id, end_message_id, content, token_count))
+            row = cursor.fetchone()
         
-        conn.commit()
-        conn.close()
-        return message_id
+        return {
+            "id": row[0],
+            "end_message_id": row[1],
+            "content": row[2],
+            "token_count": row[3],
+            "created_at": row[4]
+        }
     
-    def get_messages(self, conversation_id: int) -> List[Dict]:
-        """获取对话的所有消息"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    @retry_on_locked
+    def get_summary(self, conversation_id: int) -> Optional[Dict]:
+        """获取对话最新的摘要"""
+        cursor = self._get_connection().cursor()
         
         cursor.execute('''
-            SELECT id, role, content, created_at 
-            FROM messages 
-            WHERE conversation_id = ? 
-            ORDER BY created_at ASC
+            SELECT id, end_message_id, content, token_count, created_at
+            FROM summaries
+            WHERE conversation_id = ?
+            ORDER BY end_message_id DESC, id DESC
+            LIMIT 1
         ''', (conversation_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
         
-        messages = []
-        for row in cursor.fetchall():
-            messages.append({
+        return {
+            "id": row[0],
+            "end_message_id": row[1],
+            "content": row[2],
+            "token_count": row[3],
+            "created_at": row[4]
+        }
+    
+    @retry_on_locked
+    def get_messages_to_summarize(self, conversation_id: int, after_id: int, min_tokens: int,
+                                  keep_tokens: int, max_tokens: int) -> List[Dict]:
+        """返回下一段需要压缩的消息（按 id 顺序）
+
+        after_id 之后未压缩的 token 数超过 min_tokens 时，从 after_id 之后取累计不超过 max_tokens 的消息，
+        最新的 keep_tokens 以内的消息保留原文；不需要压缩时返回空列表。
+        """
+        cursor = self._get_connection().cursor()
+        
+        cursor.execute(
+            "SELECT token_total FROM messages WHERE conversation_id = ? ORDER BY id DESC LIMIT 1",
+            (conversation_id,)
+        )
+        last = cursor.fetchone()
+        if last is None:
+            return []
+        total = last[0]
+        
+        base = 0
+        if after_id:
+            cursor.execute("SELECT token_total FROM messages WHERE id = ?", (after_id,))
+            row = cursor.fetchone()
+            base = row[0] if row else 0
+        if total - base <= min_tokens:
+            return []
+        
+        # 前缀和落在 (base, limit] 之间的消息即本段；单条消息超过 max_tokens 时单独成段
+        limit = total - keep_tokens
+        cursor.execute('''
+            SELECT id, role, content, created_at, token_total
+            FROM messages
+            WHERE conversation_id = ? AND token_total > ? AND token_total <= ? AND id > ?
+            ORDER BY token_total, id
+        ''', (conversation_id, base, min(limit, base + max_tokens), after_id))
+        rows = cursor.fetchall()
+        if not rows:
+            cursor.execute('''
+                SELECT id, role, content, created_at, token_total
+                FROM messages
+                WHERE conversation_id = ? AND token_total > ? AND token_total <= ? AND id > ?
+                ORDER BY token_total, id
+                LIMIT 1
+            ''', (conversation_id, base, limit, after_id))
+            rows = cursor.fetchall()
+        
+        return [
+            {
                 "id": row[0],
                 "role": row[1],
                 "content": row[2],
                 "created_at": row[3]
+            }
+            for row in rows
+        ]
+    
+    def iter_export(self, batch_size: int = EXPORT_BATCH_SIZE) -> Iterator[Dict]:
+        """按对话 id 顺序逐条产出导出记录：每个对话一条 conversation 记录，随后是其全部 message 记录
+        
+        使用独立连接并在一个读事务中完成，导出内容是同一时刻的一致快照；
+        结果由游标分批读取，内存占用与数据量无关。生成器可以在不同线程中推进。
+        """
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN")
+            cursor = conn.execute('''
+                SELECT c.id, c.title, c.created_at, c.updated_at,
+                       m.id, m.role, m.content, m.created_at
+                FROM conversations c
+                LEFT JOIN messages m ON m.conversation_id = c.id
+                ORDER BY c.id, m.created_at, m.id
+            ''')
+            current_id = None
+            for rows in iter(lambda: cursor.fetchmany(batch_size), []):
+                for row in rows:
+                    if row[0] != current_id:
+                        current_id = row[0]
+                        yield {
+                            "type": "conversation",
+                            "id": row[0],
+                            "title": row[1],
+                            "created_at": row[2],
+                            "updated_at": row[3]
+                        }
+                    if row[4] is not None:
+                        yield {
+                            "type": "message",
+                            "conversation_id": row[0],
+                            "id": row[4],
+                            "role": row[5],
+                            "content": row[6],
+                            "created_at": row[7]
+                        }
+        finally:
+            conn.close()
+    
+    @retry_on_locked
+    def search(self, query: str, limit: int = 20, offset: int = 0) -> List[Dict]:
+        """全文检索对话标题和消息内容，按相关度排序，返回带高亮片段的结果"""
+        match_query = build_match_query(query)
+        if match_query is None:
+            return []
+        
+        cursor = self._get_connection().cursor()
+        cursor.execute('''
+            SELECT 'conversation', c.id, c.title, NULL, NULL, c.title, c.updated_at, f.rank AS score
+            FROM conversations_fts f JOIN conversations c ON c.id = f.rowid
+            WHERE conversations_fts MATCH ?
+            UNION ALL
+            SELECT 'message', m.conversation_id, c.title, m.id, m.role, m.content, m.created_at, f.rank AS score
+            FROM messages_fts f
+            JOIN messages m ON m.id = f.rowid
+            JOIN conversations c ON c.id = m.conversation_id
+            WHERE messages_fts MATCH ?
+            ORDER BY score
+            LIMIT ? OFFSET ?
+        ''', (match_query, match_query, limit, offset))
+        
+        results = []
+        for row in cursor.fetchall():
+            results.append({
+                "type": row[0],
+                "conversation_id": row[1],
+                "conversation_title": row[2],
+                "message_id": row[3],
+                "role": row[4],
+                "snippet": highlight_snippet(row[5], query),
+                "created_at": row[6]
             })
         
-        conn.close()
-        return messages
+        return results
     
+    @retry_on_locked
     def save_file(self, filename: str, original_filename: str, file_path: str, 
-                  file_size: int, conversation_id: Optional[int] = None) -> int:
-        """保存文件信息"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+                  file_size: int, conversation_id: Optional[int] = None,
+                  sha256: Optional[str] = None) -> int:
+        """保存文件信息；指定 sha256 时登记内容 blob 并增加其引用计数"""
+        with self._transaction() as cursor:
+            if sha256 is not None:
+                cursor.execute('''
+                    INSERT INTO blobs (sha256, file_path, file_size) VALUES (?, ?, ?)
+                    ON CONFLICT (sha256) DO NOTHING
+                ''', (sha256, file_path, file_size))
+            cursor.execute('''
+                INSERT INTO files (filename, original_filename, file_path, file_size, conversation_id, sha256) 
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (filename, original_filename, file_path, file_size, conversation_id, sha256))
+            file_id = cursor.lastrowid
+        
+        return file_id
+    
+    @retry_on_locked
+    def get_file(self, file_id: int) -> Optional[Dict]:
+        """获取文件信息"""
+        cursor = self._get_connection().cursor()
+        
+        cursor.execute('''
+            SELECT id, original_filename, file_path, file_size, sha256
+            FROM files WHERE id = ?
+        ''', (file_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        
+        return {
+            "id": row[0],
+            "original_filename": row[1],
+            "file_path": row[2],
+            "file_size": row[3],
+            "sha256": row[4]
+        }
+    
+    @retry_on_locked
+    def delete_file(self, file_id: int) -> bool:
+        """删除文件引用及其知识库文本块，blob 的引用计数由触发器减少"""
+        with self._transaction() as cursor:
+            cursor.execute("DELETE FROM file_chunks WHERE file_id = ?", (file_id,))
+            cursor.execute("DELETE FROM file_ingestions WHERE file_id = ?", (file_id,))
+            cursor.execute("DELETE FROM files WHERE id = ?", (file_id,))
+            success = cursor.rowcount > 0
+        
+        return success
+    
+    @retry_on_locked
+    def delete_unreferenced_blobs(self) -> List[str]:
+        """回收引用计数为 0 的 blob，返回被删除的文件路径"""
+        # 在写事务内删除磁盘文件：并发上传登记同一内容时会等待本事务结束，
+        # 之后发现文件不存在会重新放置，不会引用到已删除的文件
+        with self._transaction() as cursor:
+            cursor.execute("SELECT sha256, file_path FROM blobs WHERE ref_count <= 0")
+            rows = cursor.fetchall()
+            for sha256, file_path in rows:
+                cursor.execute("DELETE FROM blobs WHERE sha256 = ?", (sha256,))
+                try:
+                    os.remove(file_path)
+                except FileNotFoundError:
+                    pass
+        
+        return [row[1] for row in rows]
+    
+    @retry_on_locked
+    def set_ingestion_status(self, file_id: int, status: str, error: Optional[str] = None) -> bool:
+        """更新文件的知识库处理状态；文件已被删除时返回 False"""
+        with self._transaction() as cursor:
+            cursor.execute('''
+                INSERT INTO file_ingestions (file_id, status, error)
+                SELECT id, ?, ? FROM files WHERE id = ?
+                ON CONFLICT (file_id) DO UPDATE SET
+                    status = excluded.status,
+                    error = excluded.error,
+                    updated_at = CURRENT_TIMESTAMP
+            ''', (status, error, file_id))
+            success = cursor.rowcount > 0
+        
+        return success
+    
+    @retry_on_locked
+    def save_file_chunks(self, file_id: int, char_count: int, chunks: List[tuple]) -> bool:
+        """替换文件的全部文本块（(起始偏移, 结束偏移, 内容) 列表）并标记处理完成；文件已被删除时返回 False"""
+        with self._transaction() as cursor:
+            cursor.execute("SELECT 1 FROM files WHERE id = ?", (file_id,))
+            if cursor.fetchone() is None:
+                return False
+            cursor.execute("DELETE FROM file_chunks WHERE file_id = ?", (file_id,))
+            cursor.executemany('''
+                INSERT INTO file_chunks (file_id, chunk_index, start_offset, end_offset, content)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [(file_id, index, start, end, content)
+                  for index, (start, end, content) in enumerate(chunks)])
+            cursor.execute('''
+                UPDATE file_ingestions
+                SET status = 'done', char_count = ?, chunk_count = ?, error = NULL,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE file_id = ?
+            ''', (char_count, len(chunks), file_id))
+        
+        return True
+    
+    @retry_on_locked
+    def copy_file_chunks(self, file_id: int, sha256: str) -> Optional[int]:
+        """内容相同的文件已处理完成时直接复制其文本块，返回块数；没有可复用的结果时返回 None"""
+        with self._transaction() as cursor:
+            cursor.execute('''
+                SELECT i.file_id, i.char_count, i.chunk_count
+                FROM files f JOIN file_ingestions i ON i.file_id = f.id
+                WHERE f.sha256 = ? AND f.id != ? AND i.status = 'done'
+                LIMIT 1
+            ''', (sha256, file_id))
+            source = cursor.fetchone()
+            if source is None:
+                return None
+            cursor.execute("DELETE FROM file_chunks WHERE file_id = ?", (file_id,))
+            cursor.execute('''
+                INSERT INTO file_chunks (file_id, chunk_index, start_offset, end_offset, content)
+                SELECT ?, chunk_index, start_offset, end_offset, content
+                FROM file_chunks WHERE file_id = ? ORDER BY chunk_index
+            ''', (file_id, source[0]))
+            cursor.execute('''
+                UPDATE file_ingestions
+                SET status = 'done', char_count = ?, chunk_count = ?, error = NULL,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE file_id = ?
+            ''', (source[1], source[2], file_id))
+        
+        return source[2]
+    
+    @retry_on_locked
+    def get_ingestion(self, file_id: int) -> Optional[Dict]:
+        """获取文件的知识库处理状态"""
+        cursor = self._get_connection().cursor()
         
         cursor.execute('''
-            INSERT INTO files (filename, original_filename, file_path, file_size, conversation_id) 
-            VALUES (?, ?, ?, ?, ?)
-        ''', (filename, original_filename, file_path, file_size, conversation_id))
-        
-        file_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        return file_id
\ No newline at end of file
+            SELECT file_id, status, char_count, chunk_count, error, created_at, updated_at
+            FROM file_ingestions WHERE file_id = ?
+        ''', (file_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        
+        return {
+            "file_id": row[0],
+            "status": row[1],
+            "char_count": row[2],
+            "chunk_count": row[3],
+            "error": row[4],
+            "created_at": row[5],
+            "updated_at": row[6]
+        }
+    
+    @retry_on_locked
+    def get_unfinished_ingestions(self) -> List[int]:
+        """尚未处理完成的文件（服务重启后重新排队）"""
+        cursor = self._get_connection().cursor()
+        cursor.execute(
+            "SELECT file_id FROM file_ingestions WHERE status NOT IN ('done', 'failed') ORDER BY file_id"
+        )
+        return [row[0] for row in cursor.fetchall()]
+    
+    @retry_on_locked
+    def get_ingestion_counts(self) -> Dict[str, int]:
+        """各处理状态的文件数"""
+        cursor = self._get_connection().cursor()
+        cursor.execute("SELECT status, COUNT(*) FROM file_ingestions GROUP BY status")
+        return {row[0]: row[1] for row in cursor.fetchall()}
+    
+    @retry_on_locked
+    def get_file_chunks(self, file_id: int, limit: int = 50, offset: int = 0) -> List[Dict]:
+        """按顺序获取文件的文本块"""
+        cursor = self._get_connection().cursor()
+        
+        cursor.execute('''
+            SELECT id, chunk_index, start_offset, end_offset, content
+            FROM file_chunks
+            WHERE file_id = ? AND chunk_index >= ?
+            ORDER BY chunk_index
+            LIMIT ?
+        ''', (file_id, offset, limit))
+        
+        return [
+            {
+                "id": row[0],
+                "chunk_index": row[1],
+                "start_offset": row[2],
+                "end_offset": row[3],
+                "content": row[4]
+            }
+            for row in cursor.fetchall()
+        ]
+    
+    @retry_on_locked
+    def get_chunks_after(self, after_id: int, limit: int = 500) -> List[tuple]:
+        """按 id 顺序获取 id 大于 after_id 的文本块 (id, 内容)，供向量索引增量追加"""
+        cursor = self._get_connection().cursor()
+        cursor.execute(
+            "SELECT id, content FROM file_chunks WHERE id > ? ORDER BY id LIMIT ?",
+            (after_id, limit)
+        )
+        return cursor.fetchall()
+    
+    @retry_on_locked
+    def get_chunks_by_ids(self, chunk_ids: List[int]) -> Dict[int, Dict]:
+        """按 id 获取文本块及其文件名；已删除的块不在结果中"""
+        cursor = self._get_connection().cursor()
+        chunks = {}
+        
+        for i in range(0, len(chunk_ids), BULK_ID_BATCH):
+            batch = chunk_ids[i:i + BULK_ID_BATCH]
+            placeholders = ",".join("?" * len(batch))
+            cursor.execute(f'''
+                SELECT c.id, c.file_id, f.original_filename, c.chunk_index,
+                       c.start_offset, c.end_offset, c.content
+                FROM file_chunks c JOIN files f ON f.id = c.file_id
+                WHERE c.id IN ({placeholders})
+            ''', batch)
+            for row in cursor.fetchall():
+                chunks[row[0]] = {
+                    "chunk_id": row[0],
+                    "file_id": row[1],
+                    "filename": row[2],
+                    "chunk_index": row[3],
+                    "start_offset": row[4],
+                    "end_offset": row[5],
+                    "content": row[6]
+                }
+        
+        return chunks
+    
+    @retry_on_locked
+    def create_upload_session(self, upload_id: str, original_filename: str, file_size: int,
+                              chunk_size: int, temp_path: str) -> Dict:
+        """创建分块上传会话"""
+        with self._transaction() as cursor:
+            cursor.execute('''
+                INSERT INTO upload_sessions (id, original_filename, file_size, chunk_size, temp_path)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (upload_id, original_filename, file_size, chunk_size, temp_path))
+        
+        return self.get_upload_session(upload_id)
+    
+    @retry_on_locked
+    def get_upload_session(self, upload_id: str) -> Optional[Dict]:
+        """获取上传会话及已接收的分块序号"""
+        cursor = self._get_connection().cursor()
+        
+        cursor.execute(
+            "SELECT id, original_filename, file_size, chunk_size, temp_path, created_at "
+            "FROM upload_sessions WHERE id = ?",
+            (upload_id,)
+        )
+        row = cursor.fetchone()
+        if not row:
+            return None
+        
+        cursor.execute(
+            "SELECT chunk_index FROM upload_chunks WHERE upload_id = ? ORDER BY chunk_index",
+            (upload_id,)
+        )
+        file_size, chunk_size = row[2], row[3]
+        return {
+            "id": row[0],
+            "filename": row[1],
+            "file_size": file_size,
+            "chunk_size": chunk_size,
+            "total_chunks": (file_size + chunk_size - 1) // chunk_size,
+            "received_chunks": [r[0] for r in cursor.fetchall()],
+            "temp_path": row[4],
+            "created_at": row[5]
+        }
+    
+    @retry_on_locked
+    def mark_chunk_received(self, upload_id: str, chunk_index: int) -> bool:
+        """记录分块已写入；会话不存在时返回 False"""
+        with self._transaction() as cursor:
+            cursor.execute("SELECT 1 FROM upload_sessions WHERE id = ?", (upload_id,))
+            if not cursor.fetchone():
+                return False
+            cursor.execute(
+                "INSERT OR IGNORE INTO upload_chunks (upload_id, chunk_index) VALUES (?, ?)",
+                (upload_id, chunk_index)
+            )
+        
+        return True
+    
+    @retry_on_locked
+    def delete_upload_session(self, upload_id: str) -> Optional[str]:
+        """删除上传会话，返回其临时文件路径；会话不存在时返回 None"""
+        with self._transaction() as cursor:
+            cursor.execute(
+                "DELETE FROM upload_sessions WHERE id = ? RETURNING temp_path",
+                (upload_id,)
+            )
+            row = cursor.fetchone()
+            cursor.execute("DELETE FROM upload_chunks WHERE upload_id = ?", (upload_id,))
+        
+        return row[0] if row else None
+    
+    @retry_on_locked
+    def delete_expired_upload_sessions(self, max_age_seconds: int) -> List[str]:
+        """删除超过 max_age_seconds 未完成的上传会话，返回其临时文件路径"""
+        with self._transaction() as cursor:
+            cursor.execute(
+                "DELETE FROM upload_sessions WHERE created_at < datetime('now', ?) "
+                "RETURNING id, temp_path",
+                (f"-{int(max_age_seconds)} seconds",)
+            )
+            rows = cursor.fetchall()
+            cursor.executemany(
+                "DELETE FROM upload_chunks WHERE upload_id = ?",
+                [(row[0],) for row in rows]
+            )
+        
+        return [row[1] for row in rows]
+
+
+# 查询缓存配置：多进程部署时其他进程的写入不会使本进程缓存失效，过期时间限制了最长的不一致窗口
+CACHE_SIZE = 1024           # 最多缓存的对话数
+CACHE_TTL = 10.0            # 缓存条目过期时间（秒）
+MESSAGE_TAIL_SIZE = 100     # 每个对话缓存的最新消息条数
+
+
+class AsyncDatabase:
+    """Database 的异步封装：在有界线程池中执行查询，不阻塞事件循环；对话和最新消息走 LRU 缓存"""
+    
+    def __init__(self, database: Database, max_workers: int = 8,
+                 cache_size: int = CACHE_SIZE, cache_ttl: Optional[float] = CACHE_TTL):
+        self.database = database
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="db")
+        
+        self.conversation_cache = LRUCache(cache_size, cache_ttl)      # id -> 对话
+        self.conversation_stats_cache = LRUCache(cache_size, cache_ttl)  # id -> 对话及消息条数
+        self.conversation_list_cache = LRUCache(16, cache_ttl)         # 查询参数 -> 对话列表
+        self.message_cache = LRUCache(cache_size, cache_ttl)           # id -> (最新消息, 是否为全部消息)
+        # 每次写入递增；查询期间发生过写入时不回填缓存，避免把旧数据写回
+        self._write_seq = 0
+    
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        call = partial(func, *args, **kwargs)
+        if profiling.active():
+            # run_in_executor 不传递 contextvars，剖析中的请求需要在线程池里看到自己的记录
+            call = partial(contextvars.copy_context().run, call)
+        return await loop.run_in_executor(self._executor, call)
+    
+    def _invalidate_conversation(self, conversation_id: Optional[int] = None):
+        self._write_seq += 1
+        self.conversation_list_cache.clear()
+        if conversation_id is not None:
+            self.conversation_cache.pop(conversation_id)
+            self.conversation_stats_cache.pop(conversation_id)
+    
+    async def create_conversation(self, title: str = "新对话", created_at: Optional[str] = None,
+                                  updated_at: Optional[str] = None) -> int:
+        conversation_id = await self._run(self.database.create_conversation, title,
+                                          created_at, updated_at)
+        self._invalidate_conversation()
+        return conversation_id
+    
+    async def get_conversations(self, before_id: Optional[int] = None,
+                                limit: Optional[int] = None,
+                                updated_since: Optional[str] = None) -> List[Dict]:
+        key = (before_id, limit, updated_since)
+        cached = self.conversation_list_cache.get(key)
+        if cached is not MISSING:
+            return [dict(conversation) for conversation in cached]
+        
+        write_seq = self._write_seq
+        conversations = await self._run(self.database.get_conversations, before_id, limit, updated_since)
+        if write_seq == self._write_seq:
+            self.conversation_list_cache.set(key, [dict(conversation) for conversation in conversations])
+        return conversations
+    
+    async def get_conversation(self, conversation_id: int) -> Optional[Dict]:
+        cached = self.conversation_cache.get(conversation_id)
+        if cached is not MISSING:
+            return dict(cached)
+        
+        write_seq = self._write_seq
+        conversation = await self._run(self.database.get_conversation, conversation_id)
+        if conversation and write_seq == self._write_seq:
+            self.conversation_cache.set(conversation_id, dict(conversation))
+        return conversation
+    
+    async def get_conversation_stats(self, conversation_id: int) -> Optional[Dict]:
+        cached = self.conversation_stats_cache.get(conversation_id)
+        if cached is not MISSING:
+            return dict(cached)
+        
+        write_seq = self._write_seq
+        stats = await self._run(self.database.get_conversation_stats, conversation_id)
+        if stats and write_seq == self._write_seq:
+            self.conversation_stats_cache.set(conversation_id, dict(stats))
+        return stats
+    
+    async def update_conversation_title(self, conversation_id: int, title: str) -> bool:
+        success = await self._run(self.database.update_conversation_title, conversation_id, title)
+        self._invalidate_conversation(conversation_id)
+        return success
+    
+    async def add_message(self, conversation_id: int, role: str, content: str) -> Optional[Dict]:
+        message = await self._run(self.database.add_message, conversation_id, role, content)
+        self._invalidate_conversation(conversation_id)
+        
+        # 新消息通常是最新的一条，直接追加到缓存的消息尾部；
+        # 并发写入时后写入的可能先返回，id 不大于尾部最后一条时丢弃缓存，下次读取重新查询
+        cached = self.message_cache.peek(conversation_id)
+        if message and cached is not MISSING:
+            tail, complete = cached
+            if tail and message["id"] <= tail[-1]["id"]:
+                self.message_cache.pop(conversation_id)
+                return message
+            tail = tail + [dict(message)]
+            if len(tail) > MESSAGE_TAIL_SIZE:
+                tail, complete = tail[-MESSAGE_TAIL_SIZE:], False
+            self.message_cache.set(conversation_id, (tail, complete))
+        return message
+    
+    async def add_messages_bulk(self, messages: List[Dict]) -> int:
+        count = await self._run(self.database.add_messages_bulk, messages)
+        # 导入的消息可能带有更早的时间，不能直接追加到缓存尾部
+        for conversation_id in {message["conversation_id"] for message in messages}:
+            self._invalidate_conversation(conversation_id)
+            self.message_cache.pop(conversation_id)
+        return count
+    
+    async def get_context_messages(self, conversation_id: int, budget: int,
+                                   after_id: int = 0) -> List[Dict]:
+        return await self._run(self.database.get_context_messages, conversation_id, budget, after_id)
+    
+    async def add_summary(self, conversation_id: int, end_message_id: int, content: str) -> Dict:
+        summary = await self._run(self.database.add_summary, conversation_id, end_message_id, content)
+        self._invalidate_conversation(conversation_id)
+        return summary
+    
+    async def get_summary(self, conversation_id: int) -> Optional[Dict]:
+        return await self._run(self.database.get_summary, conversation_id)
+    
+    async def get_messages_to_summarize(self, conversation_id: int, after_id: int, min_tokens: int,
+                                        keep_tokens: int, max_tokens: int) -> List[Dict]:
+        return await self._run(self.database.get_messages_to_summarize, conversation_id,
+                               after_id, min_tokens, keep_tokens, max_tokens)
+    
+    async def get_messages(self, conversation_id: int, before_id: Optional[int] = None,
+                           limit: Optional[int] = None, since_id: Optional[int] = None) -> List[Dict]:
+        # 只有最新的一段消息走缓存，翻页和增量查询直接读库
+        if (since_id is not None or before_id is not None
+                or (limit is not None and limit > MESSAGE_TAIL_SIZE)):
+            return await self._run(self.database.get_messages, conversation_id,
+                                   before_id, limit, since_id)
+        
+        cached = self.message_cache.get(conversation_id)
+        if cached is not MISSING:
+            tail, complete = cached
+            if limit is not None and (limit <= len(tail) or complete):
+                return [dict(message) for message in tail[-limit:]]
+            if limit is None and complete:
+                return [dict(message) for message in tail]
+        
+        # 未命中时至少读取 MESSAGE_TAIL_SIZE 条，回填缓存
+        write_seq = self._write_seq
+        fetch_limit = None if limit is None else MESSAGE_TAIL_SIZE
+        messages = await self._run(self.database.get_messages, conversation_id, None, fetch_limit)
+        if write_seq == self._write_seq:
+            complete = fetch_limit is None or len(messages) < fetch_limit
+            if complete or len(messages) >= MESSAGE_TAIL_SIZE:
+                tail = [dict(message) for message in messages[-MESSAGE_TAIL_SIZE:]]
+                self.message_cache.set(conversation_id, (tail, complete and len(messages) <= MESSAGE_TAIL_SIZE))
+        return messages if limit is None else messages[-limit:]
+    
+    def cache_stats(self) -> Dict:
+        """各缓存的命中统计"""
+        return {
+            "conversations": self.conversation_cache.stats(),
+            "conversation_stats": self.conversation_stats_cache.stats(),
+            "conversation_lists": self.conversation_list_cache.stats(),
+            "messages": self.message_cache.stats(),
+        }
+    
+    async def search(self, query: str, limit: int = 20, offset: int = 0) -> List[Dict]:
+        return await self._run(self.database.search, query, limit, offset)
+    
+    async def save_file(self, filename: str, original_filename: str, file_path: str,
+                        file_size: int, conversation_id: Optional[int] = None,
+                        sha256: Optional[str] = None) -> int:
+        return await self._run(self.database.save_file, filename, original_filename,
+                               file_path, file_size, conversation_id, sha256)
+    
+    async def delete_file(self, file_id: int) -> bool:
+        return await self._run(self.database.delete_file, file_id)
+    
+    async def delete_unreferenced_blobs(self) -> List[str]:
+        return await self._run(self.database.delete_unreferenced_blobs)
+    
+    async def get_file(self, file_id: int) -> Optional[Dict]:
+        return await self._run(self.database.get_file, file_id)
+    
+    async def set_ingestion_status(self, file_id: int, status: str, error: Optional[str] = None) -> bool:
+        return await self._run(self.database.set_ingestion_status, file_id, status, error)
+    
+    async def save_file_chunks(self, file_id: int, char_count: int, chunks: List[tuple]) -> bool:
+        return await self._run(self.database.save_file_chunks, file_id, char_count, chunks)
+    
+    async def copy_file_chunks(self, file_id: int, sha256: str) -> Optional[int]:
+        return await self._run(self.database.copy_file_chunks, file_id, sha256)
+    
+    async def get_ingestion(self, file_id: int) -> Optional[Dict]:
+        return await self._run(self.database.get_ingestion, file_id)
+    
+    async def get_unfinished_ingestions(self) -> List[int]:
+        return await self._run(self.database.get_unfinished_ingestions)
+    
+    async def get_ingestion_counts(self) -> Dict[str, int]:
+        return await self._run(self.database.get_ingestion_counts)
+    
+    async def get_file_chunks(self, file_id: int, limit: int = 50, offset: int = 0) -> List[Dict]:
+        return await self._run(self.database.get_file_chunks, file_id, limit, offset)
+    
+    async def get_chunks_after(self, after_id: int, limit: int = 500) -> List[tuple]:
+        return await self._run(self.database.get_chunks_after, after_id, limit)
+    
+    async def get_chunks_by_ids(self, chunk_ids: List[int]) -> Dict[int, Dict]:
+        return await self._run(self.database.get_chunks_by_ids, chunk_ids)
+    
+    async def create_upload_session(self, upload_id: str, original_filename: str, file_size: int,
+                                    chunk_size: int, temp_path: str) -> Dict:
+        return await self._run(self.database.create_upload_session, upload_id,
+                               original_filename, file_size, chunk_size, temp_path)
+    
+    async def get_upload_session(self, upload_id: str) -> Optional[Dict]:
+        return await self._run(self.database.get_upload_session, upload_id)
+    
+    async def mark_chunk_received(self, upload_id: str, chunk_index: int) -> bool:
+        return await self._run(self.database.mark_chunk_received, upload_id, chunk_index)
+    
+    async def delete_upload_session(self, upload_id: str) -> Optional[str]:
+        return await self._run(self.database.delete_upload_session, upload_id)
+    
+    async def delete_expired_upload_sessions(self, max_age_seconds: int) -> List[str]:
+        return await self._run(self.database.delete_expired_upload_sessions, max_age_seconds)
+    
+    def close(self):
+        """等待进行中的查询完成后关闭线程池和连接"""
+        self._executor.shutdown(wait=True)
+        self.database.close()
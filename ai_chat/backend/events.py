@@ -0,0 +1,68 @@
+"""
+进程内事件发布订阅：写操作发布事件，WebSocket 连接订阅后推送给客户端
+"""
+import asyncio
+from typing import Dict, Optional, Set
+
+# 每个订阅者最多积压的事件数
+EVENT_QUEUE_SIZE = 256
+
+# 队列溢出时发送给客户端的事件：提示其通过增量同步接口补齐数据
+RESYNC_EVENT = {"type": "resync"}
+
+
+class Subscriber:
+    """一个订阅者（一条 WebSocket 连接）：有界队列 + 关注的对话集合"""
+
+    def __init__(self, queue_size: int = EVENT_QUEUE_SIZE):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.conversation_ids: Set[int] = set()
+        self.overflows = 0
+
+    def wants(self, conversation_id: Optional[int]) -> bool:
+        # 不属于特定对话的事件（对话创建、改名）推送给所有订阅者
+        return conversation_id is None or conversation_id in self.conversation_ids
+
+    def offer(self, event: Dict):
+        """非阻塞地放入事件；队列已满说明客户端跟不上，丢弃积压并改为发送 resync"""
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflows += 1
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(RESYNC_EVENT)
+
+    async def get(self) -> Dict:
+        return await self.queue.get()
+
+
+class EventHub:
+    """事件中心：发布者不会因为慢速订阅者而阻塞"""
+
+    def __init__(self, queue_size: int = EVENT_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.subscribers: Set[Subscriber] = set()
+        self.published = 0
+
+    def subscribe(self) -> Subscriber:
+        subscriber = Subscriber(self.queue_size)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        self.subscribers.discard(subscriber)
+
+    def publish(self, event: Dict, conversation_id: Optional[int] = None):
+        """发布事件；指定 conversation_id 时只推送给关注该对话的订阅者"""
+        self.published += 1
+        for subscriber in list(self.subscribers):
+            if subscriber.wants(conversation_id):
+                subscriber.offer(event)
+
+    def stats(self) -> Dict:
+        return {
+            "subscribers": len(self.subscribers),
+            "published": self.published,
+            "overflows": sum(s.overflows for s in self.subscribers),
+        }
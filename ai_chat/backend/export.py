@@ -0,0 +1,77 @@
+"""
+流式导出：把全部对话和消息逐行编码为 NDJSON（可选 gzip 压缩），格式与 bulk.py 的导入格式一致
+
+命令行用法：
+    python export.py [--db chat.db] [--gzip] [-o 输出文件]
+不指定输出文件时写到标准输出。
+"""
+import argparse
+import json
+import os
+import sys
+import zlib
+from typing import Iterable, Iterator
+
+from database import Database
+
+# 输出块大小：编码后的行攒够该字节数再产出，减少响应分块和系统调用
+EXPORT_CHUNK_SIZE = 64 * 1024  # 64KB
+
+# gzip 压缩级别，兼顾速度和压缩率
+GZIP_LEVEL = 6
+
+
+def encode_records(records: Iterable[dict], chunk_size: int = EXPORT_CHUNK_SIZE) -> Iterator[bytes]:
+    """把记录编码为 NDJSON，按块产出"""
+    buffer = bytearray()
+    for record in records:
+        buffer += json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        buffer += b"\n"
+        if len(buffer) >= chunk_size:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+
+def gzip_chunks(chunks: Iterable[bytes], level: int = GZIP_LEVEL) -> Iterator[bytes]:
+    """增量压缩为 gzip 格式"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits=31 输出 gzip 头和校验
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def iter_export(database: Database, compress: bool = False) -> Iterator[bytes]:
+    """导出整个数据库，内存占用与数据量无关"""
+    chunks = encode_records(database.iter_export())
+    return gzip_chunks(chunks) if compress else chunks
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="导出全部对话和消息为 NDJSON")
+    parser.add_argument("--db", default="chat.db", help="数据库文件路径")
+    parser.add_argument("--gzip", action="store_true", help="使用 gzip 压缩输出")
+    parser.add_argument("-o", "--output", help="输出文件路径，默认写到标准输出")
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.db):
+        parser.error(f"database not found: {args.db}")
+
+    database = Database(args.db)
+    try:
+        out = open(args.output, "wb") if args.output else sys.stdout.buffer
+        try:
+            for chunk in iter_export(database, args.gzip):
+                out.write(chunk)
+        finally:
+            if args.output:
+                out.close()
+    finally:
+        database.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+HTTP 条件请求：生成 ETag / Last-Modified，处理 If-None-Match / If-Modified-Since
+"""
+import hashlib
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Optional
+
+from fastapi import Request, Response
+
+# 数据库中 CURRENT_TIMESTAMP 的格式（UTC）
+DB_TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def to_db_timestamp(value: str) -> str:
+    """把 ISO 8601 时间转换为数据库中的 UTC 时间格式，格式错误时抛出 ValueError"""
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed.strftime(DB_TIMESTAMP_FORMAT)
+
+
+def make_etag(*parts) -> str:
+    """由若干字段生成强 ETag"""
+    digest = hashlib.sha1("\x1f".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+    return f'"{digest}"'
+
+
+def parse_db_timestamp(timestamp: str) -> datetime:
+    return datetime.strptime(timestamp, DB_TIMESTAMP_FORMAT).replace(tzinfo=timezone.utc)
+
+
+def http_date(timestamp: str) -> str:
+    """数据库时间戳转换为 HTTP 日期格式"""
+    return format_datetime(parse_db_timestamp(timestamp), usegmt=True)
+
+
+def is_not_modified(request: Request, etag: str, last_modified: Optional[str] = None) -> bool:
+    """判断客户端缓存是否仍然有效；同时带有两个条件头时以 If-None-Match 为准"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        candidates = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in candidates or any(
+            (tag[2:] if tag.startswith("W/") else tag) == etag for tag in candidates
+        )
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None and last_modified is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        return parse_db_timestamp(last_modified) <= since
+    return False
+
+
+def cache_headers(etag: str, last_modified: Optional[str] = None) -> dict:
+    """响应需要携带的缓存头：每次使用前都向服务器验证"""
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if last_modified is not None:
+        headers["Last-Modified"] = http_date(last_modified)
+    return headers
+
+
+def not_modified_response(etag: str, last_modified: Optional[str] = None) -> Response:
+    return Response(status_code=304, headers=cache_headers(etag, last_modified))
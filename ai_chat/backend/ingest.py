@@ -0,0 +1,344 @@
+"""
+知识库导入：从上传的文件中抽取文本，切分为带字符偏移的文本块存入数据库
+
+抽取和切分是 CPU 密集的工作，在进程池中执行，吞吐量随 CPU 核数扩展；数据库写入留在主进程。
+上传接口只登记任务，不等待处理结果。处理进度记录在 file_ingestions 表中：
+pending（排队）→ extracting（抽取和切分）→ storing（写入文本块）→ done / failed。
+"""
+import asyncio
+import codecs
+import logging
+import multiprocessing
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from html.parser import HTMLParser
+from typing import Callable, Dict, List, Optional, Tuple
+from xml.etree import ElementTree
+
+logger = logging.getLogger(__name__)
+
+# 文本块长度和相邻块的重叠长度（字符数）
+CHUNK_SIZE = int(os.environ.get("INGEST_CHUNK_SIZE", 1000))
+CHUNK_OVERLAP = int(os.environ.get("INGEST_CHUNK_OVERLAP", 200))
+# 进程池大小，0 表示使用全部 CPU 核
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", 0))
+# 超过该大小的文件（或解压后的文档内容）不处理
+INGEST_MAX_BYTES = int(os.environ.get("INGEST_MAX_BYTES", 50 * 1024 * 1024))  # 默认50MB
+
+# 切分时优先在这些字符之后断开
+SENTENCE_BOUNDARIES = ("\n", "。", "！", "？", "；", ".", "!", "?", ";")
+
+# 处理状态
+STATUS_PENDING = "pending"
+STATUS_EXTRACTING = "extracting"
+STATUS_STORING = "storing"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+_WORD_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+
+class UnsupportedFileError(Exception):
+    """无法从文件中抽取文本"""
+
+
+def decode_text(data: bytes) -> str:
+    """解码纯文本：依次尝试 UTF-16（有 BOM 时）、UTF-8、GB18030，最后按 Latin-1 保留原始字节"""
+    if data.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return data.decode("utf-16")
+    if b"\x00" in data[:8192]:
+        raise UnsupportedFileError("Binary file")
+    for encoding in ("utf-8-sig", "gb18030"):
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    return data.decode("latin-1")
+
+
+class _HTMLTextParser(HTMLParser):
+    """提取 HTML 的可见文本，块级元素之间换行"""
+    SKIP_TAGS = {"script", "style", "head", "template"}
+    BLOCK_TAGS = {"p", "div", "br", "li", "tr", "h1", "h2", "h3", "h4", "h5", "h6",
+                  "section", "article", "pre", "blockquote", "table"}
+
+    def __init__(self):
+        super().__init__()
+        self.parts: List[str] = []
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self._skip += 1
+        elif tag in self.BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            self._skip = max(self._skip - 1, 0)
+        elif tag in self.BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if not self._skip:
+            self.parts.append(data)
+
+
+def _html_text(data: bytes) -> str:
+    parser = _HTMLTextParser()
+    parser.feed(decode_text(data))
+    parser.close()
+    return "".join(parser.parts)
+
+
+def _docx_text(path: str) -> str:
+    """读取 Word 文档正文：每个段落一行"""
+    try:
+        with zipfile.ZipFile(path) as archive:
+            info = archive.getinfo("word/document.xml")
+            if info.file_size > INGEST_MAX_BYTES:
+                raise UnsupportedFileError("Document content too large")
+            parts = []
+            with archive.open(info) as document:
+                for _, element in ElementTree.iterparse(document):
+                    if element.tag == _WORD_NS + "t":
+                        parts.append(element.text or "")
+                    elif element.tag == _WORD_NS + "tab":
+                        parts.append("\t")
+                    elif element.tag == _WORD_NS + "br":
+                        parts.append("\n")
+                    elif element.tag == _WORD_NS + "p":
+                        parts.append("\n")
+                        element.clear()
+            return "".join(parts)
+    except (zipfile.BadZipFile, KeyError, ElementTree.ParseError) as e:
+        raise UnsupportedFileError(f"Invalid docx file: {e}")
+
+
+def _pdf_text(path: str) -> str:
+    """读取 PDF 文本层（需要安装 pypdf）"""
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        raise UnsupportedFileError("PDF support requires pypdf")
+    reader = PdfReader(path)
+    return "\n".join(page.extract_text() or "" for page in reader.pages)
+
+
+def extract_text(path: str, filename: str) -> str:
+    """按扩展名抽取文件文本；其他类型的文件按纯文本解码"""
+    if os.path.getsize(path) > INGEST_MAX_BYTES:
+        raise UnsupportedFileError("File too large for ingestion")
+
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == ".docx":
+        text = _docx_text(path)
+    elif extension == ".pdf":
+        text = _pdf_text(path)
+    else:
+        with open(path, "rb") as f:
+            data = f.read()
+        text = _html_text(data) if extension in (".html", ".htm") else decode_text(data)
+    return text.replace("\r\n", "\n").replace("\r", "\n")
+
+
+def _last_boundary(text: str, lo: int, hi: int) -> int:
+    """[lo, hi) 中最后一个句子边界之后的位置，没有时返回 -1"""
+    position = max(text.rfind(mark, lo, hi) for mark in SENTENCE_BOUNDARIES)
+    return position + 1 if position >= 0 else -1
+
+
+def _first_boundary(text: str, lo: int, hi: int) -> int:
+    """[lo, hi) 中第一个句子边界之后的位置，没有时返回 -1"""
+    positions = [p for p in (text.find(mark, lo, hi) for mark in SENTENCE_BOUNDARIES) if p >= 0]
+    return min(positions) + 1 if positions else -1
+
+
+def chunk_text(text: str, chunk_size: int = CHUNK_SIZE,
+               overlap: int = CHUNK_OVERLAP) -> List[Tuple[int, int, str]]:
+    """切分为 (起始偏移, 结束偏移, 内容) 列表，内容即 text[起始偏移:结束偏移]
+
+    每块至多 chunk_size 个字符，尽量在后半段的句子边界处断开；
+    下一块从前一块末尾 overlap 个字符内的句子开头开始，保证跨块的句子能完整出现在某一块中。
+    """
+    overlap = min(overlap, chunk_size // 2)
+    chunks = []
+    length = len(text)
+    start = 0
+    while start < length:
+        while start < length and text[start].isspace():
+            start += 1
+        if start >= length:
+            break
+
+        end = min(start + chunk_size, length)
+        if end < length:
+            boundary = _last_boundary(text, start + chunk_size // 2, end)
+            if boundary > 0:
+                end = boundary
+        content_end = end
+        while content_end > start and text[content_end - 1].isspace():
+            content_end -= 1
+        chunks.append((start, content_end, text[start:content_end]))
+        if end >= length:
+            break
+
+        # 重叠部分从句子开头开始；找不到句子边界时直接回退 overlap 个字符
+        next_start = end - overlap
+        boundary = _first_boundary(text, next_start, end - 1)
+        if boundary > 0:
+            next_start = boundary
+        start = max(next_start, start + 1)
+    return chunks
+
+
+def extract_and_chunk(path: str, filename: str, chunk_size: int = CHUNK_SIZE,
+                      overlap: int = CHUNK_OVERLAP) -> Tuple[int, List[Tuple[int, int, str]]]:
+    """在工作进程中执行：返回 (文本字符数, 文本块列表)"""
+    text = extract_text(path, filename)
+    return len(text), chunk_text(text, chunk_size, overlap)
+
+
+def _worker_context():
+    """工作进程的启动方式：不用 fork，不继承主进程的数据库连接和线程
+
+    优先使用 forkserver 并预先导入本模块，工作进程从已导入本模块的服务进程分叉，启动更快；
+    不支持的平台使用 spawn。两种方式的工作进程都会以 __mp_main__ 重新导入主程序，
+    main.py 在导入时不打开数据库、不启动线程池，重新导入几乎没有开销。
+    """
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("spawn")
+    worker_context = multiprocessing.get_context("forkserver")
+    worker_context.set_forkserver_preload([__name__])
+    return worker_context
+
+
+class Ingestor:
+    """知识库导入任务：每个文件一个协程，抽取和切分交给进程池，结果在主进程写入数据库"""
+
+    def __init__(self, db, max_workers: int = INGEST_WORKERS,
+                 chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP,
+                 on_stored: Optional[Callable[[int], None]] = None):
+        self.db = db
+        self.on_stored = on_stored  # 文件的文本块写入后调用，参数为文件 id
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.overlap = overlap
+        # 同时等待进程池的任务数：保证每个工作进程都有活干，又不至于积压过多结果占用内存
+        self._slots = asyncio.Semaphore(self.max_workers * 2)
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._tasks: Dict[int, asyncio.Task] = {}
+        # 正在抽取的内容（sha256 -> 完成事件）：相同内容的文件等待第一个的结果再复制，不重复抽取
+        self._extracting: Dict[str, asyncio.Event] = {}
+        self.completed = 0
+        self.reused = 0
+        self.failed = 0
+
+    def _executor(self) -> ProcessPoolExecutor:
+        # 首次有任务时才启动工作进程
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(self.max_workers, mp_context=_worker_context())
+        return self._pool
+
+    async def start(self):
+        """重新排队上次退出时没有处理完的文件"""
+        for file_id in await self.db.get_unfinished_ingestions():
+            self._schedule(file_id)
+
+    async def stop(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    async def submit(self, file_id: int) -> bool:
+        """登记文件并排队处理；文件不存在时返回 False。同一文件正在处理时不重复排队"""
+        if file_id in self._tasks:
+            return True
+        if not await self.db.set_ingestion_status(file_id, STATUS_PENDING):
+            return False
+        self._schedule(file_id)
+        return True
+
+    def _schedule(self, file_id: int):
+        if file_id in self._tasks:
+            return
+        task = asyncio.create_task(self._run(file_id))
+        self._tasks[file_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(file_id, None))
+
+    async def _run(self, file_id: int):
+        try:
+            await self.ingest(file_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Failed to ingest file %s", file_id)
+
+    async def ingest(self, file_id: int):
+        file = await self.db.get_file(file_id)
+        if file is None:
+            return
+
+        sha256 = file["sha256"]
+        if sha256:
+            # 相同内容已处理过时直接复用其文本块；正在处理时等它完成再复用，
+            # 它失败或文件已被删除时由本文件重新抽取
+            while True:
+                extracting = self._extracting.get(sha256)
+                if extracting is not None:
+                    await extracting.wait()
+                    continue
+                if await self.db.copy_file_chunks(file_id, sha256) is not None:
+                    self.reused += 1
+                    self._stored(file_id)
+                    return
+                if sha256 not in self._extracting:
+                    break
+            self._extracting[sha256] = asyncio.Event()
+        try:
+            await self._extract_and_store(file_id, file)
+        finally:
+            if sha256:
+                self._extracting.pop(sha256).set()
+
+    async def _extract_and_store(self, file_id: int, file: Dict):
+        if not await self.db.set_ingestion_status(file_id, STATUS_EXTRACTING):
+            return
+        try:
+            async with self._slots:
+                char_count, chunks = await asyncio.get_running_loop().run_in_executor(
+                    self._executor(), extract_and_chunk,
+                    file["file_path"], file["original_filename"], self.chunk_size, self.overlap
+                )
+        except Exception as e:
+            if isinstance(e, BrokenProcessPool):
+                # 工作进程异常退出（例如内存不足）后进程池不可再用，下一个任务重新创建
+                self._pool = None
+            self.failed += 1
+            await self.db.set_ingestion_status(file_id, STATUS_FAILED, str(e) or type(e).__name__)
+            return
+
+        if not await self.db.set_ingestion_status(file_id, STATUS_STORING):
+            return
+        if await self.db.save_file_chunks(file_id, char_count, chunks):
+            self.completed += 1
+            self._stored(file_id)
+
+    def _stored(self, file_id: int):
+        if self.on_stored is not None:
+            self.on_stored(file_id)
+
+    def stats(self) -> Dict:
+        return {
+            "workers": self.max_workers,
+            "active": len(self._tasks),
+            "completed": self.completed,
+            "reused": self.reused,
+            "failed": self.failed,
+        }
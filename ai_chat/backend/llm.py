@@ -0,0 +1,86 @@
+"""
+大语言模型接入层：统一的流式生成接口，具体模型通过注册表按名称选择
+"""
+import asyncio
+import hashlib
+from typing import AsyncIterator, Callable, Dict, List, Optional
+
+
+class LLMProvider:
+    """模型提供方基类：子类实现 stream_chat，逐段产出回复内容"""
+    name = "base"
+
+    async def stream_chat(self, messages: List[Dict], temperature: float = 0.7,
+                          max_tokens: Optional[int] = None) -> AsyncIterator[str]:
+        raise NotImplementedError
+        yield  # 使子类以外的调用也是异步生成器
+
+    async def complete(self, messages: List[Dict], temperature: float = 0.7,
+                       max_tokens: Optional[int] = None) -> str:
+        """非流式调用：收集完整回复"""
+        parts = []
+        async for token in self.stream_chat(messages, temperature, max_tokens):
+            parts.append(token)
+        return "".join(parts)
+
+
+class FakeLLMProvider(LLMProvider):
+    """本地假模型：回复只由输入决定，用于开发和测试"""
+    name = "fake"
+
+    REPLIES = (
+        "我理解您的问题。让我来帮助您解决这个问题。",
+        "这是一个很好的问题。根据我的理解...",
+        "感谢您的提问。我建议您可以考虑以下几个方面：",
+        "我明白了您的需求。让我为您提供一些建议。",
+        "这个问题很有意思。从我的角度来看...",
+    )
+
+    def __init__(self, token_delay: float = 0.02, chunk_size: int = 2, latency: float = 0.0):
+        self.token_delay = token_delay  # 每个片段之间的延迟（秒），模拟生成速度
+        self.chunk_size = chunk_size    # 每个片段的字符数
+        self.latency = latency          # 首个片段之前的延迟（秒），模拟排队和处理提示词的时间
+        self.active = 0                 # 正在进行的调用数，用于观察调度效果
+        self.max_active = 0
+
+    def build_reply(self, messages: List[Dict]) -> str:
+        last_user = next((m["content"] for m in reversed(messages) if m["role"] == "user"), "")
+        digest = hashlib.sha256(last_user.encode("utf-8")).digest()
+        opening = self.REPLIES[digest[0] % len(self.REPLIES)]
+        return f"{opening}\n\n您刚才提到了：\"{last_user}\"，我会认真考虑这个问题并为您提供最佳的解决方案。"
+
+    async def stream_chat(self, messages: List[Dict], temperature: float = 0.7,
+                          max_tokens: Optional[int] = None) -> AsyncIterator[str]:
+        reply = self.build_reply(messages)
+        chunks = [reply[i:i + self.chunk_size] for i in range(0, len(reply), self.chunk_size)]
+        if max_tokens is not None:
+            chunks = chunks[:max_tokens]
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            for chunk in chunks:
+                if self.token_delay:
+                    await asyncio.sleep(self.token_delay)
+                yield chunk
+        finally:
+            self.active -= 1
+
+
+# 提供方注册表：名称 -> 构造函数
+PROVIDERS: Dict[str, Callable[..., LLMProvider]] = {
+    FakeLLMProvider.name: FakeLLMProvider,
+}
+
+
+def register_provider(name: str, factory: Callable[..., LLMProvider]):
+    """注册新的模型提供方"""
+    PROVIDERS[name] = factory
+
+
+def create_provider(name: str, **kwargs) -> LLMProvider:
+    """按名称创建模型提供方"""
+    if name not in PROVIDERS:
+        raise ValueError(f"Unknown LLM provider: {name}")
+    return PROVIDERS[name](**kwargs)
@@ -1,16 +1,54 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File, Depends
+from fastapi import (
+    FastAPI, HTTPException, UploadFile, File, Depends, Query, Request, Response,
+    WebSocket, WebSocketDisconnect
+)
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+import asyncio
+import json
+import logging
 import os
 import uuid
-from typing import List
-from database import Database
+from typing import Dict, List, Optional
+from bulk import BulkImporter, BulkImportError, iter_ndjson
+from context import create_tokenizer, prompt_budget
+from database import Database, AsyncDatabase
+from events import EventHub, RESYNC_EVENT
+from export import iter_export
+from ingest import Ingestor
+from http_cache import (
+    make_etag, is_not_modified, cache_headers, not_modified_response, to_db_timestamp
+)
+from llm import create_provider
+from metrics import MetricsMiddleware, REGISTRY, CONTENT_TYPE
+from profiling import PROFILE_ENABLED, Profiler, ProfilingMiddleware, span
+from response_cache import CachedProvider, ResponseCache
+from scheduler import LLMScheduler, PRIORITY_BACKGROUND
+from summarizer import Compactor, create_summarizer
+from starlette.concurrency import run_in_threadpool
+from vectors import KnowledgeBase, create_embedder
+from uploads import (
+    stream_upload_to_temp, blob_name, place_blob, remove_quietly, UploadTooLargeError,
+    preallocate, write_stream_at, hash_file, InvalidChunkError
+)
 from models import (
     ConversationCreate, ConversationUpdate, Conversation, 
-    MessageCreate, Message, ConversationWithMessages, FileUploadResponse
+    MessageCreate, Message, ConversationWithMessages, FileUploadResponse,
+    CompletionRequest, UploadSessionCreate, UploadSession, SearchResponse, BulkImportResult,
+    IngestionStatus, FileChunk, KnowledgeSearchResponse
 )
 
-app = FastAPI(title="AI Chat API", version="1.0.0")
+logger = logging.getLogger(__name__)
+
+class ProfiledJSONResponse(JSONResponse):
+    """默认响应类：剖析时记录 JSON 序列化耗时，未剖析的请求只多一次 ContextVar 读取"""
+
+    def render(self, content) -> bytes:
+        with span("serialization"):
+            return super().render(content)
+
+app = FastAPI(title="AI Chat API", version="1.0.0", default_response_class=ProfiledJSONResponse)
 
 # 配置CORS
 app.add_middleware(
@@ -25,28 +63,147 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "Last-Modified"],
 )
 
-# 初始化数据库
-db = Database()
+# 请求指标（按路由模板统计请求数、处理中的请求数和耗时），在 /metrics 输出
+app.add_middleware(MetricsMiddleware)
+
+# 请求剖析（PROFILE_ENABLED=1 时开启）：按 PROFILE_SAMPLE_RATE 抽样或带 X-Debug-Profile 请求头的请求
+# 记录调用栈采样和 SQL / 序列化 / I/O 耗时，保留最慢的若干条，在 /api/admin/profiles 查看；
+# 请求头和管理接口都要带上 PROFILE_TOKEN
+profiler = Profiler() if PROFILE_ENABLED else None
+if profiler:
+    app.add_middleware(ProfilingMiddleware, profiler=profiler)
+
+# 事件中心：写操作发布事件，通过 WebSocket 推送给客户端
+hub = EventHub()
+WEBSOCKET_SEND_TIMEOUT = 10.0  # 单条事件发送超时（秒），超时视为客户端失去响应
+
+# 数据库、模型调度和后台任务在应用启动时创建（见 start_services），导入本模块不打开数据库、
+# 不启动线程池：知识库进程池的工作进程会以 __mp_main__ 重新导入主程序，此时几乎没有开销
+db: Optional[AsyncDatabase] = None
+scheduler: Optional[LLMScheduler] = None
+response_cache: Optional[ResponseCache] = None
+llm: Optional[CachedProvider] = None
+compactor: Optional[Compactor] = None
+knowledge_base: Optional[KnowledgeBase] = None
+ingestor: Optional[Ingestor] = None
+
+# 分页单页上限
+MAX_PAGE_SIZE = 200
 
 # 创建上传目录
 UPLOAD_DIR = "../uploads"
+MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
+
+# 分块上传配置
+RESUMABLE_MAX_FILE_SIZE = int(os.environ.get("RESUMABLE_MAX_FILE_SIZE", 1024 * 1024 * 1024))  # 默认1GB
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024   # 4MB
+MIN_CHUNK_SIZE = 64 * 1024             # 64KB
+MAX_CHUNK_SIZE = 16 * 1024 * 1024      # 16MB
+UPLOAD_SESSION_TTL = 24 * 60 * 60      # 未完成的上传会话保留24小时
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
 # 静态文件服务
 app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
 
+@app.on_event("startup")
+async def start_services():
+    global db, scheduler, response_cache, llm, compactor, knowledge_base, ingestor
+    
+    # 初始化数据库（查询在线程池中执行，不阻塞事件循环）；分词器用于写入消息时统计 token 数
+    db = AsyncDatabase(Database(tokenizer=create_tokenizer(os.environ.get("TOKENIZER", "simple"))))
+    data_dir = os.path.dirname(os.path.abspath(db.database.db_path))
+    
+    # 大语言模型提供方，默认使用本地假模型
+    # 所有调用经过调度器排队：限制全局和单个对话的并发，相同的进行中请求只调用一次
+    scheduler = LLMScheduler(
+        create_provider(os.environ.get("LLM_PROVIDER", "fake")),
+        max_concurrency=int(os.environ.get("LLM_MAX_CONCURRENCY", 4)),
+        per_conversation=int(os.environ.get("LLM_MAX_PER_CONVERSATION", 1)),
+    )
+    
+    # temperature 为 0 的请求先查回复缓存，命中时不进入调度队列
+    response_cache = ResponseCache(os.path.join(data_dir, "llm_cache.db"))
+    llm = CachedProvider(scheduler, response_cache, model=scheduler.provider.name)
+    
+    # 后台滚动摘要：长对话较早的消息压缩为摘要，默认使用本地抽取式摘要；调用模型时排在对话回复之后
+    compactor = Compactor(db, create_summarizer(os.environ.get("SUMMARIZER", "extractive"),
+                                                scheduler.bind(priority=PRIORITY_BACKGROUND)))
+    
+    # 知识库：上传的文件在后台进程池中抽取文本并切分，不占用请求处理；
+    # 文本块写入后增量嵌入，向量存放在 chat.db 同目录下，默认使用本地哈希嵌入
+    knowledge_base = KnowledgeBase(
+        db, create_embedder(os.environ.get("EMBEDDER", "hashing")), os.path.join(data_dir, "kb_vectors")
+    )
+    ingestor = Ingestor(db, on_stored=knowledge_base.notify)
+    
+    compactor.start()
+    knowledge_base.start()
+    await ingestor.start()
+    
+    if profiler and not profiler.token:
+        logger.warning("PROFILE_TOKEN is not set: only sampled requests are profiled "
+                       "and the /api/admin/profiles endpoints are disabled")
+
+@app.on_event("shutdown")
+async def stop_services():
+    await compactor.stop()
+    await ingestor.stop()
+    await knowledge_base.stop()
+    response_cache.close()
+    db.close()
+
 @app.get("/")
 async def root():
     return {"message": "AI Chat API is running"}
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus 文本格式的运行指标"""
+    return Response(REGISTRY.render(), media_type=CONTENT_TYPE)
+
+def publish_message_created(conversation_id: int, message: Dict):
+    """推送新消息：消息内容只发给关注该对话的客户端，对话的更新时间发给所有客户端"""
+    hub.publish(
+        {"type": "message.created", "conversation_id": conversation_id, "message": message},
+        conversation_id
+    )
+    hub.publish({
+        "type": "conversation.updated",
+        "conversation": {"id": conversation_id, "updated_at": message["created_at"]}
+    })
+
 @app.get("/api/conversations", response_model=List[Conversation])
-async def get_conversations():
-    """获取所有对话列表"""
+async def get_conversations(
+    request: Request,
+    response: Response,
+    before_id: Optional[int] = Query(None, description="返回该对话之后（更早更新）的对话"),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    updated_since: Optional[str] = Query(None, description="只返回在该时间（含）之后更新过的对话"),
+):
+    """获取对话列表，支持游标分页、增量同步和条件请求"""
     try:
-        conversations = db.get_conversations()
+        if updated_since is not None:
+            try:
+                updated_since = to_db_timestamp(updated_since)
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Invalid timestamp")
+        conversations = await db.get_conversations(before_id, limit, updated_since)
+        
+        # 列表本身很小（且有缓存），ETag 直接由列表内容生成，未变化时省去序列化和传输
+        etag = make_etag(before_id, limit, updated_since, *(
+            f"{c['id']}:{c['updated_at']}:{c['title']}" for c in conversations
+        ))
+        last_modified = max((c["updated_at"] for c in conversations), default=None)
+        if is_not_modified(request, etag, last_modified):
+            return not_modified_response(etag, last_modified)
+        
+        response.headers.update(cache_headers(etag, last_modified))
         return conversations
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -54,9 +211,10 @@ async def get_conversations():
 async def create_conversation(conversation: ConversationCreate):
     """创建新对话"""
     try:
-        conversation_id = db.create_conversation(conversation.title)
-        new_conversation = db.get_conversation(conversation_id)
+        conversation_id = await db.create_conversation(conversation.title)
+        new_conversation = await db.get_conversation(conversation_id)
         if new_conversation:
+            hub.publish({"type": "conversation.created", "conversation": new_conversation})
             return new_conversation
         else:
             raise HTTPException(status_code=500, detail="Failed to create conversation")
@@ -64,18 +222,44 @@ async def create_conversation(conversation: ConversationCreate):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/conversations/{conversation_id}", response_model=ConversationWithMessages)
-async def get_conversation(conversation_id: int):
-    """获取特定对话及其消息"""
+async def get_conversation(
+    conversation_id: int,
+    request: Request,
+    response: Response,
+    compact: bool = Query(False, description="返回摘要及其之后的消息，而不是全部消息"),
+):
+    """获取特定对话及其消息，支持条件请求"""
     try:
-        conversation = db.get_conversation(conversation_id)
+        # 先用对话信息和最新消息 id 判断客户端缓存是否有效，有效时不读取消息
+        stats = await db.get_conversation_stats(conversation_id)
+        if not stats:
+            raise HTTPException(status_code=404, detail="Conversation not found")
+        
+        summary = None
+        if compact:
+            summary = await db.get_summary(conversation_id)
+            if not summary:
+                # 尚未压缩过的长对话安排一次压缩，下次获取时即可返回摘要
+                compactor.notify(conversation_id)
+        etag = make_etag(stats["id"], stats["title"], stats["updated_at"], stats["last_message_id"],
+                         compact, summary["id"] if summary else None)
+        if is_not_modified(request, etag, stats["updated_at"]):
+            return not_modified_response(etag, stats["updated_at"])
+        response.headers.update(cache_headers(etag, stats["updated_at"]))
+        
+        conversation = await db.get_conversation(conversation_id)
         if not conversation:
             raise HTTPException(status_code=404, detail="Conversation not found")
         
-        messages = db.get_messages(conversation_id)
+        if summary:
+            messages = await db.get_messages(conversation_id, since_id=summary["end_message_id"])
+        else:
+            messages = await db.get_messages(conversation_id)
         
         return ConversationWithMessages(
             **conversation,
-            messages=messages
+            messages=messages,
+            summary=summary
         )
     except HTTPException:
         raise
@@ -86,11 +270,13 @@ async def get_conversation(conversation_id: int):
 async def update_conversation(conversation_id: int, conversation_update: ConversationUpdate):
     """更新对话标题"""
     try:
-        success = db.update_conversation_title(conversation_id, conversation_update.title)
+        success = await db.update_conversation_title(conversation_id, conversation_update.title)
         if not success:
             raise HTTPException(status_code=404, detail="Conversation not found")
         
-        updated_conversation = db.get_conversation(conversation_id)
+        updated_conversation = await db.get_conversation(conversation_id)
+        if updated_conversation:
+            hub.publish({"type": "conversation.updated", "conversation": updated_conversation})
         return updated_conversation
     except HTTPException:
         raise
@@ -98,16 +284,24 @@ async def update_conversation(conversation_id: int, conversation_update: Convers
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/conversations/{conversation_id}/messages", response_model=List[Message])
-async def get_messages(conversation_id: int):
-    """获取对话的所有消息"""
+async def get_messages(
+    conversation_id: int,
+    before_id: Optional[int] = Query(None, description="返回该消息之前的消息"),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    since_id: Optional[int] = Query(None, description="只返回该消息之后新增的消息"),
+):
+    """获取对话的消息，支持游标分页和增量同步"""
     try:
+        if since_id is not None and before_id is not None:
+            raise HTTPException(status_code=400, detail="since_id and before_id cannot be combined")
+        
         # 检查对话是否存在
-        conversation = db.get_conversation(conversation_id)
+        conversation = await db.get_conversation(conversation_id)
         if not conversation:
             raise HTTPException(status_code=404, detail="Conversation not found")
         
         # 获取消息
-        messages = db.get_messages(conversation_id)
+        messages = await db.get_messages(conversation_id, before_id, limit, since_id)
         return messages
     except HTTPException:
         raise
@@ -118,61 +312,261 @@ async def get_messages(conversation_id: int):
 async def add_message(conversation_id: int, message: MessageCreate):
     """向对话添加消息"""
     try:
-        # 检查对话是否存在
-        conversation = db.get_conversation(conversation_id)
-        if not conversation:
+        # 存在性检查和插入在同一事务中完成
+        new_message = await db.add_message(conversation_id, message.role, message.content)
+        if not new_message:
             raise HTTPException(status_code=404, detail="Conversation not found")
         
-        # 添加消息
-        message_id = db.add_message(conversation_id, message.role, message.content)
-        
-        # 获取添加的消息
-        messages = db.get_messages(conversation_id)
-        new_message = next((msg for msg in messages if msg["id"] == message_id), None)
+        publish_message_created(conversation_id, new_message)
+        compactor.notify(conversation_id)
+        return new_message
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/conversations/{conversation_id}/messages/bulk", response_model=BulkImportResult)
+async def add_messages_bulk(conversation_id: int, request: Request):
+    """批量向对话追加消息：请求体为 NDJSON，每行 {"role", "content", "created_at"（可选）}
+
+    边读取边解析，每攒够一批在一个事务内写入；出错时之前的批次已经写入，返回 400 并说明已写入的条数。
+    """
+    importer = BulkImporter(db)
+    try:
+        conversation = await db.get_conversation(conversation_id)
+        if not conversation:
+            raise HTTPException(status_code=404, detail="Conversation not found")
         
-        if new_message:
-            return new_message
-        else:
-            raise HTTPException(status_code=500, detail="Failed to add message")
+        await importer.import_messages(conversation_id, iter_ndjson(request.stream()))
+        return importer.result()
+    except BulkImportError as e:
+        raise HTTPException(status_code=400, detail=f"{e} ({importer.messages} messages imported)")
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if importer.messages:
+            compactor.notify(conversation_id)
+            # 不逐条推送消息，由客户端按需增量同步
+            hub.publish(
+                {"type": "messages.imported", "conversation_id": conversation_id,
+                 "count": importer.messages},
+                conversation_id
+            )
+            updated_conversation = await db.get_conversation(conversation_id)
+            if updated_conversation:
+                hub.publish({"type": "conversation.updated", "conversation": updated_conversation})
+
+@app.post("/api/import", response_model=BulkImportResult)
+async def import_conversations(request: Request):
+    """导入整批对话：请求体为 NDJSON，conversation 行之后跟随其 message 行（格式见 bulk.py）
+
+    出错时已导入的对话和消息会保留，返回 400 并说明已导入的数量。
+    """
+    importer = BulkImporter(db)
+    try:
+        await importer.import_records(iter_ndjson(request.stream()))
+        return importer.result()
+    except BulkImportError as e:
+        raise HTTPException(
+            status_code=400,
+            detail=f"{e} ({len(importer.created_ids)} conversations, "
+                   f"{importer.messages} messages imported)"
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        # 导入的对话可能很多，通知客户端整体重新同步
+        if importer.created_ids:
+            hub.publish(RESYNC_EVENT)
+        for conversation_id in importer.touched_ids:
+            compactor.notify(conversation_id)
+
+@app.get("/api/export")
+async def export_conversations(gzip: bool = Query(False, description="使用 gzip 压缩")):
+    """流式导出全部对话和消息（NDJSON，可用 /api/import 导入），数据库在一致的快照上逐批读取"""
+    filename = "conversations.ndjson.gz" if gzip else "conversations.ndjson"
+    return StreamingResponse(
+        # 同步生成器由 StreamingResponse 放到线程池中推进，数据库读取和压缩不阻塞事件循环
+        iter_export(db.database, gzip),
+        media_type="application/gzip" if gzip else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+@app.websocket("/api/ws")
+async def websocket_events(websocket: WebSocket):
+    """实时事件推送；客户端发送 {"action": "subscribe"/"unsubscribe", "conversation_id": id} 关注对话消息"""
+    await websocket.accept()
+    subscriber = hub.subscribe()
+    
+    async def send_events():
+        while True:
+            event = await subscriber.get()
+            # 客户端长时间不读取时发送会卡住，超时后断开连接
+            await asyncio.wait_for(websocket.send_json(event), WEBSOCKET_SEND_TIMEOUT)
+    
+    sender = asyncio.create_task(send_events())
+    receiver = asyncio.create_task(receive_subscriptions(websocket, subscriber))
+    try:
+        # 任一方向结束（断开、超时、协议错误）都关闭连接
+        done, _ = await asyncio.wait({sender, receiver}, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if not task.cancelled() and isinstance(task.exception(), asyncio.TimeoutError):
+                await websocket.close(code=1008)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        hub.unsubscribe(subscriber)
+        sender.cancel()
+        receiver.cancel()
+
+async def receive_subscriptions(websocket: WebSocket, subscriber):
+    """处理客户端的订阅请求，直到连接断开"""
+    while True:
+        try:
+            request = await websocket.receive_json()
+            action = request.get("action")
+            conversation_id = int(request["conversation_id"])
+        except WebSocketDisconnect:
+            return
+        except (ValueError, KeyError, TypeError, AttributeError):
+            continue
+        if action == "subscribe":
+            subscriber.conversation_ids.add(conversation_id)
+        elif action == "unsubscribe":
+            subscriber.conversation_ids.discard(conversation_id)
+
+@app.get("/api/cache/stats")
+async def get_cache_stats():
+    """查询缓存的命中统计"""
+    return db.cache_stats()
+
+@app.get("/api/llm/stats")
+async def get_llm_stats():
+    """查询模型调用的排队和并发情况"""
+    return scheduler.stats()
+
+@app.get("/api/llm/cache/stats")
+async def get_response_cache_stats():
+    """查询回复缓存的命中统计"""
+    return response_cache.stats()
+
+@app.get("/api/compaction/stats")
+async def get_compaction_stats():
+    """查询后台摘要任务的状态"""
+    return compactor.stats()
+
+@app.get("/api/search", response_model=SearchResponse)
+async def search(
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+):
+    """全文检索对话标题和消息内容"""
+    try:
+        # 多取一条用于判断是否还有下一页
+        results = await db.search(q, limit + 1, offset)
+        return SearchResponse(query=q, results=results[:limit], has_more=len(results) > limit)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+def sse_event(event: str, data) -> str:
+    """格式化一条 Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.post("/api/conversations/{conversation_id}/completions")
+async def create_completion(conversation_id: int, request: CompletionRequest):
+    """流式生成助手回复（Server-Sent Events）"""
+    # 先追加用户消息（同时完成对话存在性检查）
+    user_message = None
+    if request.content:
+        user_message = await db.add_message(conversation_id, "user", request.content)
+        if not user_message:
+            raise HTTPException(status_code=404, detail="Conversation not found")
+        publish_message_created(conversation_id, user_message)
+    elif not await db.get_conversation(conversation_id):
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    
+    # 已压缩的部分用摘要代替，其后只取预算内最新的消息（token 数在写入时已算好）
+    summary = await db.get_summary(conversation_id)
+    budget = prompt_budget(request.max_tokens)
+    prompt = []
+    after_id = 0
+    if summary:
+        prompt.append({"role": "system", "content": f"此前对话的摘要：\n{summary['content']}"})
+        budget = max(budget - summary["token_count"], 0)
+        after_id = summary["end_message_id"]
+    history = await db.get_context_messages(conversation_id, budget, after_id)
+    prompt.extend({"role": msg["role"], "content": msg["content"]} for msg in history)
+    
+    async def event_stream():
+        if user_message:
+            yield sse_event("message", user_message)
+        
+        parts = []
+        try:
+            async for token in llm.stream_chat(prompt, request.temperature, request.max_tokens,
+                                               conversation_id=conversation_id):
+                parts.append(token)
+                yield sse_event("token", {"content": token})
+        except Exception as e:
+            yield sse_event("error", {"detail": str(e)})
+            return
+        
+        # 生成完成后保存完整的助手回复
+        assistant_message = await db.add_message(conversation_id, "assistant", "".join(parts))
+        if assistant_message:
+            publish_message_created(conversation_id, assistant_message)
+            compactor.notify(conversation_id)
+        yield sse_event("done", assistant_message)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 @app.post("/api/upload", response_model=FileUploadResponse)
 async def upload_file(file: UploadFile = File(...)):
     """上传文件"""
     try:
-        # 检查文件大小（10MB限制）
-        MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
-        
-        # 读取文件内容以检查大小
-        file_content = await file.read()
-        file_size = len(file_content)
+        # 已知大小时直接拒绝超限文件（10MB限制）
+        if file.size is not None and file.size > MAX_FILE_SIZE:
+            raise HTTPException(status_code=413, detail="File size exceeds 10MB limit")
         
-        if file_size > MAX_FILE_SIZE:
+        # 分块写入临时文件，同时计算内容哈希，写入过程中检查大小
+        try:
+            temp_path, file_size, sha256 = await stream_upload_to_temp(
+                file, UPLOAD_DIR, MAX_FILE_SIZE
+            )
+        except UploadTooLargeError:
             raise HTTPException(status_code=413, detail="File size exceeds 10MB limit")
         
-        # 生成唯一文件名
-        file_extension = os.path.splitext(file.filename)[1] if file.filename else ""
-        unique_filename = f"{uuid.uuid4()}{file_extension}"
-        file_path = os.path.join(UPLOAD_DIR, unique_filename)
+        # 按内容哈希存放，相同内容的文件只保存一份
+        stored_filename = blob_name(sha256)
+        file_path = os.path.join(UPLOAD_DIR, stored_filename)
         
-        # 保存文件
-        with open(file_path, "wb") as f:
-            f.write(file_content)
+        # 先登记引用再放置文件，保证垃圾回收不会删除正在使用的内容
+        try:
+            file_id = await db.save_file(
+                filename=stored_filename,
+                original_filename=file.filename or "unknown",
+                file_path=file_path,
+                file_size=file_size,
+                sha256=sha256
+            )
+        except Exception:
+            await run_in_threadpool(remove_quietly, temp_path)
+            raise
+        await run_in_threadpool(place_blob, temp_path, file_path)
         
-        # 保存文件信息到数据库
-        file_id = db.save_file(
-            filename=unique_filename,
-            original_filename=file.filename or "unknown",
-            file_path=file_path,
-            file_size=file_size
-        )
+        # 文件就位后加入知识库导入队列
+        await ingestor.submit(file_id)
         
         return FileUploadResponse(
             id=file_id,
-            filename=unique_filename,
+            filename=stored_filename,
             original_filename=file.filename or "unknown",
             file_size=file_size,
             message="File uploaded successfully"
@@ -182,6 +576,247 @@ async def upload_file(file: UploadFile = File(...)):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.delete("/api/files/{file_id}")
+async def delete_file(file_id: int):
+    """删除文件引用，没有引用的内容会被回收"""
+    try:
+        success = await db.delete_file(file_id)
+        if not success:
+            raise HTTPException(status_code=404, detail="File not found")
+        
+        await db.delete_unreferenced_blobs()
+        return {"message": "File deleted successfully"}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/files/{file_id}/ingest", response_model=IngestionStatus)
+async def ingest_file(file_id: int):
+    """重新导入文件到知识库"""
+    try:
+        if not await ingestor.submit(file_id):
+            raise HTTPException(status_code=404, detail="File not found")
+        return await db.get_ingestion(file_id)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/files/{file_id}/ingestion", response_model=IngestionStatus)
+async def get_file_ingestion(file_id: int):
+    """获取文件的知识库导入进度"""
+    try:
+        ingestion = await db.get_ingestion(file_id)
+        if not ingestion:
+            raise HTTPException(status_code=404, detail="Ingestion not found")
+        return ingestion
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/files/{file_id}/chunks", response_model=List[FileChunk])
+async def get_file_chunks(
+    file_id: int,
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+    offset: int = Query(0, ge=0, description="起始块序号")
+):
+    """按顺序获取文件的文本块"""
+    try:
+        if not await db.get_ingestion(file_id):
+            raise HTTPException(status_code=404, detail="Ingestion not found")
+        return await db.get_file_chunks(file_id, limit, offset)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/kb/stats")
+async def get_ingestion_stats():
+    """知识库统计：各导入状态的文件数、进程池状态和向量索引状态"""
+    return {"files": await db.get_ingestion_counts(), **ingestor.stats(),
+            "vectors": knowledge_base.stats()}
+
+@app.get("/api/kb/search", response_model=KnowledgeSearchResponse)
+async def search_knowledge_base(
+    q: str = Query(..., min_length=1, max_length=1000),
+    limit: int = Query(10, ge=1, le=100)
+):
+    """按语义相似度检索上传文件的文本块"""
+    try:
+        if not knowledge_base.available:
+            raise HTTPException(status_code=503, detail="Knowledge-base search requires numpy")
+        results = await knowledge_base.search(q, limit)
+        return {"query": q, "results": results}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+def require_profiler(request: Request) -> Profiler:
+    """剖析管理接口：未开启时返回 404；请求头须带上 PROFILE_TOKEN，未设置时一律拒绝"""
+    if profiler is None:
+        raise HTTPException(status_code=404, detail="Profiling is disabled")
+    if not profiler.token:
+        raise HTTPException(status_code=403, detail="PROFILE_TOKEN is not set")
+    if not profiler.authorized(request.headers.get(profiler.header.decode("latin-1"))):
+        raise HTTPException(status_code=403, detail="Invalid profiling token")
+    return profiler
+
+@app.get("/api/admin/profiles")
+async def list_profiles(
+    order: str = Query("slowest", pattern="^(slowest|recent)$"),
+    profiler: Profiler = Depends(require_profiler)
+):
+    """列出保留的剖析记录（按耗时从慢到快，或按时间从新到旧），只含耗时分解"""
+    return {**profiler.stats(), "profiles": [trace.summary() for trace in profiler.traces(order)]}
+
+@app.get("/api/admin/profiles/{profile_id}")
+async def get_profile(profile_id: int, profiler: Profiler = Depends(require_profiler)):
+    """获取剖析记录详情：各数据库方法的耗时、采样最多的函数和折叠格式的调用栈"""
+    trace = profiler.get(profile_id)
+    if trace is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return trace.detail()
+
+@app.delete("/api/admin/profiles")
+async def clear_profiles(profiler: Profiler = Depends(require_profiler)):
+    """清空保留的剖析记录"""
+    profiler.clear()
+    return {"message": "Profiles cleared"}
+
+@app.post("/api/uploads", response_model=UploadSession)
+async def create_upload_session(upload: UploadSessionCreate):
+    """创建分块上传会话"""
+    try:
+        if upload.file_size < 0:
+            raise HTTPException(status_code=400, detail="Invalid file size")
+        if upload.file_size > RESUMABLE_MAX_FILE_SIZE:
+            raise HTTPException(status_code=413, detail="File size exceeds upload limit")
+        
+        chunk_size = upload.chunk_size or DEFAULT_CHUNK_SIZE
+        if not MIN_CHUNK_SIZE <= chunk_size <= MAX_CHUNK_SIZE:
+            raise HTTPException(status_code=400, detail="Invalid chunk size")
+        
+        # 顺带清理过期的会话
+        for temp_path in await db.delete_expired_upload_sessions(UPLOAD_SESSION_TTL):
+            await run_in_threadpool(remove_quietly, temp_path)
+        
+        upload_id = uuid.uuid4().hex
+        temp_path = os.path.join(UPLOAD_DIR, f".upload-{upload_id}.part")
+        await run_in_threadpool(preallocate, temp_path, upload.file_size)
+        
+        return await db.create_upload_session(
+            upload_id, upload.filename, upload.file_size, chunk_size, temp_path
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/uploads/{upload_id}", response_model=UploadSession)
+async def get_upload_session(upload_id: str):
+    """查询上传进度，客户端断线后据此续传缺失的分块"""
+    try:
+        session = await db.get_upload_session(upload_id)
+        if not session:
+            raise HTTPException(status_code=404, detail="Upload session not found")
+        return session
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.put("/api/uploads/{upload_id}/chunks/{offset}", response_model=UploadSession)
+async def upload_chunk(upload_id: str, offset: int, request: Request):
+    """按偏移写入一个分块，分块之间可以并行上传"""
+    try:
+        session = await db.get_upload_session(upload_id)
+        if not session:
+            raise HTTPException(status_code=404, detail="Upload session not found")
+        
+        chunk_size = session["chunk_size"]
+        if offset < 0 or offset >= session["file_size"] or offset % chunk_size != 0:
+            raise HTTPException(status_code=400, detail="Invalid chunk offset")
+        length = min(chunk_size, session["file_size"] - offset)
+        
+        # 请求体直接流式写入文件对应位置，不在内存中缓存整个分块
+        try:
+            await write_stream_at(request.stream(), session["temp_path"], offset, length)
+        except InvalidChunkError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        
+        if not await db.mark_chunk_received(upload_id, offset // chunk_size):
+            raise HTTPException(status_code=404, detail="Upload session not found")
+        return await db.get_upload_session(upload_id)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/uploads/{upload_id}/complete", response_model=FileUploadResponse)
+async def complete_upload_session(upload_id: str):
+    """所有分块到齐后合并为文件"""
+    try:
+        session = await db.get_upload_session(upload_id)
+        if not session:
+            raise HTTPException(status_code=404, detail="Upload session not found")
+        
+        missing = set(range(session["total_chunks"])) - set(session["received_chunks"])
+        if missing:
+            raise HTTPException(status_code=409, detail=f"Missing chunks: {sorted(missing)}")
+        
+        # 先删除会话，防止重复完成
+        temp_path = await db.delete_upload_session(upload_id)
+        if not temp_path:
+            raise HTTPException(status_code=404, detail="Upload session not found")
+        
+        try:
+            sha256 = await run_in_threadpool(hash_file, temp_path)
+            stored_filename = blob_name(sha256)
+            file_path = os.path.join(UPLOAD_DIR, stored_filename)
+            file_id = await db.save_file(
+                filename=stored_filename,
+                original_filename=session["filename"],
+                file_path=file_path,
+                file_size=session["file_size"],
+                sha256=sha256
+            )
+        except Exception:
+            await run_in_threadpool(remove_quietly, temp_path)
+            raise
+        await run_in_threadpool(place_blob, temp_path, file_path)
+        
+        # 文件就位后加入知识库导入队列
+        await ingestor.submit(file_id)
+        
+        return FileUploadResponse(
+            id=file_id,
+            filename=stored_filename,
+            original_filename=session["filename"],
+            file_size=session["file_size"],
+            message="File uploaded successfully"
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.delete("/api/uploads/{upload_id}")
+async def abort_upload_session(upload_id: str):
+    """取消上传会话并删除已接收的数据"""
+    try:
+        temp_path = await db.delete_upload_session(upload_id)
+        if not temp_path:
+            raise HTTPException(status_code=404, detail="Upload session not found")
+        await run_in_threadpool(remove_quietly, temp_path)
+        return {"message": "Upload aborted"}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
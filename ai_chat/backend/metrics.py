@@ -0,0 +1,267 @@
+"""
+运行指标：计数器、仪表和直方图，以 Prometheus 文本格式在 /metrics 输出
+
+只依赖标准库。记录一次指标只是一次加锁的字典更新，汇总和格式化都在抓取时进行，
+请求路径上的开销在微秒级。HTTP 指标按路由模板（如 /api/conversations/{conversation_id}）
+而不是实际路径分组，避免标签数量随 id 增长。
+"""
+import bisect
+import math
+import re
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4"  # 响应会自动补上 charset=utf-8
+
+# 直方图分桶（上界）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+DB_LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+THROUGHPUT_BUCKETS = tuple(float(2 ** n) for n in range(16, 31, 2))  # 64KB/s ~ 1GB/s
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(pairs: Sequence[Tuple[str, str]]) -> str:
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Registry:
+    """已注册的指标，抓取时依次输出"""
+
+    def __init__(self):
+        self.metrics: List["Metric"] = []
+
+    def register(self, metric: "Metric"):
+        self.metrics.append(metric)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class Metric:
+    """指标基类：按标签值元组分别记录，标签值按 labelnames 的顺序作为位置参数传入"""
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 registry: Registry = REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[tuple, object] = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _pairs(self, labels: tuple, *extra: Tuple[str, str]) -> List[Tuple[str, str]]:
+        return list(zip(self.labelnames, labels)) + list(extra)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self._pairs(labels))} {_format_value(value)}"
+                for labels, value in values]
+
+
+class Counter(Metric):
+    """只增不减的累计值"""
+    type = "counter"
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+
+class Gauge(Metric):
+    """可增可减的当前值"""
+    type = "gauge"
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def dec(self, *labels: str, amount: float = 1.0):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value: float, *labels: str):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    """分桶计数：记录时只累加所在的桶，输出时再换算为累计计数"""
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS, registry: Registry = REGISTRY):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels: str):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = sorted((labels, ([*state[0]], state[1], state[2]))
+                            for labels, state in self._values.items())
+        lines = []
+        for labels, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                pairs = self._pairs(labels, ("le", _format_value(bound)))
+                lines.append(f"{self.name}_bucket{_format_labels(pairs)} {cumulative}")
+            label_text = _format_labels(self._pairs(labels))
+            lines.append(f"{self.name}_sum{label_text} {_format_value(total)}")
+            lines.append(f"{self.name}_count{label_text} {count}")
+        return lines
+
+
+# HTTP
+HTTP_REQUESTS = Counter("http_requests_total", "HTTP requests by route template and status",
+                        ("method", "route", "status"))
+HTTP_IN_FLIGHT = Gauge("http_requests_in_flight", "HTTP requests currently being handled",
+                       ("method", "route"))
+HTTP_DURATION = Histogram("http_request_duration_seconds",
+                          "HTTP request latency, including streamed response bodies",
+                          ("method", "route"))
+
+# 数据库
+DB_DURATION = Histogram("db_query_duration_seconds", "Database method latency, including lock retries",
+                        ("operation",), buckets=DB_LATENCY_BUCKETS)
+DB_ERRORS = Counter("db_query_errors_total", "Database method calls that raised", ("operation",))
+
+# 上传
+UPLOAD_BYTES = Counter("upload_bytes_total", "Bytes received by upload endpoints", ("kind",))
+UPLOAD_THROUGHPUT = Histogram("upload_throughput_bytes_per_second",
+                              "Per-request upload throughput", ("kind",),
+                              buckets=THROUGHPUT_BUCKETS)
+
+
+UNMATCHED_ROUTE = "unmatched"
+_NAMED_GROUP = re.compile(r"\(\?P<\w+>")
+
+
+class RouteResolver:
+    """按路由表解析请求的路由模板，不依赖路由匹配的结果，请求开始时即可使用
+
+    各路由的路径正则合并为一个，一次匹配找到第一个路径相符的路由；它不接受该请求方法时
+    按 Starlette 的规则逐个检查，方法和路径都相符的路由优先于只有路径相符的路由。
+    """
+
+    def __init__(self, routes: Sequence):
+        self.size = len(routes)
+        # WebSocket 路由（有 endpoint 而没有 methods）不处理 HTTP 请求
+        routes = [route for route in routes
+                  if getattr(route, "methods", None) is not None or not hasattr(route, "endpoint")]
+        self._routes = [(route.path_regex.match, getattr(route, "methods", None), route.path)
+                        for route in routes]
+        # 路径正则相同的路由（同一路径的不同方法）合为一组，接受的方法取并集，None 表示接受任何方法
+        self._groups: List[Tuple[Optional[set], str]] = []
+        patterns: Dict[str, int] = {}
+        alternatives = []
+        for route in routes:
+            pattern = route.path_regex.pattern
+            methods = getattr(route, "methods", None)
+            index = patterns.get(pattern)
+            if index is None:
+                patterns[pattern] = len(self._groups)
+                # 各路由正则的命名分组会重名，合并时改为不命名的分组
+                alternatives.append(f"(?P<r{len(self._groups)}>{_NAMED_GROUP.sub('(?:', pattern)})")
+                self._groups.append((None if methods is None else set(methods), route.path))
+            else:
+                accepted, template = self._groups[index]
+                if accepted is not None:
+                    self._groups[index] = (None if methods is None else accepted | methods, template)
+        self._match = re.compile("|".join(alternatives)).match if alternatives else None
+
+    def resolve(self, method: str, path: str) -> str:
+        found = self._match(path) if self._match else None
+        if found is None:
+            return UNMATCHED_ROUTE
+        methods, template = self._groups[int(found.lastgroup[1:])]
+        if methods is None or method in methods:
+            return template
+        for match, methods, candidate in self._routes:
+            if (methods is None or method in methods) and match(path):
+                return candidate
+        return template
+
+
+_resolvers: Dict[int, RouteResolver] = {}
+
+
+def route_template(scope) -> str:
+    """请求对应的路由模板（如 /api/conversations/{conversation_id}），没有匹配的路由时为 unmatched"""
+    routes = scope["app"].router.routes
+    resolver = _resolvers.get(id(routes))
+    if resolver is None or resolver.size != len(routes):
+        resolver = _resolvers[id(routes)] = RouteResolver(routes)
+    return resolver.resolve(scope["method"], scope["path"])
+
+
+def observe_upload(kind: str, size: int, seconds: float):
+    UPLOAD_BYTES.inc(kind, amount=size)
+    if size and seconds > 0:
+        UPLOAD_THROUGHPUT.observe(size / seconds, kind)
+
+
+class MetricsMiddleware:
+    """ASGI 中间件：记录 HTTP 请求数、处理中的请求数和耗时
+
+    直接实现 ASGI 接口而不是继承 BaseHTTPMiddleware，不缓冲流式响应，开销更小。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        route = route_template(scope)
+        status = 500  # 应用抛出异常、没有发送响应头时按 500 计
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc(method, route)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            HTTP_IN_FLIGHT.dec(method, route)
+            HTTP_REQUESTS.inc(method, route, str(status))
+            HTTP_DURATION.observe(elapsed, method, route)
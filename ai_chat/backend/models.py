@@ -24,16 +24,89 @@ class Message(BaseModel):
     content: str
     created_at: str
 
+class ConversationSummary(BaseModel):
+    id: int
+    end_message_id: int  # 摘要覆盖到的最后一条消息（含）
+    content: str
+    created_at: str
+
 class ConversationWithMessages(BaseModel):
     id: int
     title: str
     created_at: str
     updated_at: str
     messages: List[Message]
+    summary: Optional[ConversationSummary] = None  # 仅 compact 模式：messages 为摘要之后的消息
 
 class FileUploadResponse(BaseModel):
     id: int
     filename: str
     original_filename: str
     file_size: int
-    message: str
\ No newline at end of file
+    message: str
+
+class CompletionRequest(BaseModel):
+    content: Optional[str] = None  # 新的用户消息，为空时直接基于已有历史生成
+    temperature: float = 0.7
+    max_tokens: Optional[int] = None
+
+class UploadSessionCreate(BaseModel):
+    filename: str
+    file_size: int
+    chunk_size: Optional[int] = None
+
+class UploadSession(BaseModel):
+    id: str
+    filename: str
+    file_size: int
+    chunk_size: int
+    total_chunks: int
+    received_chunks: List[int]
+
+class SearchHit(BaseModel):
+    type: str  # "conversation" or "message"
+    conversation_id: int
+    conversation_title: str
+    message_id: Optional[int] = None
+    role: Optional[str] = None
+    snippet: str  # HTML 转义后的片段，命中部分用 <mark> 标记
+    created_at: str
+
+class SearchResponse(BaseModel):
+    query: str
+    results: List[SearchHit]
+    has_more: bool
+
+class BulkImportResult(BaseModel):
+    conversations: int  # 新建的对话数
+    messages: int       # 写入的消息数
+
+class IngestionStatus(BaseModel):
+    file_id: int
+    status: str  # pending / extracting / storing / done / failed
+    char_count: Optional[int] = None
+    chunk_count: Optional[int] = None
+    error: Optional[str] = None
+    created_at: str
+    updated_at: str
+
+class FileChunk(BaseModel):
+    id: int
+    chunk_index: int
+    start_offset: int  # 在抽取出的全文中的字符偏移
+    end_offset: int
+    content: str
+
+class KnowledgeHit(BaseModel):
+    chunk_id: int
+    file_id: int
+    filename: str
+    chunk_index: int
+    start_offset: int
+    end_offset: int
+    content: str
+    score: float  # 与查询的余弦相似度
+
+class KnowledgeSearchResponse(BaseModel):
+    query: str
+    results: List[KnowledgeHit]
@@ -0,0 +1,335 @@
+"""
+请求级性能剖析：按比例抽样（或带调试请求头）的请求记录调用栈采样和耗时分解，保留最慢的若干条
+
+只依赖标准库，数据库层可以直接导入埋点。默认关闭，关闭时不安装中间件，
+数据库等处的埋点只剩一次 ContextVar 读取。开启后：
+  - 调用栈：后台线程每隔几毫秒采样所有线程的调用栈（跳过空闲等待），按折叠格式计数，
+    可直接生成火焰图。异步请求共用事件循环线程，同时在处理的其他请求也会出现在采样中。
+  - 耗时分解：数据库方法（sql）、响应 JSON 序列化（serialization，由应用的默认响应类记录）、
+    读取请求体和发送响应以及上传文件落盘（io），其余计为 other。
+"""
+import contextvars
+import heapq
+import hmac
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from metrics import route_template
+
+PROFILE_ENABLED = os.environ.get("PROFILE_ENABLED", "0") == "1"
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0.0))   # 抽样比例，0~1
+PROFILE_HEADER = os.environ.get("PROFILE_HEADER", "X-Debug-Profile")
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN", "")   # 请求头和管理接口都要带上它，未设置时只能按比例抽样
+PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", 20))                     # 保留最慢的记录数
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL_MS", 5)) / 1000  # 调用栈采样间隔
+
+MAX_STACK_DEPTH = 64
+TOP_STACKS = 200       # 每条记录保留的调用栈数
+TOP_FUNCTIONS = 20
+ADMIN_PATH = "/api/admin/profiles"  # 查看剖析记录的请求本身不剖析
+
+# 栈顶是这些函数时线程处于空闲等待，不计入采样
+_IDLE_FRAMES = {
+    ("selectors.py", "select"),
+    ("threading.py", "wait"),
+    ("queue.py", "get"),
+    ("thread.py", "_worker"),
+}
+
+_current_trace: contextvars.ContextVar[Optional["Trace"]] = contextvars.ContextVar(
+    "profile_trace", default=None
+)
+
+
+def active() -> bool:
+    """当前请求是否正在被剖析"""
+    return _current_trace.get() is not None
+
+
+def record(category: str, seconds: float, operation: Optional[str] = None):
+    """把一段耗时计入当前请求的剖析记录；没有在剖析时什么都不做"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(category, seconds, operation)
+
+
+class span:
+    """计时上下文：with span("io"): ...，耗时计入当前请求"""
+    __slots__ = ("category", "trace", "started")
+
+    def __init__(self, category: str):
+        self.category = category
+
+    def __enter__(self):
+        self.trace = _current_trace.get()
+        if self.trace is not None:
+            self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.trace is not None:
+            self.trace.add(self.category, time.perf_counter() - self.started)
+
+
+class Trace:
+    """一次被剖析的请求"""
+
+    def __init__(self, trace_id: int, method: str, path: str, trigger: str):
+        self.id = trace_id
+        self.method = method
+        self.path = path
+        self.trigger = trigger  # "sample" 或 "header"
+        self.route = ""
+        self.status = 0
+        self.started_at = datetime.now().isoformat(timespec="milliseconds")
+        self.duration = 0.0
+        self.totals: Dict[str, float] = {"sql": 0.0, "serialization": 0.0, "io": 0.0}
+        self.sql_operations: Dict[str, List] = {}   # 方法名 -> [调用次数, 耗时]
+        self.stacks: Dict[str, int] = {}            # 折叠的调用栈 -> 采样次数
+        self.samples = 0
+        self._lock = threading.Lock()  # 数据库埋点在线程池中调用
+
+    def add(self, category: str, seconds: float, operation: Optional[str] = None):
+        with self._lock:
+            self.totals[category] = self.totals.get(category, 0.0) + seconds
+            if operation is not None:
+                entry = self.sql_operations.setdefault(operation, [0, 0.0])
+                entry[0] += 1
+                entry[1] += seconds
+
+    def add_sample(self, stack: str):
+        with self._lock:
+            self.samples += 1
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def summary(self) -> Dict:
+        breakdown = {f"{name}_ms": round(value * 1000, 3) for name, value in self.totals.items()}
+        # 数据库调用可能并发执行，其余时间不小于 0
+        breakdown["other_ms"] = round(max(self.duration - sum(self.totals.values()), 0.0) * 1000, 3)
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "route": self.route,
+            "status": self.status,
+            "trigger": self.trigger,
+            "started_at": self.started_at,
+            "duration_ms": round(self.duration * 1000, 3),
+            "breakdown": breakdown,
+            "sql_calls": sum(count for count, _ in self.sql_operations.values()),
+            "samples": self.samples,
+        }
+
+    def detail(self) -> Dict:
+        with self._lock:
+            stacks = sorted(self.stacks.items(), key=lambda item: -item[1])
+            sql_operations = dict(self.sql_operations)
+        # 每个栈的最后一帧即采样时正在执行的函数
+        self_time: Dict[str, int] = {}
+        for stack, count in stacks:
+            leaf = stack.rsplit(";", 1)[-1]
+            self_time[leaf] = self_time.get(leaf, 0) + count
+        return {
+            **self.summary(),
+            "sql_operations": {
+                name: {"calls": count, "ms": round(seconds * 1000, 3)}
+                for name, (count, seconds) in sorted(sql_operations.items(), key=lambda item: -item[1][1])
+            },
+            "top_functions": [
+                {"function": name, "samples": count}
+                for name, count in sorted(self_time.items(), key=lambda item: -item[1])[:TOP_FUNCTIONS]
+            ],
+            "stacks": [{"stack": stack, "samples": count} for stack, count in stacks[:TOP_STACKS]],
+        }
+
+
+def _thread_label(thread_id: int, names: Dict[int, str]) -> str:
+    # 线程池的线程按池归并，如 db_3 -> db、ThreadPoolExecutor-0_1 -> ThreadPoolExecutor-0
+    name = names.get(thread_id, str(thread_id))
+    prefix, _, index = name.rpartition("_")
+    return prefix if prefix and index.isdigit() else name
+
+
+def _collapse(frame, label: str) -> Optional[str]:
+    """折叠调用栈为 "线程;文件:函数;..."（从外到内）；空闲等待时返回 None"""
+    code = frame.f_code
+    if (os.path.basename(code.co_filename), code.co_name) in _IDLE_FRAMES:
+        return None
+    names = []
+    while frame is not None and len(names) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    names.append(label)
+    return ";".join(reversed(names))
+
+
+class StackSampler:
+    """有剖析中的请求时运行的采样线程，每个样本记入所有进行中的记录"""
+
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = interval
+        self._traces = set()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def attach(self, trace: Trace):
+        with self._lock:
+            self._traces.add(trace)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+                self._thread.start()
+
+    def detach(self, trace: Trace):
+        with self._lock:
+            self._traces.discard(trace)
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while True:
+            with self._lock:
+                if not self._traces:
+                    self._thread = None
+                    return
+                traces = list(self._traces)
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = _collapse(frame, _thread_label(thread_id, names))
+                if stack is not None:
+                    for trace in traces:
+                        trace.add_sample(stack)
+            time.sleep(self.interval)
+
+
+class Profiler:
+    """剖析配置和记录存储：保留最慢的 keep 条，另保留最近的 keep 条"""
+
+    def __init__(self, sample_rate: float = PROFILE_SAMPLE_RATE, header: str = PROFILE_HEADER,
+                 token: str = PROFILE_TOKEN, keep: int = PROFILE_KEEP,
+                 interval: float = PROFILE_INTERVAL):
+        self.sample_rate = sample_rate
+        self.header = header.lower().encode("latin-1")
+        self.token = token
+        self.keep = keep
+        self.sampler = StackSampler(interval)
+        self._ids = itertools.count(1)
+        self._slowest: List[tuple] = []   # (耗时, id, 记录) 小顶堆
+        self._recent: deque = deque(maxlen=keep)
+        self._lock = threading.Lock()
+        self.profiled = 0
+
+    def authorized(self, value: Optional[str]) -> bool:
+        """请求头的值是否允许触发剖析或访问管理接口；未设置令牌时一律不允许"""
+        if not self.token or value is None:
+            return False
+        return hmac.compare_digest(value.encode("utf-8"), self.token.encode("utf-8"))
+
+    def trigger(self, scope) -> Optional[str]:
+        """决定是否剖析该请求，返回触发方式"""
+        if scope["path"].startswith(ADMIN_PATH):
+            return None
+        if self.sample_rate and random.random() < self.sample_rate:
+            return "sample"
+        for name, value in scope["headers"]:
+            if name == self.header:
+                return "header" if self.authorized(value.decode("latin-1")) else None
+        return None
+
+    def start(self, scope, trigger: str) -> Trace:
+        trace = Trace(next(self._ids), scope["method"], scope["path"], trigger)
+        self.sampler.attach(trace)
+        return trace
+
+    def finish(self, trace: Trace):
+        self.sampler.detach(trace)
+        with self._lock:
+            self.profiled += 1
+            self._recent.append(trace)
+            entry = (trace.duration, trace.id, trace)
+            if len(self._slowest) < self.keep:
+                heapq.heappush(self._slowest, entry)
+            elif entry > self._slowest[0]:
+                heapq.heapreplace(self._slowest, entry)
+
+    def traces(self, order: str = "slowest") -> List[Trace]:
+        with self._lock:
+            if order == "recent":
+                return list(reversed(self._recent))
+            return [trace for _, _, trace in sorted(self._slowest, reverse=True)]
+
+    def get(self, trace_id: int) -> Optional[Trace]:
+        with self._lock:
+            for trace in itertools.chain(self._recent, (entry[2] for entry in self._slowest)):
+                if trace.id == trace_id:
+                    return trace
+        return None
+
+    def clear(self):
+        with self._lock:
+            self._slowest.clear()
+            self._recent.clear()
+
+    def stats(self) -> Dict:
+        return {
+            "sample_rate": self.sample_rate,
+            "header": self.header.decode("latin-1"),
+            "profiled": self.profiled,
+            "kept": len(self._slowest),
+        }
+
+
+class ProfilingMiddleware:
+    """ASGI 中间件：被选中的请求在 ContextVar 中挂上剖析记录，并计时读取请求体和发送响应"""
+
+    def __init__(self, app, profiler: Profiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        trigger = self.profiler.trigger(scope)
+        if trigger is None:
+            await self.app(scope, receive, send)
+            return
+
+        trace = self.profiler.start(scope, trigger)
+
+        async def timed_receive():
+            started = time.perf_counter()
+            message = await receive()
+            trace.add("io", time.perf_counter() - started)
+            return message
+
+        async def timed_send(message):
+            if message["type"] == "http.response.start":
+                trace.status = message["status"]
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [
+                    (b"x-profile-id", str(trace.id).encode("latin-1"))
+                ]
+            started = time.perf_counter()
+            await send(message)
+            trace.add("io", time.perf_counter() - started)
+
+        token = _current_trace.set(trace)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, timed_receive, timed_send)
+        finally:
+            trace.duration = time.perf_counter() - started
+            _current_trace.reset(token)
+            trace.route = route_template(scope)
+            if not trace.status:
+                trace.status = 500
+            self.profiler.finish(trace)
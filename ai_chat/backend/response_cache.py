@@ -0,0 +1,185 @@
+"""
+模型回复缓存：确定性请求（temperature 为 0）按规范化后的提示词、模型和参数缓存完整回复
+
+两级存储：进程内 LRU 缓存，以及与 chat.db 同目录的 SQLite 文件（重启后仍有效）。
+两级都有过期时间和容量上限。命中时不经过排队和模型，直接按片段流式返回。
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from typing import AsyncIterator, Dict, List, Optional
+
+from starlette.concurrency import run_in_threadpool
+
+from cache import LRUCache, MISSING
+from llm import LLMProvider
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_CACHE_TTL = int(os.environ.get("RESPONSE_CACHE_TTL", 7 * 24 * 60 * 60))   # 默认7天
+RESPONSE_CACHE_MEMORY_SIZE = 256       # 内存中缓存的回复数
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", 10000))
+EVICT_INTERVAL = 100                   # 每写入多少条检查一次持久化缓存的容量
+
+# 命中时每个流式片段的字符数
+REPLAY_CHUNK_SIZE = 64
+
+
+def normalize_messages(messages: List[Dict]) -> List[Dict]:
+    """统一全角半角等 Unicode 写法并合并空白，使只有格式差异的提示词得到相同的键"""
+    return [
+        {
+            "role": message["role"].strip().lower(),
+            "content": " ".join(unicodedata.normalize("NFKC", message["content"]).split()),
+        }
+        for message in messages
+    ]
+
+
+def cache_key(messages: List[Dict], model: str, max_tokens: Optional[int]) -> str:
+    payload = json.dumps([normalize_messages(messages), model, max_tokens],
+                         ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """内存 + SQLite 两级回复缓存，统计命中率"""
+
+    def __init__(self, path: str, ttl: float = RESPONSE_CACHE_TTL,
+                 memory_size: int = RESPONSE_CACHE_MEMORY_SIZE,
+                 max_entries: int = RESPONSE_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.memory = LRUCache(memory_size, ttl)
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self._writes_since_evict = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.execute("PRAGMA synchronous = NORMAL")
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_used_at REAL NOT NULL
+            )
+        ''')
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_used ON responses (last_used_at)")
+        self._evict()
+
+    def _load(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response FROM responses WHERE key = ? AND created_at > ?",
+                (key, now - self.ttl)
+            ).fetchone()
+            if row is not None:
+                self._conn.execute("UPDATE responses SET last_used_at = ? WHERE key = ?", (now, key))
+        return row[0] if row else None
+
+    def _save(self, key: str, response: str):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, created_at, last_used_at) "
+                "VALUES (?, ?, ?, ?)",
+                (key, response, now, now)
+            )
+            self._writes_since_evict += 1
+            if self._writes_since_evict < EVICT_INTERVAL:
+                return
+        self._evict()
+
+    def _evict(self):
+        """删除过期的条目，超出容量时删除最久未使用的条目"""
+        with self._lock:
+            self._writes_since_evict = 0
+            self._conn.execute("DELETE FROM responses WHERE created_at <= ?", (time.time() - self.ttl,))
+            count = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute('''
+                    DELETE FROM responses WHERE key IN (
+                        SELECT key FROM responses ORDER BY last_used_at LIMIT ?
+                    )
+                ''', (count - self.max_entries,))
+
+    async def get(self, key: str) -> Optional[str]:
+        response = self.memory.get(key)
+        if response is not MISSING:
+            self.memory_hits += 1
+            return response
+        response = await run_in_threadpool(self._load, key)
+        if response is None:
+            self.misses += 1
+            return None
+        self.disk_hits += 1
+        self.memory.set(key, response)
+        return response
+
+    async def set(self, key: str, response: str):
+        self.memory.set(key, response)
+        self.stores += 1
+        try:
+            await run_in_threadpool(self._save, key, response)
+        except sqlite3.Error:
+            # 持久化失败不影响本次回复，内存中的条目仍然有效
+            logger.exception("Failed to persist cached response")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def stats(self) -> Dict:
+        hits = self.memory_hits + self.disk_hits
+        total = hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "stores": self.stores,
+            "hit_rate": hits / total if total else 0.0,
+            "memory_size": len(self.memory),
+        }
+
+
+class CachedProvider(LLMProvider):
+    """在模型提供方之前查缓存：只缓存 temperature 为 0 的完整回复，其他请求原样转发"""
+    name = "cached"
+
+    def __init__(self, provider: LLMProvider, cache: ResponseCache, model: str):
+        self.provider = provider
+        self.cache = cache
+        self.model = model  # 参与缓存键，切换模型后不会命中旧回复
+
+    async def stream_chat(self, messages: List[Dict], temperature: float = 0.7,
+                          max_tokens: Optional[int] = None, **kwargs) -> AsyncIterator[str]:
+        if temperature != 0:
+            async for token in self.provider.stream_chat(messages, temperature, max_tokens, **kwargs):
+                yield token
+            return
+
+        key = cache_key(messages, self.model, max_tokens)
+        cached = await self.cache.get(key)
+        if cached is not None:
+            for i in range(0, len(cached), REPLAY_CHUNK_SIZE):
+                yield cached[i:i + REPLAY_CHUNK_SIZE]
+            return
+
+        # 只有完整生成的回复才写入缓存，中途出错或客户端断开时不缓存
+        parts = []
+        async for token in self.provider.stream_chat(messages, temperature, max_tokens, **kwargs):
+            parts.append(token)
+            yield token
+        if parts:
+            await self.cache.set(key, "".join(parts))
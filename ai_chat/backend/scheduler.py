@@ -0,0 +1,239 @@
+"""
+模型调用调度：限制全局和单个对话的并发数，排队请求按优先级放行，相同的进行中请求合并为一次调用
+
+调度器本身也是 LLMProvider，可以直接替换原来的模型提供方。
+"""
+import asyncio
+import hashlib
+import heapq
+import itertools
+import json
+import time
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from llm import LLMProvider
+
+# 优先级：数值越小越先执行
+PRIORITY_INTERACTIVE = 0   # 用户正在等待的对话回复
+PRIORITY_BACKGROUND = 10   # 摘要等后台任务
+
+_END = object()
+
+
+class _Failure:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+class _Flight:
+    """一次进行中的模型调用：生成的片段依次分发给所有订阅者，后加入的订阅者先补发已生成的部分"""
+
+    def __init__(self):
+        self.tokens: List[str] = []
+        self.subscribers: List[asyncio.Queue] = []
+        self.finished = False
+        self.task: Optional[asyncio.Task] = None
+
+    def subscribe(self) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue()
+        for token in self.tokens:
+            queue.put_nowait(token)
+        self.subscribers.append(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.subscribers.remove(queue)
+
+    def publish(self, token: str):
+        self.tokens.append(token)
+        for queue in self.subscribers:
+            queue.put_nowait(token)
+
+    def finish(self, item=_END):
+        self.finished = True
+        for queue in self.subscribers:
+            queue.put_nowait(item)
+
+
+class LLMScheduler(LLMProvider):
+    """在模型提供方之前排队：最多 max_concurrency 个调用同时进行，每个对话最多 per_conversation 个"""
+    name = "scheduler"
+
+    def __init__(self, provider: LLMProvider, max_concurrency: int = 4, per_conversation: int = 1):
+        self.provider = provider
+        self.max_concurrency = max_concurrency
+        self.per_conversation = per_conversation
+
+        self._queue: List[Tuple[int, int, Optional[int], asyncio.Future]] = []  # (优先级, 序号, 对话, 放行信号)
+        self._seq = itertools.count()
+        self._running = 0
+        self._running_by_conversation: Dict[int, int] = {}
+        self._flights: Dict[str, _Flight] = {}
+
+        # 统计
+        self.submitted = 0
+        self.coalesced = 0
+        self.completed = 0
+        self.failed = 0
+        self.max_queue_depth = 0
+        self.waits = 0
+        self.total_wait = 0.0
+
+    def _can_run(self, conversation_id: Optional[int]) -> bool:
+        if self._running >= self.max_concurrency:
+            return False
+        return (conversation_id is None
+                or self._running_by_conversation.get(conversation_id, 0) < self.per_conversation)
+
+    def _start(self, conversation_id: Optional[int]):
+        self._running += 1
+        if conversation_id is not None:
+            self._running_by_conversation[conversation_id] = \
+                self._running_by_conversation.get(conversation_id, 0) + 1
+
+    def _release(self, conversation_id: Optional[int]):
+        self._running -= 1
+        if conversation_id is not None:
+            remaining = self._running_by_conversation[conversation_id] - 1
+            if remaining:
+                self._running_by_conversation[conversation_id] = remaining
+            else:
+                del self._running_by_conversation[conversation_id]
+        self._dispatch()
+
+    def _dispatch(self):
+        """按优先级放行排队的请求；所属对话已达上限的请求让后面的请求先走"""
+        blocked = []
+        while self._queue and self._running < self.max_concurrency:
+            entry = heapq.heappop(self._queue)
+            future = entry[3]
+            if future.done():  # 等待期间已取消
+                continue
+            if self._can_run(entry[2]):
+                self._start(entry[2])
+                future.set_result(None)
+            else:
+                blocked.append(entry)
+        for entry in blocked:
+            heapq.heappush(self._queue, entry)
+
+    async def _acquire(self, priority: int, conversation_id: Optional[int]):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._seq), conversation_id, future))
+        self._dispatch()
+        # 已取消的请求要等放行时才出队，只统计仍在等待的
+        self.max_queue_depth = max(self.max_queue_depth, sum(self.queue_depth().values()))
+
+        started = time.monotonic()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # 放行信号和取消同时发生时，归还已经占用的名额
+            if future.done() and not future.cancelled():
+                self._release(conversation_id)
+            raise
+        finally:
+            self.waits += 1
+            self.total_wait += time.monotonic() - started
+
+    @staticmethod
+    def _key(messages: List[Dict], temperature: float, max_tokens: Optional[int]) -> str:
+        payload = json.dumps([messages, temperature, max_tokens], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    async def _produce(self, key: str, flight: _Flight, messages: List[Dict], temperature: float,
+                       max_tokens: Optional[int], conversation_id: Optional[int], priority: int):
+        try:
+            await self._acquire(priority, conversation_id)
+            try:
+                async for token in self.provider.stream_chat(messages, temperature, max_tokens):
+                    flight.publish(token)
+            finally:
+                self._release(conversation_id)
+            self.completed += 1
+            flight.finish()
+        except asyncio.CancelledError:
+            flight.finish(_Failure(RuntimeError("LLM call cancelled")))
+            raise
+        except Exception as e:
+            self.failed += 1
+            flight.finish(_Failure(e))
+        finally:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    async def stream_chat(self, messages: List[Dict], temperature: float = 0.7,
+                          max_tokens: Optional[int] = None, *,
+                          conversation_id: Optional[int] = None,
+                          priority: int = PRIORITY_INTERACTIVE) -> AsyncIterator[str]:
+        """排队后流式生成；与进行中的请求完全相同时直接共享其结果"""
+        key = self._key(messages, temperature, max_tokens)
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight()
+            self._flights[key] = flight
+            self.submitted += 1
+            flight.task = asyncio.create_task(self._produce(
+                key, flight, messages, temperature, max_tokens, conversation_id, priority
+            ))
+        else:
+            self.coalesced += 1
+
+        queue = flight.subscribe()
+        try:
+            while True:
+                item = await queue.get()
+                if item is _END:
+                    return
+                if isinstance(item, _Failure):
+                    raise item.error
+                yield item
+        finally:
+            flight.unsubscribe(queue)
+            # 所有订阅者都离开后不再需要结果，取消排队或生成
+            if not flight.subscribers and not flight.finished:
+                flight.task.cancel()
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+
+    def bind(self, conversation_id: Optional[int] = None,
+             priority: int = PRIORITY_INTERACTIVE) -> LLMProvider:
+        """返回固定了对话和优先级的提供方，供只认识 LLMProvider 接口的调用方使用"""
+        return _BoundProvider(self, conversation_id, priority)
+
+    def queue_depth(self) -> Dict[int, int]:
+        """各优先级正在排队的请求数"""
+        depth: Dict[int, int] = {}
+        for priority, _, _, future in self._queue:
+            if not future.done():
+                depth[priority] = depth.get(priority, 0) + 1
+        return depth
+
+    def stats(self) -> Dict:
+        return {
+            "running": self._running,
+            "queued": sum(self.queue_depth().values()),
+            "queued_by_priority": self.queue_depth(),
+            "max_queue_depth": self.max_queue_depth,
+            "in_flight": len(self._flights),
+            "submitted": self.submitted,
+            "coalesced": self.coalesced,
+            "completed": self.completed,
+            "failed": self.failed,
+            "avg_wait_seconds": self.total_wait / self.waits if self.waits else 0.0,
+        }
+
+
+class _BoundProvider(LLMProvider):
+    def __init__(self, scheduler: LLMScheduler, conversation_id: Optional[int], priority: int):
+        self.scheduler = scheduler
+        self.conversation_id = conversation_id
+        self.priority = priority
+
+    async def stream_chat(self, messages: List[Dict], temperature: float = 0.7,
+                          max_tokens: Optional[int] = None) -> AsyncIterator[str]:
+        async for token in self.scheduler.stream_chat(
+            messages, temperature, max_tokens,
+            conversation_id=self.conversation_id, priority=self.priority,
+        ):
+            yield token
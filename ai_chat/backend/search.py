@@ -0,0 +1,78 @@
+"""
+全文检索辅助：中日韩文本按二元组切分后写入 FTS5，查询使用相同规则，命中片段从原文生成高亮
+"""
+import html
+import re
+from typing import List, Optional
+
+# 中日韩字符（假名、汉字、谚文）
+CJK_RE = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af]+")
+
+# 片段长度（字符数）
+SNIPPET_LENGTH = 64
+
+
+def segment_text(text: str) -> str:
+    """生成写入索引的文本：每段连续的中日韩字符展开为二元组，末尾补一个单字
+
+    例如 "你好世界" -> "你好 好世 世界 界"。单字查询用前缀匹配即可覆盖任意位置的字。
+    """
+    def expand(match):
+        run = match.group()
+        grams = [run[i:i + 2] for i in range(len(run) - 1)]
+        grams.append(run[-1])
+        return " " + " ".join(grams) + " "
+    return CJK_RE.sub(expand, text)
+
+
+def _quote(text: str) -> str:
+    return '"' + text.replace('"', '""') + '"'
+
+
+def build_match_query(query: str) -> Optional[str]:
+    """把用户输入转换为 FTS5 MATCH 表达式，各词之间为 AND 关系；没有可检索内容时返回 None"""
+    parts = []
+    for term in query.split():
+        # 中日韩字符段与其他字符段分别匹配
+        position = 0
+        for match in CJK_RE.finditer(term):
+            if match.start() > position:
+                parts.append(_quote(term[position:match.start()]))
+            run = match.group()
+            if len(run) == 1:
+                parts.append(_quote(run) + " *")
+            else:
+                parts.append(_quote(" ".join(run[i:i + 2] for i in range(len(run) - 1))))
+            position = match.end()
+        if position < len(term):
+            parts.append(_quote(term[position:]))
+    # 只含标点等无法分词的内容时 FTS5 会报错，这里只保留含字母或数字的部分
+    parts = [part for part in parts if any(ch.isalnum() for ch in part)]
+    return " AND ".join(parts) if parts else None
+
+
+def highlight_snippet(text: str, query: str, length: int = SNIPPET_LENGTH) -> str:
+    """从原文截取包含查询词的片段，转义 HTML 后用 <mark> 标记命中位置"""
+    terms = [t for t in query.split() if t]
+    pattern = re.compile("|".join(re.escape(t) for t in terms), re.IGNORECASE) if terms else None
+    first = pattern.search(text) if pattern else None
+
+    # 以第一个命中位置为中心截取片段
+    start = 0
+    if first and len(text) > length:
+        start = max(0, min(first.start() - length // 4, len(text) - length))
+    end = min(len(text), start + length)
+    window = text[start:end]
+
+    pieces: List[str] = []
+    position = 0
+    if pattern:
+        for match in pattern.finditer(window):
+            pieces.append(html.escape(window[position:match.start()]))
+            pieces.append(f"<mark>{html.escape(match.group())}</mark>")
+            position = match.end()
+    pieces.append(html.escape(window[position:]))
+
+    prefix = "..." if start > 0 else ""
+    suffix = "..." if end < len(text) else ""
+    return prefix + "".join(pieces) + suffix
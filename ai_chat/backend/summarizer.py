@@ -0,0 +1,171 @@
+"""
+滚动摘要：后台任务把长对话中较早的消息分段压缩进摘要，只保留最近的消息原文
+
+摘要模型可插拔，通过注册表按名称选择；默认的抽取式摘要不调用模型，结果只由输入决定。
+"""
+import asyncio
+import logging
+import os
+from typing import Callable, Dict, List, Optional, Set
+
+from llm import LLMProvider
+
+logger = logging.getLogger(__name__)
+
+# 未压缩的消息超过该 token 数时触发压缩
+COMPACT_TRIGGER_TOKENS = int(os.environ.get("COMPACT_TRIGGER_TOKENS", 6000))
+# 压缩后保留原文的最近消息的 token 数
+COMPACT_KEEP_TOKENS = int(os.environ.get("COMPACT_KEEP_TOKENS", 2000))
+# 每次送去摘要的消息的 token 数上限
+COMPACT_STEP_TOKENS = int(os.environ.get("COMPACT_STEP_TOKENS", 4000))
+
+
+class Summarizer:
+    """摘要模型基类：把已有摘要和新一段消息合并为新的摘要"""
+    name = "base"
+
+    async def summarize(self, previous: Optional[str], messages: List[Dict]) -> str:
+        raise NotImplementedError
+
+
+class ExtractiveSummarizer(Summarizer):
+    """本地确定性摘要：每条消息保留开头部分，总长度超过上限时丢弃最早的内容"""
+    name = "extractive"
+
+    def __init__(self, provider: Optional[LLMProvider] = None,
+                 line_chars: int = 80, max_chars: int = 2000):
+        self.line_chars = line_chars  # 每条消息保留的字符数
+        self.max_chars = max_chars    # 摘要总长度上限
+
+    async def summarize(self, previous: Optional[str], messages: List[Dict]) -> str:
+        lines = previous.split("\n") if previous else []
+        for message in messages:
+            text = " ".join(message["content"].split())
+            if len(text) > self.line_chars:
+                text = text[:self.line_chars] + "..."
+            lines.append(f"{message['role']}: {text}")
+
+        # 从最新的一行往前保留，直到达到长度上限（至少保留一行）
+        kept, length = [], 0
+        for line in reversed(lines):
+            length += len(line) + 1
+            if kept and length > self.max_chars:
+                break
+            kept.append(line)
+        return "\n".join(reversed(kept))
+
+
+class LLMSummarizer(Summarizer):
+    """调用大语言模型生成摘要"""
+    name = "llm"
+
+    INSTRUCTION = "请把已有摘要和新增的对话内容合并成一段简洁的摘要，保留关键事实、结论和未完成的事项。"
+
+    def __init__(self, provider: LLMProvider, max_tokens: int = 512):
+        self.provider = provider
+        self.max_tokens = max_tokens
+
+    async def summarize(self, previous: Optional[str], messages: List[Dict]) -> str:
+        transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+        content = f"已有摘要：\n{previous or '（无）'}\n\n新增对话：\n{transcript}"
+        return await self.provider.complete(
+            [{"role": "system", "content": self.INSTRUCTION}, {"role": "user", "content": content}],
+            temperature=0,
+            max_tokens=self.max_tokens,
+        )
+
+
+# 摘要模型注册表：名称 -> 构造函数（第一个参数为模型提供方）
+SUMMARIZERS: Dict[str, Callable[..., Summarizer]] = {
+    ExtractiveSummarizer.name: ExtractiveSummarizer,
+    LLMSummarizer.name: LLMSummarizer,
+}
+
+
+def register_summarizer(name: str, factory: Callable[..., Summarizer]):
+    """注册新的摘要模型"""
+    SUMMARIZERS[name] = factory
+
+
+def create_summarizer(name: str, provider: Optional[LLMProvider] = None, **kwargs) -> Summarizer:
+    """按名称创建摘要模型"""
+    if name not in SUMMARIZERS:
+        raise ValueError(f"Unknown summarizer: {name}")
+    return SUMMARIZERS[name](provider, **kwargs)
+
+
+class Compactor:
+    """后台压缩任务：有新消息的对话排队，由单个协程依次检查并压缩"""
+
+    def __init__(self, db, summarizer: Summarizer,
+                 trigger_tokens: int = COMPACT_TRIGGER_TOKENS,
+                 keep_tokens: int = COMPACT_KEEP_TOKENS,
+                 step_tokens: int = COMPACT_STEP_TOKENS):
+        self.db = db
+        self.summarizer = summarizer
+        self.trigger_tokens = trigger_tokens
+        self.keep_tokens = keep_tokens
+        self.step_tokens = step_tokens
+        self.pending: Set[int] = set()
+        self.summaries_written = 0
+        self.errors = 0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def notify(self, conversation_id: int):
+        """对话有新消息，稍后检查是否需要压缩"""
+        self.pending.add(conversation_id)
+        self._wakeup.set()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self.pending:
+                conversation_id = self.pending.pop()
+                try:
+                    await self.compact(conversation_id)
+                except Exception:
+                    self.errors += 1
+                    logger.exception("Failed to compact conversation %s", conversation_id)
+
+    async def compact(self, conversation_id: int) -> int:
+        """压缩一个对话，返回写入的摘要数
+
+        未压缩部分超过 trigger_tokens 时开始，每次并入至多 step_tokens 的消息，
+        直到只剩最近 keep_tokens 以内的消息。
+        """
+        written = 0
+        min_tokens = self.trigger_tokens
+        while True:
+            summary = await self.db.get_summary(conversation_id)
+            after_id = summary["end_message_id"] if summary else 0
+            messages = await self.db.get_messages_to_summarize(
+                conversation_id, after_id, min_tokens, self.keep_tokens, self.step_tokens
+            )
+            if not messages:
+                return written
+            content = await self.summarizer.summarize(summary["content"] if summary else None, messages)
+            await self.db.add_summary(conversation_id, messages[-1]["id"], content)
+            written += 1
+            self.summaries_written += 1
+            min_tokens = self.keep_tokens
+
+    def stats(self) -> Dict:
+        return {
+            "pending": len(self.pending),
+            "summaries_written": self.summaries_written,
+            "errors": self.errors,
+        }
@@ -0,0 +1,133 @@
+"""
+上传文件存储：分块写入临时文件并计算 SHA-256，按内容哈希存放，相同内容只保存一份
+"""
+import hashlib
+import os
+import tempfile
+import time
+from typing import Tuple
+
+from fastapi import UploadFile
+from starlette.concurrency import run_in_threadpool
+
+from metrics import observe_upload
+from profiling import span
+
+# 每次从上传流读取的块大小
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1MB
+
+# 内容寻址存储的子目录（相对于上传目录）
+BLOB_DIR = "blobs"
+
+
+class UploadTooLargeError(Exception):
+    """上传内容超过大小限制"""
+
+    def __init__(self, max_size: int):
+        super().__init__(f"File size exceeds {max_size} bytes")
+        self.max_size = max_size
+
+
+def remove_quietly(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def blob_name(sha256: str) -> str:
+    """内容哈希对应的相对路径，按前两位分目录避免单目录文件过多"""
+    return f"{BLOB_DIR}/{sha256[:2]}/{sha256}"
+
+
+def place_blob(temp_path: str, dest_path: str) -> bool:
+    """把临时文件放到内容地址上；内容已存在时丢弃临时文件，返回是否新写入"""
+    if os.path.exists(dest_path):
+        remove_quietly(temp_path)
+        return False
+    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+    # 同一文件系统内 rename 是原子的，并发写入相同内容也只会留下一份
+    os.replace(temp_path, dest_path)
+    return True
+
+
+def _write_chunk(out, hasher, chunk: bytes):
+    hasher.update(chunk)
+    out.write(chunk)
+
+
+async def stream_upload_to_temp(upload: UploadFile, directory: str,
+                                max_size: int) -> Tuple[str, int, str]:
+    """把上传内容分块写入 directory 下的临时文件，返回 (临时路径, 大小, SHA-256)；超限时中止并清理"""
+    fd, temp_path = await run_in_threadpool(
+        tempfile.mkstemp, dir=directory, prefix=".upload-", suffix=".part"
+    )
+    hasher = hashlib.sha256()
+    size = 0
+    started = time.perf_counter()
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_size:
+                    raise UploadTooLargeError(max_size)
+                # 哈希计算和磁盘写入放到线程池，避免阻塞事件循环
+                with span("io"):
+                    await run_in_threadpool(_write_chunk, out, hasher, chunk)
+    except BaseException:
+        await run_in_threadpool(remove_quietly, temp_path)
+        raise
+    observe_upload("file", size, time.perf_counter() - started)
+    return temp_path, size, hasher.hexdigest()
+
+
+class InvalidChunkError(Exception):
+    """分块的偏移或长度与上传会话不符"""
+
+
+def preallocate(path: str, size: int):
+    """创建指定大小的空文件，分块可按偏移并行写入"""
+    with open(path, "wb") as f:
+        f.truncate(size)
+
+
+def _pwrite_all(fd: int, data: bytes, offset: int):
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+async def write_stream_at(stream, path: str, offset: int, length: int) -> int:
+    """把请求体流写入文件的 offset 处，长度必须恰好为 length"""
+    fd = await run_in_threadpool(os.open, path, os.O_WRONLY)
+    written = 0
+    started = time.perf_counter()
+    try:
+        async for piece in stream:
+            if not piece:
+                continue
+            if written + len(piece) > length:
+                raise InvalidChunkError(f"Chunk exceeds expected length {length}")
+            with span("io"):
+                await run_in_threadpool(_pwrite_all, fd, piece, offset + written)
+            written += len(piece)
+    finally:
+        os.close(fd)
+    if written != length:
+        raise InvalidChunkError(f"Chunk length {written} does not match expected {length}")
+    observe_upload("chunk", written, time.perf_counter() - started)
+    return written
+
+
+def hash_file(path: str) -> str:
+    """分块计算文件的 SHA-256"""
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
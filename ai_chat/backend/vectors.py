@@ -0,0 +1,395 @@
+"""
+知识库向量检索：文本块的向量按行追加到磁盘上的 float32 矩阵，查询时内存映射后分块计算归一化点积
+
+向量文件只追加不改写：新文本块写入后由后台任务增量嵌入并追加；已删除的文本块在查询时按数据库过滤。
+向量较多时可启用 IVF 索引（k-means 聚类分桶），查询只扫描离查询向量最近的几个桶，
+索引建立之后追加的向量单独暴力扫描，积累到一定比例时重建索引。
+嵌入模型可插拔，通过注册表按名称选择，默认使用不依赖外部资源的哈希嵌入。
+依赖 numpy；未安装时知识库检索不可用，其他功能不受影响。
+"""
+import asyncio
+import json
+import logging
+import math
+import os
+import re
+import shutil
+import threading
+import zlib
+from typing import Callable, Dict, List, Optional, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+from search import segment_text
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - 可选依赖
+    np = None
+
+logger = logging.getLogger(__name__)
+
+# 索引方式："flat" 暴力扫描，"ivf" 聚类分桶
+VECTOR_INDEX = os.environ.get("VECTOR_INDEX", "flat")
+# 向量数达到该值才建立 IVF 索引，数据量小时暴力扫描更快
+IVF_MIN_VECTORS = int(os.environ.get("VECTOR_IVF_MIN_VECTORS", 20000))
+# 每次查询扫描的桶数
+IVF_NPROBE = int(os.environ.get("VECTOR_IVF_NPROBE", 8))
+# 索引之后追加的向量超过已索引数量的该比例时重建
+IVF_REBUILD_RATIO = 0.2
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE_SIZE = 50000
+
+SEARCH_BLOCK_ROWS = 32768  # 暴力扫描时每次参与矩阵乘法的向量数
+EMBED_BATCH_SIZE = 256     # 每次从数据库读取并嵌入的文本块数
+
+_WORD_RE = re.compile(r"\w+")
+
+
+class Embedder:
+    """嵌入模型基类：子类实现 embed，返回每行已归一化的 (n, dim) float32 矩阵"""
+    name = "base"
+    dim = 0
+
+    def embed(self, texts: List[str]):
+        raise NotImplementedError
+
+
+class HashingEmbedder(Embedder):
+    """离线哈希嵌入：词（中日韩文本取二元组）和相邻词对经 CRC32 散列到固定维度，带符号累加后归一化
+
+    结果只由文本决定，跨进程和重启保持一致（不使用带随机种子的 hash()）。
+    """
+    name = "hashing"
+
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+
+    def _features(self, text: str) -> List[str]:
+        tokens = _WORD_RE.findall(segment_text(text.lower()))
+        return tokens + [a + " " + b for a, b in zip(tokens, tokens[1:])]
+
+    def embed(self, texts: List[str]):
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            vector = matrix[row]
+            for feature in self._features(text):
+                h = zlib.crc32(feature.encode("utf-8"))
+                vector[(h >> 1) % self.dim] += 1.0 if h & 1 else -1.0
+        return normalize(matrix)
+
+
+# 嵌入模型注册表：名称 -> 构造函数
+EMBEDDERS: Dict[str, Callable[..., Embedder]] = {
+    HashingEmbedder.name: HashingEmbedder,
+}
+
+
+def register_embedder(name: str, factory: Callable[..., Embedder]):
+    """注册新的嵌入模型"""
+    EMBEDDERS[name] = factory
+
+
+def create_embedder(name: str, **kwargs) -> Embedder:
+    """按名称创建嵌入模型"""
+    if name not in EMBEDDERS:
+        raise ValueError(f"Unknown embedder: {name}")
+    return EMBEDDERS[name](**kwargs)
+
+
+def normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (matrix / norms).astype(np.float32, copy=False)
+
+
+def _merge_top_k(scores, rows, best_scores, best_rows, k: int):
+    """把一批候选并入每个查询当前的前 k 名"""
+    scores = np.concatenate([best_scores, scores], axis=1)
+    rows = np.concatenate([best_rows, rows], axis=1)
+    if scores.shape[1] > k:
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, top, axis=1)
+        rows = np.take_along_axis(rows, top, axis=1)
+    return scores, rows
+
+
+class IVFIndex:
+    """倒排聚类索引：质心矩阵，以及按所属桶排序的行号（offsets[i]:offsets[i + 1] 为第 i 个桶）"""
+
+    def __init__(self, centroids, order, offsets, count: int):
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+        self.count = count  # 建立索引时的向量数，此后追加的行不在桶中
+
+    @classmethod
+    def build(cls, vectors, count: int, seed: int = 0) -> "IVFIndex":
+        """在前 count 行上做球面 k-means（采样训练），再把所有行分到最近的质心"""
+        nlist = max(1, min(int(math.sqrt(count)), 4096))
+        rng = np.random.default_rng(seed)
+        sample_rows = np.sort(rng.choice(count, min(count, KMEANS_SAMPLE_SIZE), replace=False))
+        sample = np.asarray(vectors[sample_rows])
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+        for _ in range(KMEANS_ITERATIONS):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            empty = np.bincount(assignment, minlength=nlist) == 0
+            sums[empty] = centroids[empty]  # 空桶保留原质心
+            centroids = normalize(sums)
+
+        assignment = np.empty(count, dtype=np.int32)
+        for start in range(0, count, SEARCH_BLOCK_ROWS):
+            block = np.asarray(vectors[start:start + SEARCH_BLOCK_ROWS])
+            assignment[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+        order = np.argsort(assignment, kind="stable").astype(np.int64)
+        offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=nlist), out=offsets[1:])
+        return cls(centroids, order, offsets, count)
+
+    def save(self, path: str):
+        temp_path = path + ".tmp.npz"
+        np.savez(temp_path, centroids=self.centroids, order=self.order,
+                 offsets=self.offsets, count=np.array(self.count))
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "IVFIndex":
+        with np.load(path) as data:
+            return cls(data["centroids"], data["order"], data["offsets"], int(data["count"]))
+
+    def candidate_rows(self, query, nprobe: int):
+        """离查询向量最近的 nprobe 个桶中的行号"""
+        nearest = np.argsort(-(self.centroids @ query))[:nprobe]
+        return np.concatenate([self.order[self.offsets[i]:self.offsets[i + 1]] for i in nearest])
+
+
+class VectorStore:
+    """磁盘向量库：vectors.f32 为 (n, dim) 的 float32 行，ids.i64 为对应的文本块 id，两者只追加
+
+    行数以两个文件中较短的一方为准，写入中途崩溃留下的半行会被忽略并在下次追加前截断。
+    """
+
+    def __init__(self, directory: str, dim: int, embedder_name: str,
+                 index: str = VECTOR_INDEX, nprobe: int = IVF_NPROBE,
+                 ivf_min_vectors: int = IVF_MIN_VECTORS):
+        self.directory = directory
+        self.dim = dim
+        self.index = index
+        self.nprobe = nprobe
+        self.ivf_min_vectors = ivf_min_vectors
+        self.vectors_path = os.path.join(directory, "vectors.f32")
+        self.ids_path = os.path.join(directory, "ids.i64")
+        self.ivf_path = os.path.join(directory, "ivf.npz")
+        self._lock = threading.Lock()  # 串行化追加和索引重建
+
+        # 维度或嵌入模型变化时旧向量不可比较，清空后从头重建
+        meta = {"dim": dim, "embedder": embedder_name}
+        meta_path = os.path.join(directory, "meta.json")
+        try:
+            with open(meta_path, encoding="utf-8") as f:
+                stale = json.load(f) != meta
+        except (FileNotFoundError, ValueError):
+            stale = True
+        if stale:
+            shutil.rmtree(directory, ignore_errors=True)
+            os.makedirs(directory)
+            with open(meta_path, "w", encoding="utf-8") as f:
+                json.dump(meta, f)
+
+        self.ivf: Optional[IVFIndex] = None
+        if index == "ivf" and os.path.exists(self.ivf_path):
+            try:
+                self.ivf = IVFIndex.load(self.ivf_path)
+            except Exception:
+                logger.exception("Failed to load IVF index, falling back to flat search")
+        self._truncate_partial_rows()
+        self._remap()
+
+    def _truncate_partial_rows(self):
+        count = self._count_on_disk()
+        for path, row_bytes in ((self.vectors_path, self.dim * 4), (self.ids_path, 8)):
+            with open(path, "ab") as f:
+                f.truncate(count * row_bytes)
+
+    def _count_on_disk(self) -> int:
+        def rows(path, row_bytes):
+            return os.path.getsize(path) // row_bytes if os.path.exists(path) else 0
+        return min(rows(self.vectors_path, self.dim * 4), rows(self.ids_path, 8))
+
+    def _remap(self):
+        """重新映射文件；查询持有的旧映射仍然有效，因为文件只会变长"""
+        count = self._count_on_disk()
+        if count:
+            self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(count, self.dim))
+            self.ids = np.memmap(self.ids_path, dtype=np.int64, mode="r", shape=(count,))
+        else:
+            self.vectors = np.zeros((0, self.dim), dtype=np.float32)
+            self.ids = np.zeros(0, dtype=np.int64)
+        self.count = count
+        if self.ivf is not None and self.ivf.count > count:
+            self.ivf = None
+
+    @property
+    def max_id(self) -> int:
+        return int(self.ids[-1]) if self.count else 0
+
+    def append(self, ids: List[int], vectors):
+        """追加一批向量；先写向量再写 id，id 文件的长度即提交点"""
+        with self._lock:
+            with open(self.vectors_path, "ab") as f:
+                f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self.ids_path, "ab") as f:
+                f.write(np.asarray(ids, dtype=np.int64).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            self._remap()
+
+    def needs_reindex(self) -> bool:
+        if self.index != "ivf" or self.count < self.ivf_min_vectors:
+            return False
+        if self.ivf is None:
+            return True
+        return self.count - self.ivf.count > self.ivf.count * IVF_REBUILD_RATIO
+
+    def reindex(self):
+        """在当前所有向量上重建 IVF 索引；重建期间查询继续使用旧索引"""
+        with self._lock:
+            vectors, count = self.vectors, self.count
+        ivf = IVFIndex.build(vectors, count)
+        ivf.save(self.ivf_path)
+        self.ivf = ivf
+
+    def search(self, queries, k: int) -> List[List[Tuple[int, float]]]:
+        """每个查询向量返回按相似度降序的 (文本块 id, 分数) 列表"""
+        vectors, ids, count, ivf = self.vectors, self.ids, self.count, self.ivf
+        queries = np.asarray(queries, dtype=np.float32)
+        if not count:
+            return [[] for _ in queries]
+
+        if ivf is None:
+            best_scores, best_rows = self._scan(vectors, queries, 0, count, k)
+        else:
+            # 每个查询扫描最近的几个桶，再加上索引之后追加的行
+            best_scores, best_rows = self._scan(vectors, queries, ivf.count, count, k)
+            for q, query in enumerate(queries):
+                rows = ivf.candidate_rows(query, self.nprobe)
+                scores = np.asarray(vectors[rows]) @ query
+                merged = _merge_top_k(scores[None, :], rows[None, :],
+                                      best_scores[q:q + 1], best_rows[q:q + 1], k)
+                best_scores[q], best_rows[q] = merged[0][0], merged[1][0]
+
+        results = []
+        for scores, rows in zip(best_scores, best_rows):
+            order = np.argsort(-scores)
+            results.append([(int(ids[rows[i]]), float(scores[i])) for i in order if rows[i] >= 0])
+        return results
+
+    @staticmethod
+    def _scan(vectors, queries, start: int, end: int, k: int):
+        """暴力扫描 [start, end) 行：分块做矩阵乘法，所有查询一起计算"""
+        best_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        best_rows = np.full((len(queries), k), -1, dtype=np.int64)
+        for block_start in range(start, end, SEARCH_BLOCK_ROWS):
+            block = np.asarray(vectors[block_start:min(block_start + SEARCH_BLOCK_ROWS, end)])
+            scores = queries @ block.T
+            rows = np.broadcast_to(np.arange(block_start, block_start + len(block)), scores.shape)
+            best_scores, best_rows = _merge_top_k(scores, rows, best_scores, best_rows, k)
+        return best_scores, best_rows
+
+    def stats(self) -> Dict:
+        return {
+            "vectors": self.count,
+            "dim": self.dim,
+            "index": "ivf" if self.ivf is not None else "flat",
+            "ivf_lists": len(self.ivf.centroids) if self.ivf is not None else 0,
+            "ivf_indexed": self.ivf.count if self.ivf is not None else 0,
+        }
+
+
+class KnowledgeBase:
+    """把新写入的文本块嵌入并追加到向量库，提供相似度检索
+
+    后台协程被唤醒后按 id 顺序读取尚未嵌入的文本块，文本块 id 单调递增，向量库最后一个 id 即进度。
+    """
+
+    def __init__(self, db, embedder: Embedder, directory: str):
+        self.db = db
+        self.embedder = embedder
+        self.directory = directory
+        self.store: Optional[VectorStore] = None
+        self.errors = 0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def available(self) -> bool:
+        return self.store is not None
+
+    def notify(self, file_id: Optional[int] = None):
+        """有新的文本块写入"""
+        self._wakeup.set()
+
+    def start(self):
+        if np is None:
+            logger.warning("numpy is not installed, knowledge-base search is disabled")
+            return
+        self.store = VectorStore(self.directory, self.embedder.dim, self.embedder.name)
+        self._wakeup.set()  # 启动时补上次退出后未嵌入的文本块
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            try:
+                await self.sync()
+            except Exception:
+                self.errors += 1
+                logger.exception("Failed to update knowledge-base vectors")
+
+    async def sync(self) -> int:
+        """嵌入并追加所有新的文本块，返回追加的向量数"""
+        appended = 0
+        while True:
+            rows = await self.db.get_chunks_after(self.store.max_id, EMBED_BATCH_SIZE)
+            if not rows:
+                break
+            vectors = await run_in_threadpool(self.embedder.embed, [content for _, content in rows])
+            await run_in_threadpool(self.store.append, [chunk_id for chunk_id, _ in rows], vectors)
+            appended += len(rows)
+        if self.store.needs_reindex():
+            await run_in_threadpool(self.store.reindex)
+        return appended
+
+    async def search(self, query: str, limit: int = 10) -> List[Dict]:
+        """返回最相似的文本块（含文件名和偏移），按分数降序"""
+        vectors = await run_in_threadpool(self.embedder.embed, [query])
+        # 多取一些候选，弥补已删除的文本块
+        hits = (await run_in_threadpool(self.store.search, vectors, limit * 2))[0]
+        chunks = await self.db.get_chunks_by_ids([chunk_id for chunk_id, _ in hits])
+        results = []
+        for chunk_id, score in hits:
+            if chunk_id in chunks:
+                results.append({**chunks[chunk_id], "score": score})
+                if len(results) == limit:
+                    break
+        return results
+
+    def stats(self) -> Dict:
+        if self.store is None:
+            return {"available": False}
+        return {"available": True, "embedder": self.embedder.name, "errors": self.errors,
+                **self.store.stats()}
@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+"""
+负载测试：大量并发虚拟用户按场景调用聊天 API，统计吞吐量（RPS）和延迟分位数（p50/p95/p99）
+
+应用可以在进程内启动（默认，不经过网络），也可以在临时目录中启动本地 uvicorn，或者直接压测已运行的服务。
+结果保存为 JSON，指定基线文件时逐项对比，吞吐量下降或 p95 延迟上升超过容差时以非零状态退出。
+
+用法：
+    python benchmark.py                                        # 进程内运行全部场景
+    python benchmark.py --target uvicorn --users 2000          # 启动本地 uvicorn 后压测
+    python benchmark.py --url http://localhost:8000 -s list_conversations
+    python benchmark.py -o results.json --compare baseline.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import httpx
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend")
+
+
+class Recorder:
+    """按操作名记录每次请求的耗时和失败数"""
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+
+    async def request(self, client, operation, method, url, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+            ok = response.status_code < 400
+        except httpx.HTTPError:
+            response, ok = None, False
+        elapsed = time.perf_counter() - started
+        self.latencies.setdefault(operation, []).append(elapsed)
+        if not ok:
+            self.errors[operation] = self.errors.get(operation, 0) + 1
+        return response if ok else None
+
+
+# ---------- 场景：setup 为每个虚拟用户准备数据（不计时），step 为一次计时的迭代 ----------
+
+class Scenario:
+    name = "base"
+
+    def __init__(self, options):
+        self.options = options
+
+    async def prepare(self, client):
+        """所有用户共享的数据，只准备一次"""
+
+    async def setup(self, client, user):
+        return {}
+
+    async def step(self, client, recorder, state):
+        raise NotImplementedError
+
+
+class CreateConversation(Scenario):
+    name = "create_conversation"
+
+    async def step(self, client, recorder, state):
+        await recorder.request(client, "create_conversation", "POST", "/api/conversations",
+                               json={"title": "benchmark"})
+
+
+class AppendMessages(Scenario):
+    """每个用户在自己的对话中连续追加消息"""
+    name = "append_messages"
+
+    async def setup(self, client, user):
+        response = await client.post("/api/conversations", json={"title": f"user {user}"})
+        return {"conversation_id": response.json()["id"], "seq": 0}
+
+    async def step(self, client, recorder, state):
+        state["seq"] += 1
+        await recorder.request(
+            client, "add_message", "POST", f"/api/conversations/{state['conversation_id']}/messages",
+            json={"role": "user", "content": f"message {state['seq']} " + "lorem ipsum " * 10},
+        )
+
+
+class ListConversations(Scenario):
+    name = "list_conversations"
+
+    async def prepare(self, client):
+        await client.post("/api/import", content=_ndjson(
+            {"type": "conversation", "title": f"seed {i}"} for i in range(self.options.seed_conversations)
+        ))
+
+    async def step(self, client, recorder, state):
+        await recorder.request(client, "list_conversations", "GET", "/api/conversations",
+                               params={"limit": 50})
+
+
+class FetchHistory(Scenario):
+    """反复读取一个很长的对话（完整历史，不带条件请求头）"""
+    name = "fetch_history"
+
+    async def prepare(self, client):
+        response = await client.post("/api/conversations", json={"title": "long history"})
+        self.conversation_id = response.json()["id"]
+        await client.post(
+            f"/api/conversations/{self.conversation_id}/messages/bulk",
+            content=_ndjson({"role": "user" if i % 2 == 0 else "assistant",
+                             "content": f"history message {i} " + "lorem ipsum " * 20}
+                            for i in range(self.options.history)),
+        )
+
+    async def step(self, client, recorder, state):
+        await recorder.request(client, "fetch_history", "GET",
+                               f"/api/conversations/{self.conversation_id}")
+
+
+class Upload(Scenario):
+    """上传随机内容的文件（内容各不相同，不会命中去重）"""
+    name = "upload"
+
+    async def step(self, client, recorder, state):
+        data = random.randbytes(self.options.upload_size)
+        await recorder.request(client, "upload", "POST", "/api/upload",
+                               files={"file": ("benchmark.bin", data)})
+
+
+class Mixed(Scenario):
+    """按比例混合：读多写少，贴近真实使用"""
+    name = "mixed"
+    WEIGHTS = {"list_conversations": 4, "fetch_history": 3, "append_messages": 2,
+               "create_conversation": 1}
+
+    def __init__(self, options):
+        super().__init__(options)
+        self.parts = {name: SCENARIOS[name](options) for name in self.WEIGHTS}
+
+    async def prepare(self, client):
+        for part in self.parts.values():
+            await part.prepare(client)
+
+    async def setup(self, client, user):
+        return {name: await part.setup(client, user) for name, part in self.parts.items()}
+
+    async def step(self, client, recorder, state):
+        name = random.choices(list(self.WEIGHTS), weights=list(self.WEIGHTS.values()))[0]
+        await self.parts[name].step(client, recorder, state[name])
+
+
+SCENARIOS = {cls.name: cls for cls in
+             (CreateConversation, AppendMessages, ListConversations, FetchHistory, Upload, Mixed)}
+
+
+def _ndjson(records):
+    return "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records).encode("utf-8")
+
+
+# ---------- 统计 ----------
+
+def percentile(sorted_values, fraction):
+    """最近秩法分位数"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values), max(1, math.ceil(fraction * len(sorted_values)))) - 1
+    return sorted_values[index]
+
+
+def summarize(latencies, errors, duration):
+    values = sorted(latencies)
+    return {
+        "requests": len(values),
+        "errors": errors,
+        "rps": round(len(values) / duration, 2) if duration else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(values, 0.50) * 1000, 3),
+            "p95": round(percentile(values, 0.95) * 1000, 3),
+            "p99": round(percentile(values, 0.99) * 1000, 3),
+            "mean": round(sum(values) / len(values) * 1000, 3) if values else 0.0,
+            "max": round(values[-1] * 1000, 3) if values else 0.0,
+        },
+    }
+
+
+async def run_scenario(client, scenario, options):
+    """所有虚拟用户同时开始，每人执行 iterations 次（或持续 duration 秒）"""
+    await scenario.prepare(client)
+    states = await asyncio.gather(*(scenario.setup(client, user) for user in range(options.users)))
+    recorder = Recorder()
+    deadline = time.perf_counter() + options.duration if options.duration else None
+
+    async def user_loop(state):
+        done = 0
+        while (deadline is None and done < options.iterations) or \
+                (deadline is not None and time.perf_counter() < deadline):
+            await scenario.step(client, recorder, state)
+            done += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user_loop(state) for state in states))
+    duration = time.perf_counter() - started
+
+    all_latencies = [value for values in recorder.latencies.values() for value in values]
+    result = summarize(all_latencies, sum(recorder.errors.values()), duration)
+    result["duration_s"] = round(duration, 3)
+    result["operations"] = {
+        operation: summarize(values, recorder.errors.get(operation, 0), duration)
+        for operation, values in sorted(recorder.latencies.items())
+    }
+    return result
+
+
+# ---------- 被测应用 ----------
+
+class InProcessTarget:
+    """在临时目录中导入并启动应用，请求经 ASGI 直接调用，不经过网络"""
+
+    def __init__(self):
+        self.workdir = os.path.join(tempfile.mkdtemp(prefix="ai-chat-bench-"), "work")
+        os.makedirs(self.workdir)
+
+    async def __aenter__(self):
+        # main.py 使用相对路径存放数据库（chat.db）和上传目录（../uploads）
+        os.chdir(self.workdir)
+        sys.path.insert(0, BACKEND_DIR)
+        import main
+        self.app = main.app
+        await self.app.router.startup()
+        return httpx.ASGITransport(app=self.app), "http://benchmark"
+
+    async def __aexit__(self, *exc):
+        await self.app.router.shutdown()
+
+
+class UvicornTarget:
+    """在临时目录中启动本地 uvicorn 子进程"""
+
+    def __init__(self, workers=1):
+        self.workers = workers
+        self.workdir = os.path.join(tempfile.mkdtemp(prefix="ai-chat-bench-"), "work")
+        os.makedirs(self.workdir)
+
+    async def __aenter__(self):
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        env = dict(os.environ, PYTHONPATH=BACKEND_DIR)
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+             "--workers", str(self.workers), "--log-level", "warning"],
+            cwd=self.workdir, env=env,
+        )
+        url = f"http://127.0.0.1:{port}"
+        async with httpx.AsyncClient() as client:
+            for _ in range(100):
+                try:
+                    await client.get(url + "/")
+                    break
+                except httpx.HTTPError:
+                    await asyncio.sleep(0.1)
+            else:
+                raise RuntimeError("uvicorn did not start")
+        return None, url
+
+    async def __aexit__(self, *exc):
+        self.process.terminate()
+        self.process.wait(timeout=10)
+
+
+class URLTarget:
+    """压测已运行的服务"""
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+
+    async def __aenter__(self):
+        return None, self.url
+
+    async def __aexit__(self, *exc):
+        pass
+
+
+# ---------- 结果对比 ----------
+
+def compare(results, baseline, tolerance):
+    """对比每个场景的 RPS 和 p95，返回退化项"""
+    regressions = []
+    for name, result in results["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(name)
+        if not base:
+            continue
+        rps_change = (result["rps"] - base["rps"]) / base["rps"] if base["rps"] else 0.0
+        p95, base_p95 = result["latency_ms"]["p95"], base["latency_ms"]["p95"]
+        p95_change = (p95 - base_p95) / base_p95 if base_p95 else 0.0
+        flag = ""
+        if rps_change < -tolerance or p95_change > tolerance:
+            regressions.append(name)
+            flag = "  ❌ 退化"
+        print(f"   {name:<22} RPS {base['rps']:>9.1f} → {result['rps']:>9.1f} ({rps_change:+.1%})  "
+              f"p95 {base_p95:>8.2f} → {p95:>8.2f} ms ({p95_change:+.1%}){flag}")
+    return regressions
+
+
+def print_result(name, result):
+    latency = result["latency_ms"]
+    print(f"✅ {name:<22} {result['requests']:>7} 请求  {result['rps']:>9.1f} RPS  "
+          f"p50 {latency['p50']:>8.2f}  p95 {latency['p95']:>8.2f}  p99 {latency['p99']:>8.2f} ms  "
+          f"错误 {result['errors']}")
+    if len(result["operations"]) > 1:
+        for operation, stats in result["operations"].items():
+            print(f"     {operation:<20} {stats['requests']:>7} 请求  p95 {stats['latency_ms']['p95']:>8.2f} ms")
+
+
+async def run(options):
+    if options.url:
+        target = URLTarget(options.url)
+    elif options.target == "uvicorn":
+        target = UvicornTarget(options.workers)
+    else:
+        target = InProcessTarget()
+
+    results = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "target": options.url or options.target,
+            "users": options.users,
+            "iterations": options.iterations,
+            "duration": options.duration,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "scenarios": {},
+    }
+    async with target as (transport, base_url):
+        limits = httpx.Limits(max_connections=options.users, max_keepalive_connections=options.users)
+        async with httpx.AsyncClient(transport=transport, base_url=base_url, limits=limits,
+                                     timeout=options.timeout) as client:
+            for name in options.scenarios:
+                print(f"🚀 运行场景 {name}（{options.users} 个并发用户）...")
+                result = await run_scenario(client, SCENARIOS[name](options), options)
+                results["scenarios"][name] = result
+                print_result(name, result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AI Chat API 负载测试")
+    parser.add_argument("-s", "--scenario", dest="scenarios", action="append", choices=sorted(SCENARIOS),
+                        help="要运行的场景，可重复指定；默认运行全部")
+    parser.add_argument("--target", choices=("inprocess", "uvicorn"), default="inprocess",
+                        help="进程内运行应用，或在临时目录启动本地 uvicorn")
+    parser.add_argument("--url", help="压测已运行的服务，例如 http://localhost:8000")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn 工作进程数")
+    parser.add_argument("-u", "--users", type=int, default=100, help="并发虚拟用户数")
+    parser.add_argument("-n", "--iterations", type=int, default=20, help="每个用户的迭代次数")
+    parser.add_argument("-d", "--duration", type=float, default=0,
+                        help="按时长运行（秒），指定后忽略迭代次数")
+    parser.add_argument("--history", type=int, default=2000, help="fetch_history 场景的对话长度")
+    parser.add_argument("--seed-conversations", type=int, default=500, help="list_conversations 预置的对话数")
+    parser.add_argument("--upload-size", type=int, default=64 * 1024, help="upload 场景的文件大小（字节）")
+    parser.add_argument("--timeout", type=float, default=60.0, help="单个请求的超时（秒）")
+    parser.add_argument("-o", "--output", help="结果 JSON 文件")
+    parser.add_argument("--compare", help="基线结果 JSON 文件")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="允许的退化比例（RPS 下降或 p95 上升），默认 0.2")
+    options = parser.parse_args()
+    options.scenarios = options.scenarios or [name for name in SCENARIOS if name != "mixed"]
+    if options.output:
+        options.output = os.path.abspath(options.output)
+    if options.compare:
+        options.compare = os.path.abspath(options.compare)
+
+    results = asyncio.run(run(options))
+
+    if options.output:
+        with open(options.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"💾 结果已保存到 {options.output}")
+
+    if options.compare:
+        with open(options.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        print(f"📊 与基线 {options.compare} 对比（容差 {options.tolerance:.0%}）：")
+        for key in ("target", "users", "iterations", "duration"):
+            if baseline.get("meta", {}).get(key) != results["meta"][key]:
+                print(f"⚠️  基线的 {key} 与本次不同（{baseline.get('meta', {}).get(key)} / "
+                      f"{results['meta'][key]}），结果不宜直接比较")
+        regressions = compare(results, baseline, options.tolerance)
+        if regressions:
+            print(f"❌ 性能退化：{', '.join(regressions)}")
+            sys.exit(1)
+        print("✅ 没有超出容差的退化")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+"""
+数据库微基准：在临时 SQLite 文件中生成合成数据，测量 Database 各方法的耗时随数据量的变化
+
+数据量按消息条数分档（默认 1K、10K、100K、1M，可加到 10M），每档在上一档的数据上追加生成，
+每个对话的消息数固定，因此对话数随档位同比增长。每一档测量：
+  - 各读写方法的 p50/p95/平均耗时
+  - 多个写线程并发 add_message 的吞吐量和延迟，以及同时进行的读请求的延迟
+输出每个方法的扩展曲线和拟合的增长指数（耗时 ∝ 行数^k，k 接近 0 表示与数据量无关），
+可保存为 JSON/CSV，并与基线对比。修改存储层之前和之后各跑一次，用数据说明影响。
+
+用法：
+    python db_benchmark.py                               # 默认档位，临时目录，结束后删除
+    python db_benchmark.py --tiers 1k,100k,10m --db /data/bench.db   # 保留数据集，下次直接复用
+    python db_benchmark.py -o db.json --csv db.csv --compare baseline.json
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+
+from database import Database  # noqa: E402
+
+GENERATE_BATCH = 20000   # 每个事务写入的消息数
+CONTENT_POOL_SIZE = 2000
+BASE_TIME = datetime(2024, 1, 1)
+
+WORDS = ("database", "index", "query", "latency", "message", "conversation", "python", "vector",
+         "cache", "token", "stream", "upload", "search", "model", "context", "summary")
+PHRASES = ("数据库", "索引", "查询", "延迟", "消息", "对话", "模型", "缓存", "上传", "检索", "摘要", "分页")
+# 词表按 Zipf 分布取词：少数常用词出现在大部分消息中，多数词很少出现，检索的选择性接近真实文本
+VOCABULARY = WORDS + PHRASES + tuple(f"term{i}" for i in range(5000))
+ZIPF_WEIGHTS = [1 / (rank + 1) for rank in range(len(VOCABULARY))]
+
+
+def parse_size(text):
+    """1k / 10K / 2.5m / 10M / 1000"""
+    text = text.strip().lower()
+    factor = {"k": 1000, "m": 1000 ** 2}.get(text[-1], 1)
+    return int(float(text.rstrip("km")) * factor)
+
+
+def format_size(n):
+    for unit, size in (("M", 1000 ** 2), ("K", 1000)):
+        if n >= size and n % (size // 10) == 0:
+            return f"{n / size:g}{unit}"
+    return str(n)
+
+
+def make_content_pool(rng):
+    pool = []
+    for _ in range(CONTENT_POOL_SIZE):
+        parts = rng.choices(VOCABULARY, weights=ZIPF_WEIGHTS, k=rng.randint(5, 80))
+        pool.append(" ".join(parts))
+    return pool
+
+
+# ---------- 数据生成 ----------
+
+def count_messages(db):
+    conn = db._get_connection()
+    return conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+
+def generate(db, target_messages, per_conversation, rng, pool):
+    """追加对话和消息直到消息数达到 target_messages；消息经 add_messages_bulk 写入，token 前缀和与全文索引与线上一致"""
+    conn = db._get_connection()
+    current = count_messages(db)
+    started = time.perf_counter()
+    while current < target_messages:
+        batch_messages = min(GENERATE_BATCH, target_messages - current)
+        conversations = max(1, math.ceil(batch_messages / per_conversation))
+        first_index = conn.execute("SELECT COALESCE(MAX(id), 0) FROM conversations").fetchone()[0]
+        # 对话的创建时间按序号递增，每个对话的消息在其后若干分钟内
+        rows = []
+        for i in range(conversations):
+            created = BASE_TIME + timedelta(minutes=first_index + i)
+            rows.append((f"对话 {first_index + i} {rng.choice(WORDS)}", created.strftime("%Y-%m-%d %H:%M:%S")))
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT INTO conversations (title, created_at, updated_at) VALUES (?, ?, ?)",
+                [(title, created, created) for title, created in rows]
+            )
+            conn.execute(
+                "INSERT INTO conversations_fts (rowid, title) "
+                "SELECT id, segment_text(title) FROM conversations WHERE id > ?",
+                (first_index,)
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+        ids = [row[0] for row in conn.execute(
+            "SELECT id FROM conversations WHERE id > ? ORDER BY id", (first_index,)
+        )]
+        messages = []
+        for conversation_id, (_, created) in zip(ids, rows):
+            start = datetime.strptime(created, "%Y-%m-%d %H:%M:%S")
+            for j in range(min(per_conversation, batch_messages - len(messages))):
+                messages.append({
+                    "conversation_id": conversation_id,
+                    "role": "user" if j % 2 == 0 else "assistant",
+                    "content": rng.choice(pool),
+                    "created_at": (start + timedelta(seconds=j)).strftime("%Y-%m-%d %H:%M:%S"),
+                })
+        current += db.add_messages_bulk(messages)
+        print(f"\r   生成中 {format_size(current)} / {format_size(target_messages)} 条消息"
+              f"（{time.perf_counter() - started:.1f}s）", end="", flush=True)
+    print()
+
+
+# ---------- 计时 ----------
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values), max(1, math.ceil(fraction * len(sorted_values)))) - 1
+    return sorted_values[index]
+
+
+def latency_stats(values):
+    values = sorted(values)
+    return {
+        "p50_ms": round(percentile(values, 0.50) * 1000, 4),
+        "p95_ms": round(percentile(values, 0.95) * 1000, 4),
+        "mean_ms": round(sum(values) / len(values) * 1000, 4) if values else 0.0,
+    }
+
+
+def time_calls(func, iterations, warmup):
+    for _ in range(warmup):
+        func()
+    latencies = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - started)
+    return latency_stats(latencies)
+
+
+def operations(db, rng, pool, per_conversation):
+    """要测量的方法：名称 -> 无参调用；每次调用随机选择目标对话"""
+    conn = db._get_connection()
+    max_conversation = conn.execute("SELECT MAX(id) FROM conversations").fetchone()[0]
+    max_message = conn.execute("SELECT MAX(id) FROM messages").fetchone()[0]
+
+    def conversation():
+        return rng.randint(1, max_conversation)
+
+    def middle_message(cid):
+        # 生成的消息按对话连续编号，估算该对话中间的一条
+        return max(1, min(max_message, (cid - 1) * per_conversation + per_conversation // 2))
+
+    return {
+        "get_conversations": lambda: db.get_conversations(limit=50),
+        "get_conversations_deep_page": lambda: db.get_conversations(before_id=conversation(), limit=50),
+        "get_conversation": lambda: db.get_conversation(conversation()),
+        "get_conversation_stats": lambda: db.get_conversation_stats(conversation()),
+        "get_messages": lambda: db.get_messages(conversation()),
+        "get_messages_page": lambda: db.get_messages(conversation(), limit=50),
+        "get_messages_since": lambda: db.get_messages(
+            (cid := conversation()), since_id=middle_message(cid)),
+        "get_context_messages": lambda: db.get_context_messages(conversation(), 4096),
+        "search": lambda: db.search(rng.choice(VOCABULARY)),
+        "add_message": lambda: db.add_message(conversation(), "user", rng.choice(pool)),
+    }
+
+
+def run_writers(db, threads, writes_per_thread, rng_seed, pool):
+    """threads 个线程并发 add_message，同时一个读线程持续分页读取消息"""
+    conn = db._get_connection()
+    max_conversation = conn.execute("SELECT MAX(id) FROM conversations").fetchone()[0]
+    write_latencies, read_latencies = [], []
+    errors = 0
+    lock = threading.Lock()
+    stop_reading = threading.Event()
+
+    def writer(index):
+        nonlocal errors
+        rng = random.Random(rng_seed + index)
+        local = []
+        for _ in range(writes_per_thread):
+            started = time.perf_counter()
+            try:
+                db.add_message(rng.randint(1, max_conversation), "user", rng.choice(pool))
+            except sqlite3.Error:
+                with lock:
+                    errors += 1
+            local.append(time.perf_counter() - started)
+        with lock:
+            write_latencies.extend(local)
+
+    def reader():
+        rng = random.Random(rng_seed - 1)
+        while not stop_reading.is_set():
+            started = time.perf_counter()
+            db.get_messages(rng.randint(1, max_conversation), limit=50)
+            read_latencies.append(time.perf_counter() - started)
+
+    reader_thread = threading.Thread(target=reader)
+    reader_thread.start()
+    workers = [threading.Thread(target=writer, args=(i,)) for i in range(threads)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+    stop_reading.set()
+    reader_thread.join()
+
+    write_stats = latency_stats(write_latencies)
+    return {
+        "threads": threads,
+        "writes": len(write_latencies),
+        "errors": errors,
+        "ops_per_s": round(len(write_latencies) / elapsed, 1) if elapsed else 0.0,
+        **write_stats,
+        "reader_p95_ms": latency_stats(read_latencies)["p95_ms"] if read_latencies else None,
+    }
+
+
+# ---------- 输出 ----------
+
+def growth_exponent(points):
+    """对 log(耗时) ~ log(行数) 做最小二乘拟合，返回斜率"""
+    points = [(math.log(rows), math.log(ms)) for rows, ms in points if rows > 0 and ms > 0]
+    if len(points) < 2:
+        return None
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    var_x = sum((x - mean_x) ** 2 for x, _ in points)
+    if not var_x:
+        return None
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / var_x
+
+
+def print_curves(results):
+    tiers = results["tiers"]
+    header = f"{'方法':<30}" + "".join(f"{format_size(t):>11}" for t in tiers) + f"{'增长指数':>10}"
+    print("\n📈 p50 耗时（毫秒）随消息条数的变化")
+    print(header)
+    for name, points in results["operations"].items():
+        cells = "".join(f"{p['p50_ms']:>11.3f}" for p in points)
+        exponent = results["growth"].get(name)
+        print(f"{name:<30}{cells}{exponent:>10.2f}" if exponent is not None else f"{name:<30}{cells}")
+
+    print("\n✍️  并发写入（ops/s，写 p95 / 同时读 p95，毫秒）")
+    for rows, runs in results["writers"].items():
+        cells = "  ".join(f"{r['threads']}线程 {r['ops_per_s']:>7.0f}/s "
+                          f"{r['p95_ms']:.2f}/{r['reader_p95_ms'] or 0:.2f}" for r in runs)
+        print(f"   {format_size(int(rows)):>6}  {cells}")
+
+
+def write_csv(results, path):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("kind,operation,rows,threads,p50_ms,p95_ms,mean_ms,ops_per_s\n")
+        for name, points in results["operations"].items():
+            for p in points:
+                f.write(f"operation,{name},{p['rows']},1,{p['p50_ms']},{p['p95_ms']},{p['mean_ms']},\n")
+        for rows, runs in results["writers"].items():
+            for r in runs:
+                f.write(f"writers,add_message,{rows},{r['threads']},{r['p50_ms']},{r['p95_ms']},"
+                        f"{r['mean_ms']},{r['ops_per_s']}\n")
+
+
+def compare(results, baseline, tolerance):
+    """逐方法、逐档位对比 p50，返回超出容差的退化项"""
+    regressions = []
+    for name, points in results["operations"].items():
+        base_points = {p["rows"]: p for p in baseline.get("operations", {}).get(name, [])}
+        for p in points:
+            base = base_points.get(p["rows"])
+            if not base or not base["p50_ms"]:
+                continue
+            change = (p["p50_ms"] - base["p50_ms"]) / base["p50_ms"]
+            if change > tolerance:
+                regressions.append(f"{name}@{format_size(p['rows'])} {base['p50_ms']:.3f} → "
+                                   f"{p['p50_ms']:.3f} ms ({change:+.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Database 微基准和扩展曲线")
+    parser.add_argument("--tiers", default="1k,10k,100k,1m", help="消息条数档位，逗号分隔，如 1k,10k,10m")
+    parser.add_argument("--per-conversation", type=int, default=100, help="每个对话的消息数")
+    parser.add_argument("-n", "--iterations", type=int, default=200, help="每个方法每档的计时次数")
+    parser.add_argument("--warmup", type=int, default=20, help="计时前的预热次数")
+    parser.add_argument("--writers", default="1,2,4,8", help="并发写线程数，逗号分隔；为空时跳过")
+    parser.add_argument("--writes", type=int, default=200, help="每个写线程的写入次数")
+    parser.add_argument("--db", help="数据集文件；已存在时在其上追加，结束后保留")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("-o", "--output", help="结果 JSON 文件")
+    parser.add_argument("--csv", help="结果 CSV 文件")
+    parser.add_argument("--compare", help="基线结果 JSON 文件")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允许的 p50 增幅，默认 0.2")
+    options = parser.parse_args()
+
+    tiers = sorted(parse_size(t) for t in options.tiers.split(",") if t.strip())
+    writer_counts = [int(w) for w in options.writers.split(",") if w.strip()]
+    temp_dir = None
+    if options.db:
+        db_path = os.path.abspath(options.db)
+    else:
+        temp_dir = tempfile.mkdtemp(prefix="ai-chat-dbbench-")
+        db_path = os.path.join(temp_dir, "bench.db")
+
+    rng = random.Random(options.seed)
+    pool = make_content_pool(rng)
+    results = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "per_conversation": options.per_conversation,
+            "iterations": options.iterations,
+            "sqlite": sqlite3.sqlite_version,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "tiers": tiers,
+        "operations": {},
+        "writers": {},
+        "growth": {},
+    }
+
+    db = Database(db_path)
+    try:
+        for rows in tiers:
+            print(f"🗄️  档位 {format_size(rows)} 条消息（{db_path}）")
+            if count_messages(db) > rows:
+                print(f"⚠️  数据集已有 {format_size(count_messages(db))} 条消息，超过该档位，跳过")
+                continue
+            generate(db, rows, options.per_conversation, rng, pool)
+            for name, func in operations(db, rng, pool, options.per_conversation).items():
+                stats = time_calls(func, options.iterations, options.warmup)
+                results["operations"].setdefault(name, []).append({"rows": rows, **stats})
+                print(f"   {name:<30} p50 {stats['p50_ms']:>9.3f}  p95 {stats['p95_ms']:>9.3f} ms")
+            for threads in writer_counts:
+                run = run_writers(db, threads, options.writes, options.seed, pool)
+                results["writers"].setdefault(str(rows), []).append(run)
+                print(f"   写线程 {threads:<3} {run['ops_per_s']:>8.0f} ops/s  p95 {run['p95_ms']:>8.3f} ms  "
+                      f"读 p95 {run['reader_p95_ms'] or 0:>8.3f} ms  错误 {run['errors']}")
+    finally:
+        db.close()
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    for name, points in results["operations"].items():
+        exponent = growth_exponent([(p["rows"], p["p50_ms"]) for p in points])
+        if exponent is not None:
+            results["growth"][name] = round(exponent, 3)
+    print_curves(results)
+
+    if options.output:
+        with open(options.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"💾 结果已保存到 {options.output}")
+    if options.csv:
+        write_csv(results, options.csv)
+        print(f"💾 CSV 已保存到 {options.csv}")
+
+    if options.compare:
+        with open(options.compare, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), options.tolerance)
+        if regressions:
+            print(f"❌ p50 超出容差（{options.tolerance:.0%}）的退化：")
+            for item in regressions:
+                print(f"   {item}")
+            sys.exit(1)
+        print("✅ 与基线相比没有超出容差的退化")
+
+
+if __name__ == "__main__":
+    main()
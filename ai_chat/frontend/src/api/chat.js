@@ -17,10 +17,102 @@ const api = axios.create({
   timeout: 10000,
 })
 
+// 条件请求缓存：URL -> { etag, data }，服务器返回 304 时复用本地数据
+const etagCache = new Map()
+
+const cachedGet = async (url, config = {}) => {
+  const key = api.getUri({ url, params: config.params })
+  const cached = etagCache.get(key)
+  const response = await api.get(url, {
+    ...config,
+    headers: cached ? { ...config.headers, 'If-None-Match': cached.etag } : config.headers,
+    validateStatus: status => (status >= 200 && status < 300) || status === 304
+  })
+  if (response.status === 304 && cached) {
+    return { ...response, status: 200, data: structuredClone(cached.data) }
+  }
+  const etag = response.headers.etag
+  if (etag) {
+    etagCache.set(key, { etag, data: structuredClone(response.data) })
+  }
+  return response
+}
+
+// 分块上传配置
+const UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024 // 4MB
+const UPLOAD_CONCURRENCY = 3
+const UPLOAD_CHUNK_RETRIES = 3
+
+// 同一文件的上传会话记录在 localStorage，刷新页面后也能续传
+const uploadSessionKey = (file) => `upload:${file.name}:${file.size}:${file.lastModified}`
+
+// 获取可续传的会话，不存在或已失效时创建新会话
+const getOrCreateUploadSession = async (file) => {
+  const key = uploadSessionKey(file)
+  const savedId = localStorage.getItem(key)
+  if (savedId) {
+    try {
+      const response = await api.get(`/uploads/${savedId}`)
+      return response.data
+    } catch (error) {
+      localStorage.removeItem(key)
+    }
+  }
+  const response = await api.post('/uploads', {
+    filename: file.name,
+    file_size: file.size,
+    chunk_size: UPLOAD_CHUNK_SIZE
+  })
+  localStorage.setItem(key, response.data.id)
+  return response.data
+}
+
+const uploadChunkWithRetry = async (session, file, index) => {
+  const offset = index * session.chunk_size
+  const chunk = file.slice(offset, offset + session.chunk_size)
+  for (let attempt = 1; ; attempt++) {
+    try {
+      return await api.put(`/uploads/${session.id}/chunks/${offset}`, chunk, {
+        headers: { 'Content-Type': 'application/octet-stream' },
+        timeout: 0
+      })
+    } catch (error) {
+      if (attempt >= UPLOAD_CHUNK_RETRIES) throw error
+      await new Promise(resolve => setTimeout(resolve, 1000 * attempt))
+    }
+  }
+}
+
+// 解析一条 SSE 事件并分发给对应的回调
+const dispatchSseEvent = (rawEvent, handlers) => {
+  let event = 'message'
+  const dataLines = []
+  for (const line of rawEvent.split('\n')) {
+    if (line.startsWith('event:')) {
+      event = line.slice(6).trim()
+    } else if (line.startsWith('data:')) {
+      dataLines.push(line.slice(5).trim())
+    }
+  }
+  if (dataLines.length === 0) return
+  const data = JSON.parse(dataLines.join('\n'))
+
+  const callbacks = {
+    message: handlers.onMessage,
+    token: handlers.onToken,
+    done: handlers.onDone,
+    error: handlers.onError
+  }
+  const callback = callbacks[event]
+  if (callback) {
+    callback(event === 'token' ? data.content : data)
+  }
+}
+
 export const chatApi = {
-  // 获取所有对话
-  getConversations() {
-    return api.get('/conversations')
+  // 获取对话列表，可传入 { before_id, limit } 分页，{ updated_since } 只获取有更新的对话
+  getConversations(params = {}) {
+    return cachedGet('/conversations', { params })
   },
 
   // 创建新对话
@@ -30,7 +122,18 @@ export const chatApi = {
 
   // 获取特定对话及其消息
   getConversation(conversationId) {
-    return api.get(`/conversations/${conversationId}`)
+    return cachedGet(`/conversations/${conversationId}`)
+  },
+
+  // 分页获取消息，传入 { before_id, limit } 加载更早的历史，
+  // 传入 { since_id } 只获取该消息之后新增的消息
+  getMessages(conversationId, params = {}) {
+    return api.get(`/conversations/${conversationId}/messages`, { params })
+  },
+
+  // 全文检索对话标题和消息，结果片段为转义后的 HTML，命中部分用 <mark> 标记
+  search(q, params = {}) {
+    return api.get('/search', { params: { q, ...params } })
   },
 
   // 更新对话标题
@@ -46,6 +149,121 @@ export const chatApi = {
     })
   },
 
+  // 流式生成助手回复（SSE）
+  // handlers: { onMessage(用户消息), onToken(片段), onDone(助手消息), onError(错误), signal }
+  async streamCompletion(conversationId, content, handlers = {}, options = {}) {
+    const response = await fetch(`${API_BASE_URL}/conversations/${conversationId}/completions`, {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+        Accept: 'text/event-stream'
+      },
+      body: JSON.stringify({ content, ...options }),
+      signal: handlers.signal
+    })
+    if (!response.ok) {
+      throw new Error(`Completion request failed: ${response.status}`)
+    }
+
+    const reader = response.body.getReader()
+    const decoder = new TextDecoder()
+    let buffer = ''
+    while (true) {
+      const { value, done } = await reader.read()
+      if (done) break
+      buffer += decoder.decode(value, { stream: true })
+
+      // 事件之间以空行分隔
+      let boundary
+      while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+        const rawEvent = buffer.slice(0, boundary)
+        buffer = buffer.slice(boundary + 2)
+        dispatchSseEvent(rawEvent, handlers)
+      }
+    }
+  },
+
+  // 分块上传大文件：断线后再次调用会跳过已上传的分块
+  async uploadFileResumable(file, { onProgress } = {}) {
+    const session = await getOrCreateUploadSession(file)
+    const received = new Set(session.received_chunks)
+    const pending = []
+    for (let index = 0; index < session.total_chunks; index++) {
+      if (!received.has(index)) pending.push(index)
+    }
+
+    let done = received.size
+    const worker = async () => {
+      while (pending.length > 0) {
+        await uploadChunkWithRetry(session, file, pending.shift())
+        done++
+        if (onProgress) onProgress(done / session.total_chunks)
+      }
+    }
+    await Promise.all(Array.from({ length: UPLOAD_CONCURRENCY }, worker))
+
+    const response = await api.post(`/uploads/${session.id}/complete`, null, { timeout: 0 })
+    localStorage.removeItem(uploadSessionKey(file))
+    return response
+  },
+
+  // 实时事件推送（WebSocket），断线后自动重连
+  // handlers: { onEvent(事件), onResync() 连接恢复或事件积压被丢弃时调用，调用方应重新同步数据 }
+  connectEvents(handlers = {}) {
+    const url = API_BASE_URL.replace(/^http/, 'ws') + '/ws'
+    const subscriptions = new Set()
+    let socket = null
+    let closed = false
+    let connectedBefore = false
+    let retryDelay = 1000
+
+    const send = (action, conversationId) => {
+      if (socket && socket.readyState === WebSocket.OPEN) {
+        socket.send(JSON.stringify({ action, conversation_id: conversationId }))
+      }
+    }
+
+    const connect = () => {
+      socket = new WebSocket(url)
+      socket.onopen = () => {
+        retryDelay = 1000
+        subscriptions.forEach(id => send('subscribe', id))
+        // 断线期间可能错过事件
+        if (connectedBefore && handlers.onResync) handlers.onResync()
+        connectedBefore = true
+      }
+      socket.onmessage = (message) => {
+        const event = JSON.parse(message.data)
+        if (event.type === 'resync') {
+          if (handlers.onResync) handlers.onResync()
+        } else if (handlers.onEvent) {
+          handlers.onEvent(event)
+        }
+      }
+      socket.onclose = () => {
+        if (closed) return
+        setTimeout(connect, retryDelay)
+        retryDelay = Math.min(retryDelay * 2, 30000)
+      }
+    }
+    connect()
+
+    return {
+      subscribe(conversationId) {
+        subscriptions.add(conversationId)
+        send('subscribe', conversationId)
+      },
+      unsubscribe(conversationId) {
+        subscriptions.delete(conversationId)
+        send('unsubscribe', conversationId)
+      },
+      close() {
+        closed = true
+        if (socket) socket.close()
+      }
+    }
+  },
+
   // 上传文件
   uploadFile(file) {
     const formData = new FormData()
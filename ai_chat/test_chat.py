@@ -8,6 +8,17 @@ import time
 
 BASE_URL = "http://localhost:8000/api"
 
+def read_events(response):
+    """解析 Server-Sent Events 响应，返回 (事件名, 数据) 列表"""
+    events = []
+    event = None
+    for line in response.iter_lines(decode_unicode=True):
+        if line.startswith("event: "):
+            event = line[len("event: "):]
+        elif line.startswith("data: "):
+            events.append((event, json.loads(line[len("data: "):])))
+    return events
+
 def test_api():
     print("🚀 开始测试聊天应用API...")
     
@@ -88,6 +99,46 @@ def test_api():
         print(f"❌ 文件上传失败: {response.status_code}")
         print(f"错误信息: {response.text}")
     
+    # 7. 测试流式生成回复
+    print("\n7. 测试流式生成回复...")
+    question = "请介绍一下你自己"
+    response = requests.post(f"{BASE_URL}/conversations/{conversation_id}/completions",
+                           json={"content": question}, stream=True)
+    if response.status_code != 200:
+        print(f"❌ 流式生成失败: {response.status_code}")
+        return
+    events = read_events(response)
+    names = [name for name, _ in events]
+    # 事件顺序：先是保存的用户消息，然后是若干片段，最后是保存的助手回复
+    if (len(names) < 3 or names[0] != "message" or names[-1] != "done"
+            or any(name != "token" for name in names[1:-1])):
+        print(f"❌ 事件顺序不正确: {names}")
+        return
+    user_message, assistant_message = events[0][1], events[-1][1]
+    reply = "".join(data["content"] for _, data in events[1:-1])
+    if user_message["content"] != question or assistant_message["content"] != reply:
+        print(f"❌ 事件内容不正确: {user_message} / {assistant_message}")
+        return
+    print(f"✅ 流式生成成功: {len(names) - 2} 个片段，回复: {reply[:30]}...")
+    
+    response = requests.get(f"{BASE_URL}/conversations/{conversation_id}/messages")
+    stored = response.json()[-2:] if response.status_code == 200 else []
+    if [(m["id"], m["role"], m["content"]) for m in stored] != [
+        (user_message["id"], "user", question),
+        (assistant_message["id"], "assistant", reply),
+    ]:
+        print(f"❌ 助手回复未保存: {stored}")
+        return
+    print("✅ 用户消息和助手回复已保存")
+    
+    response = requests.post(f"{BASE_URL}/conversations/999999999/completions",
+                           json={"content": question})
+    if response.status_code == 404:
+        print("✅ 不存在的对话返回 404")
+    else:
+        print(f"❌ 不存在的对话应返回 404: {response.status_code}")
+        return
+    
     print("\n🎉 API测试完成！")
 
 if __name__ == "__main__":
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+测试滚动摘要：用很小的压缩阈值和抽取式摘要验证压缩的边界、旧摘要的删除和 ?compact=true 的返回
+
+不需要启动服务，在临时目录中导入并启动应用，请求经 ASGI 直接调用。
+"""
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend")
+
+TRIGGER_TOKENS = 300
+KEEP_TOKENS = 100
+STEP_TOKENS = 120
+
+
+def check(condition, description):
+    print(f"  {'✅' if condition else '❌'} {description}")
+    return condition
+
+
+def wait_for(condition, timeout=10.0):
+    """等待后台压缩完成"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return condition()
+
+
+def run(client, app_main, batches):
+    database = sqlite3.connect("chat.db")
+    compactor = app_main.compactor
+
+    def token_totals(conversation_id):
+        """消息 id -> 截至该消息的累计 token 数"""
+        return dict(database.execute(
+            "SELECT id, token_total FROM messages WHERE conversation_id = ? ORDER BY id",
+            (conversation_id,)
+        ).fetchall())
+
+    def summary_rows(conversation_id):
+        return database.execute(
+            "SELECT id, end_message_id FROM summaries WHERE conversation_id = ?", (conversation_id,)
+        ).fetchall()
+
+    def content(index):
+        return f"第 {index} 条消息：" + "这是一段用于测试压缩的内容。" * 3
+
+    conversation_id = client.post("/api/conversations", json={"title": "压缩测试"}).json()["id"]
+
+    # 经接口写入的消息会通知后台压缩，未超过触发阈值时不压缩；各条消息长度相近，留出一条的余量
+    index = below = size = 0
+    while below + 2 * size <= TRIGGER_TOKENS:
+        client.post(f"/api/conversations/{conversation_id}/messages",
+                    json={"role": "user", "content": content(index)})
+        index += 1
+        current = max(token_totals(conversation_id).values())
+        below, size = current, current - below
+    wait_for(lambda: not compactor.pending)
+    time.sleep(0.1)
+    results = [
+        check(below <= TRIGGER_TOKENS and not summary_rows(conversation_id),
+              f"累计 {below} 个 token（不超过 {TRIGGER_TOKENS}）时后台不压缩"),
+        check(client.portal.call(compactor.compact, conversation_id) == 0, "直接压缩也不写入摘要"),
+    ]
+
+    # 其余消息直接写库、不通知后台压缩，再手动压缩一次，结果不受后台任务的时机影响
+    for index in range(index, index + 30):
+        client.portal.call(app_main.db.add_message, conversation_id,
+                           "user" if index % 2 == 0 else "assistant", content(index))
+    written = client.portal.call(compactor.compact, conversation_id)
+    totals = token_totals(conversation_id)
+    ids = list(totals)
+    total = totals[ids[-1]]
+
+    # 保留边界：结束位置落在最近 KEEP_TOKENS 以内的消息保留原文，之前的全部压缩
+    end_message_id = summary_rows(conversation_id)[0][1]
+    first_kept = ids[ids.index(end_message_id) + 1]
+    boundary = total - KEEP_TOKENS
+    results += [
+        check(totals[end_message_id] <= boundary,
+              f"最后压缩的消息结束于 {totals[end_message_id]}（不超过 {boundary}）"),
+        check(totals[first_kept] > boundary,
+              f"最早保留的消息结束于 {totals[first_kept]}（超过 {boundary}）"),
+    ]
+
+    # 每次摘要的消息：依次衔接，每段不超过 STEP_TOKENS
+    summarized = [message_id for batch in batches for message_id in batch]
+    sizes, base = [], 0
+    for batch in batches:
+        sizes.append(totals[batch[-1]] - base)
+        base = totals[batch[-1]]
+    results += [
+        check(written == len(batches) > 1, f"分 {written} 段压缩"),
+        check(summarized == ids[:ids.index(end_message_id) + 1], "各段依次覆盖已压缩的消息"),
+        check(all(size <= STEP_TOKENS for size in sizes), f"每段 token 数 {sizes} 不超过 {STEP_TOKENS}"),
+        check(len(summary_rows(conversation_id)) == 1, "被取代的旧摘要已删除"),
+    ]
+
+    # 压缩后新增的消息不超过触发阈值时不再压缩
+    client.portal.call(app_main.db.add_message, conversation_id, "user", content(index + 1))
+    results.append(check(client.portal.call(compactor.compact, conversation_id) == 0,
+                         "新增消息后未压缩部分不超过触发阈值时不再压缩"))
+    ids = list(token_totals(conversation_id))
+
+    # ?compact=true 返回摘要和其后的消息，默认返回全部消息
+    full = client.get(f"/api/conversations/{conversation_id}").json()
+    compact = client.get(f"/api/conversations/{conversation_id}", params={"compact": "true"}).json()
+    summary = compact["summary"]
+    results += [
+        check(full["summary"] is None and [m["id"] for m in full["messages"]] == ids, "默认返回全部消息"),
+        check(summary is not None and summary["end_message_id"] == end_message_id,
+              "?compact=true 返回最新的摘要"),
+        check([m["id"] for m in compact["messages"]] == ids[ids.index(end_message_id) + 1:],
+              f"?compact=true 只返回摘要之后的 {len(compact['messages'])} 条消息"),
+        check(compact["messages"] == full["messages"][ids.index(end_message_id) + 1:], "消息内容一致"),
+    ]
+    database.close()
+    return all(results)
+
+
+def main():
+    """主测试函数"""
+    print("🚀 开始滚动摘要测试")
+    print("=" * 50)
+
+    # 阈值在导入 summarizer 时读取，main.py 使用相对路径存放数据库，都要在导入应用之前设置
+    os.environ.update({
+        "COMPACT_TRIGGER_TOKENS": str(TRIGGER_TOKENS),
+        "COMPACT_KEEP_TOKENS": str(KEEP_TOKENS),
+        "COMPACT_STEP_TOKENS": str(STEP_TOKENS),
+        "SUMMARIZER": "recording",
+    })
+    root = tempfile.mkdtemp(prefix="ai-chat-compaction-")
+    workdir = os.path.join(root, "work")
+    os.makedirs(workdir)
+    os.chdir(workdir)
+    sys.path.insert(0, BACKEND_DIR)
+
+    from fastapi.testclient import TestClient
+    import main as app_main
+    from summarizer import ExtractiveSummarizer, register_summarizer
+
+    batches = []
+
+    class RecordingSummarizer(ExtractiveSummarizer):
+        """记录每次送去摘要的消息 id"""
+
+        async def summarize(self, previous, messages):
+            batches.append([message["id"] for message in messages])
+            return await super().summarize(previous, messages)
+
+    register_summarizer("recording", RecordingSummarizer)
+
+    try:
+        with TestClient(app_main.app) as client:
+            print("🧪 压缩测试...")
+            passed = run(client, app_main, batches)
+    finally:
+        os.chdir(root)
+        shutil.rmtree(root, ignore_errors=True)
+
+    print()
+    print("=" * 50)
+    print("🎉 所有检查通过！" if passed else "⚠️  部分检查失败。")
+    return passed
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
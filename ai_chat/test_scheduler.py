@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+测试模型调用调度：用本地假模型验证并发上限、优先级、相同请求合并和断开后释放名额
+
+不需要启动服务，直接在进程内驱动 LLMScheduler。
+"""
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+
+from llm import FakeLLMProvider  # noqa: E402
+from scheduler import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, LLMScheduler  # noqa: E402
+
+
+def prompt(text):
+    return [{"role": "user", "content": text}]
+
+
+async def collect(scheduler, text, **kwargs):
+    return "".join([token async for token in scheduler.stream_chat(prompt(text), 0, **kwargs)])
+
+
+def check(condition, description):
+    print(f"  {'✅' if condition else '❌'} {description}")
+    return condition
+
+
+async def test_concurrency_limit():
+    """同时进行的模型调用不超过 max_concurrency，同一对话不超过 per_conversation"""
+    provider = FakeLLMProvider(token_delay=0.002, latency=0.02)
+    scheduler = LLMScheduler(provider, max_concurrency=3)
+    await asyncio.gather(*(collect(scheduler, f"问题 {i}", conversation_id=i) for i in range(10)))
+    results = [
+        check(provider.max_active <= scheduler.max_concurrency,
+              f"最大并发 {provider.max_active} <= {scheduler.max_concurrency}"),
+        check(provider.max_active == scheduler.max_concurrency, "并发名额被用满"),
+        check(scheduler.completed == 10, f"完成 {scheduler.completed}/10 个调用"),
+    ]
+
+    provider = FakeLLMProvider(token_delay=0.002, latency=0.02)
+    scheduler = LLMScheduler(provider, max_concurrency=3, per_conversation=1)
+    await asyncio.gather(*(collect(scheduler, f"问题 {i}", conversation_id=1) for i in range(4)))
+    results.append(check(provider.max_active == 1, f"同一对话的最大并发 {provider.max_active} == 1"))
+    return all(results)
+
+
+async def test_priority():
+    """名额空出时，排队的交互请求先于后台请求执行"""
+    scheduler = LLMScheduler(FakeLLMProvider(token_delay=0.002, latency=0.05), max_concurrency=1)
+    order = []
+
+    async def run(name, priority):
+        await collect(scheduler, name, priority=priority)
+        order.append(name)
+
+    blocker = asyncio.create_task(run("占用", PRIORITY_INTERACTIVE))
+    await asyncio.sleep(0.01)
+    queued = [
+        asyncio.create_task(run("后台 1", PRIORITY_BACKGROUND)),
+        asyncio.create_task(run("后台 2", PRIORITY_BACKGROUND)),
+        asyncio.create_task(run("交互 1", PRIORITY_INTERACTIVE)),
+        asyncio.create_task(run("交互 2", PRIORITY_INTERACTIVE)),
+    ]
+    await asyncio.sleep(0.01)
+    depth = scheduler.queue_depth()
+    await asyncio.gather(blocker, *queued)
+    return all([
+        check(depth == {PRIORITY_INTERACTIVE: 2, PRIORITY_BACKGROUND: 2}, f"排队中 {depth}"),
+        check(order == ["占用", "交互 1", "交互 2", "后台 1", "后台 2"], f"执行顺序 {order}"),
+    ])
+
+
+async def test_coalescing():
+    """相同的进行中请求只调用一次模型，后加入的订阅者收到完整回复"""
+    provider = FakeLLMProvider(token_delay=0.005)
+    scheduler = LLMScheduler(provider, max_concurrency=4)
+    expected = provider.build_reply(prompt("相同的问题"))
+    replies = await asyncio.gather(*(collect(scheduler, "相同的问题") for _ in range(5)))
+    results = [
+        check(scheduler.submitted == 1, f"5 个相同请求提交 {scheduler.submitted} 次"),
+        check(scheduler.coalesced == 4, f"合并 {scheduler.coalesced} 次"),
+        check(provider.max_active == 1, "模型只被调用一次"),
+        check(all(reply == expected for reply in replies), "每个请求都收到完整回复"),
+    ]
+
+    # 生成进行到一半时加入：先补发已生成的片段，再继续接收
+    scheduler = LLMScheduler(FakeLLMProvider(token_delay=0.005), max_concurrency=4)
+    first = scheduler.stream_chat(prompt("相同的问题"), 0)
+    tokens = [await first.__anext__() for _ in range(3)]
+    late = asyncio.create_task(collect(scheduler, "相同的问题"))
+    tokens += [token async for token in first]
+    late_reply = await late
+    results += [
+        check(scheduler.submitted == 1 and scheduler.coalesced == 1, "中途加入的请求被合并"),
+        check(late_reply == "".join(tokens) == expected, "中途加入的请求收到完整回复"),
+    ]
+    return all(results)
+
+
+async def test_disconnect():
+    """订阅者全部断开后取消调用，释放名额给排队的请求；已取消的请求不计入排队长度"""
+    provider = FakeLLMProvider(token_delay=0.05)
+    scheduler = LLMScheduler(provider, max_concurrency=1)
+    stream = scheduler.stream_chat(prompt("很长的回答"), 0)
+    await stream.__anext__()
+    waiting = asyncio.create_task(collect(scheduler, "排队的问题"))
+    await asyncio.sleep(0.01)
+    queued_before = scheduler.stats()["queued"]
+    await stream.aclose()  # 客户端断开
+    await asyncio.wait_for(waiting, timeout=5)
+    results = [
+        check(queued_before == 1, "断开前有 1 个请求在排队"),
+        check(scheduler.completed == 1, "断开的调用被取消，排队的请求随后完成"),
+        check(provider.active == 0 and scheduler.stats()["running"] == 0, "名额全部归还"),
+        check(scheduler.stats()["in_flight"] == 0, "没有残留的进行中调用"),
+    ]
+
+    # 排队中断开：条目留在堆里直到放行，但不再计入排队长度
+    scheduler = LLMScheduler(FakeLLMProvider(token_delay=0.01), max_concurrency=1)
+    blocker = asyncio.create_task(collect(scheduler, "占用"))
+    await asyncio.sleep(0.01)
+    abandoned = asyncio.create_task(collect(scheduler, "放弃的问题"))
+    await asyncio.sleep(0.01)
+    abandoned.cancel()
+    await asyncio.sleep(0.01)
+    waiting = asyncio.create_task(collect(scheduler, "排队的问题"))
+    await asyncio.sleep(0.01)
+    stats = scheduler.stats()
+    await asyncio.gather(blocker, waiting)
+    results += [
+        check(stats["queued"] == 1, f"排队中 {stats['queued']} 个请求"),
+        check(stats["max_queue_depth"] == 1, f"最大排队长度 {stats['max_queue_depth']} == 1"),
+        check(scheduler.completed == 2, "放弃的请求没有调用模型"),
+    ]
+    return all(results)
+
+
+def main():
+    """主测试函数"""
+    print("🚀 开始模型调度测试")
+    print("=" * 50)
+
+    tests = [
+        ("并发上限", test_concurrency_limit),
+        ("优先级", test_priority),
+        ("相同请求合并", test_coalescing),
+        ("断开释放名额", test_disconnect),
+    ]
+
+    results = []
+    for test_name, test_func in tests:
+        print(f"🧪 {test_name}测试...")
+        results.append((test_name, asyncio.run(test_func())))
+        print()
+
+    print("=" * 50)
+    print("📊 测试结果汇总:")
+    passed = sum(1 for _, result in results if result)
+    for test_name, result in results:
+        print(f"  {test_name}: {'✅ 通过' if result else '❌ 失败'}")
+    print(f"\n总计: {passed}/{len(results)} 项测试通过")
+    return passed == len(results)
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)